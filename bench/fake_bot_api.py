@@ -0,0 +1,330 @@
+# ================= FAKE TELEGRAM BOT API =================
+#
+# Local stand-in for api.telegram.org, enough for main.py to run against:
+# getUpdates (long polling), sendMessage, editMessageText,
+# answerCallbackQuery, sendDocument, plus True for anything else.
+# Every call is recorded with a timestamp so a load generator can measure
+# what the bot sent and when.
+#
+#   python bench/fake_bot_api.py --port 8081 --latency 0.05 --rate-429 0.01
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+#
+# Updates can be pushed with POST /_inject {"chat_id", "user_id", "text"}
+# (or "data" + "message_id" for a button press) and the call log read with
+# GET /_calls?since=<index>.
+
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+SENDING_METHODS = {"sendMessage", "editMessageText", "sendDocument"}
+
+class Call:
+    """One Bot API request as the fake server saw it."""
+
+    __slots__ = ("at", "method", "chat_id", "text", "status", "size", "message_id", "file_name", "index")
+
+    def __init__(self, at, method, chat_id, text, status, size=0, message_id=None, file_name=None):
+        self.at = at
+        self.method = method
+        self.chat_id = chat_id
+        self.text = text
+        self.status = status    # "ok", "429", "limit" (rate limit enforced), "not_modified"
+        self.size = size        # bytes of an uploaded document
+        self.message_id = message_id  # message sent or edited, None if unknown (e.g. a refused send)
+        self.file_name = file_name    # name of an uploaded document
+        self.index = None       # position in the call log, set when recorded
+
+    def to_json(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+class Bucket:
+    """Token bucket used to enforce Telegram-like rate limits."""
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.stamp = burst, time.monotonic()
+
+    def take(self):
+        """0 if a token was taken, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class FakeBotAPI:
+    """
+    State of the fake server: pending updates, sent messages and the call
+    log. Latency, random 429s and rate limit enforcement are configurable.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1,
+                 enforce_limits=False, chat_rate=1.0, global_rate=30.0, burst=3):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.enforce_limits = enforce_limits
+        self.chat_rate = chat_rate
+        self.burst = burst
+        self.global_bucket = Bucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.cond = threading.Condition()
+        self.updates = []             # pending updates, oldest first
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.texts = {}               # (chat_id, message_id) -> current text
+        self.calls = []               # Call log, in arrival order
+        self.polls = 0                # getUpdates requests served
+
+    # ---------- Updates ----------
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _chat(self, chat_id):
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "group"}
+
+    def inject_message(self, chat_id, user_id, text):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": self._chat(chat_id), "from": self._user(user_id), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._push({"message": message})
+
+    def inject_callback(self, chat_id, user_id, data, message_id):
+        message = {"message_id": message_id, "date": int(time.time()), "chat": self._chat(chat_id),
+                   "from": BOT_USER, "text": self.texts.get((chat_id, message_id), "")}
+        self._push({"callback_query": {"id": str(next(self.update_ids)), "from": self._user(user_id),
+                                       "chat_instance": str(chat_id), "message": message, "data": data}})
+
+    def _push(self, update):
+        with self.cond:
+            update["update_id"] = next(self.update_ids)
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + min(timeout, 30)
+        with self.cond:
+            self.polls += 1
+            self.cond.notify_all()
+            # Updates below offset were confirmed by the bot
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            return list(self.updates)
+
+    # ---------- Call log ----------
+
+    def record(self, call):
+        with self.cond:
+            call.index = len(self.calls)
+            self.calls.append(call)
+            self.cond.notify_all()
+
+    def wait_for(self, predicate, timeout, since=0):
+        """First logged call from index `since` on matching predicate, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                for call in self.calls[since:]:
+                    if predicate(call):
+                        return call
+                since = len(self.calls)
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self.cond.wait(left)
+
+    def wait_ready(self, timeout):
+        """Wait until the bot has started polling."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not self.polls:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.cond.wait(left)
+            return True
+
+    # ---------- Methods ----------
+
+    def _limited(self, chat_id):
+        """Seconds to wait if this call would break Telegram's limits, else 0."""
+        if not self.enforce_limits:
+            return 0
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = Bucket(self.chat_rate, self.burst)
+        with self.cond:
+            return bucket.take() or self.global_bucket.take()
+
+    def handle(self, method, params, upload_size=0, file_name=None):
+        """Returns (http status, response JSON)."""
+        if method == "getUpdates":
+            updates = self.get_updates(int(params.get("offset", 0) or 0), float(params.get("timeout", 0) or 0))
+            return 200, {"ok": True, "result": updates}
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        text = params.get("text") or params.get("caption") or ""
+        message_id = int(params["message_id"]) if params.get("message_id") else None
+        now = time.time()
+
+        if method in SENDING_METHODS:
+            wait = self._limited(chat_id)
+            if wait or random.random() < self.rate_429:
+                retry_after = max(1, int(wait + 0.999)) if wait else self.retry_after
+                self.record(Call(now, method, chat_id, text, "limit" if wait else "429", 0, message_id, file_name))
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+
+        if method == "editMessageText":
+            key = (chat_id, message_id or 0)
+            if self.texts.get(key) == text:
+                self.record(Call(now, method, chat_id, text, "not_modified", 0, message_id))
+                return 400, {"ok": False, "error_code": 400,
+                             "description": "Bad Request: message is not modified"}
+            self.texts[key] = text
+            self.record(Call(now, method, chat_id, text, "ok", 0, message_id))
+            return 200, {"ok": True, "result": self._message(chat_id, key[1], text)}
+
+        if method in ("sendMessage", "sendDocument"):
+            message_id = next(self.message_ids)
+            self.texts[(chat_id, message_id)] = text
+            self.record(Call(now, method, chat_id, text, "ok", upload_size, message_id, file_name))
+            result = self._message(chat_id, message_id, text)
+            if method == "sendDocument":
+                result["document"] = {"file_id": f"doc{message_id}", "file_unique_id": f"doc{message_id}",
+                                      "file_size": upload_size}
+            return 200, {"ok": True, "result": result}
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+
+        # answerCallbackQuery, setWebhook, deleteWebhook, ...
+        self.record(Call(now, method, chat_id, text, "ok"))
+        return 200, {"ok": True, "result": True}
+
+    def _message(self, chat_id, message_id, text):
+        return {"message_id": message_id, "date": int(time.time()), "chat": self._chat(chat_id),
+                "from": BOT_USER, "text": text}
+
+    # ---------- HTTP ----------
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Start serving in a daemon thread; returns the HTTP server (see .server_address)."""
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                body = self.rfile.read(length) if length else b""
+                upload_size, file_name = _parse_body(self.headers.get("Content-Type", ""), body, params)
+
+                if url.path == "/_inject":
+                    if "data" in params:
+                        api.inject_callback(int(params["chat_id"]), int(params.get("user_id", params["chat_id"])),
+                                            params["data"], int(params.get("message_id", 0)))
+                    else:
+                        api.inject_message(int(params["chat_id"]), int(params.get("user_id", params["chat_id"])),
+                                           params["text"])
+                    return self._reply(200, {"ok": True})
+                if url.path == "/_calls":
+                    since = int(params.get("since", 0))
+                    with api.cond:
+                        calls = [c.to_json() for c in api.calls[since:]]
+                    return self._reply(200, {"ok": True, "result": calls})
+
+                # /bot<token>/<method>
+                parts = url.path.strip("/").split("/")
+                if len(parts) != 2 or not parts[0].startswith("bot"):
+                    return self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                status, response = api.handle(parts[1], params, upload_size, file_name)
+                self._reply(status, response)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return server
+
+def _parse_body(content_type, body, params):
+    """Merge form, JSON or multipart fields into params; returns (size of uploaded files, first file name)."""
+    if not body:
+        return 0, None
+    if content_type.startswith("application/json"):
+        params.update({k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body).items()})
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        params.update(parse_qsl(body.decode()))
+    elif content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        size, file_name = 0, None
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                size += len(payload)
+                file_name = file_name or part.get_filename()
+            elif name:
+                params[name] = payload.decode(errors="replace")
+        return size, file_name
+    return 0, None
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random seconds, uniform 0..jitter")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of a 429 on sending calls")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--enforce-limits", action="store_true", help="answer 429 when Telegram's rate limits are broken")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_429, args.retry_after, args.enforce_limits)
+    server = api.serve(args.host, args.port)
+    print(f"🧪 Fake Bot API on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
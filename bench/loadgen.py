@@ -0,0 +1,312 @@
+# ================= LOAD GENERATOR =================
+#
+# Runs main.py against the fake Bot API and drives it like N admins
+# working in M chats each: commands with heavy output, progress bars,
+# prompts that get answered, and long jobs that get /stop-ped. Reports
+# latency percentiles, Bot API calls per command, and CPU and RSS of the
+# bot process.
+#
+#   python bench/loadgen.py --admins 2 --chats 2 --rounds 3 --latency 0.05
+#   python bench/loadgen.py --enforce-limits --json bench_output.json
+#
+# Extra settings for the bot go through --env, e.g. --env CONSOLE_MAX_MESSAGES=5.
+
+import argparse
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import FakeBotAPI
+
+MAIN_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+ACK = re.compile(r"\[#(\d+)(@[\w.-]+)?\] \$ ")
+FOOTER = re.compile(r"\[(exit -?\d+|killed by \w+|[a-z]+) · [\d.]+s( · [^\]]*)?\]")
+
+# name -> (command, needs) where needs is "answer" (reply to a prompt) or "stop"
+SCENARIOS = {
+    "heavy": ("seq 1 {lines}", None),
+    "progress": ("for i in $(seq 1 100); do printf '\\r%3d%%' $i; sleep 0.01; done; echo", None),
+    "prompt": ("read -p 'Name: ' n; echo hello $n", "answer"),
+    "stop": ("sleep 60", "stop"),
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+class ProcessSampler:
+    """Samples RSS of a process; CPU comes from /proc/<pid>/stat at the end."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def rss(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def cpu(self):
+        """(bot CPU seconds, CPU seconds of reaped jobs)."""
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return float("nan"), float("nan")
+        tick = os.sysconf("SC_CLK_TCK")
+        # utime, stime, cutime, cstime are fields 14-17 of stat
+        return (int(fields[11]) + int(fields[12])) / tick, (int(fields[13]) + int(fields[14])) / tick
+
+class ChatDriver(threading.Thread):
+    """Plays the scenarios in one chat, one command at a time, and records timings."""
+
+    def __init__(self, api, chat_id, user_id, scenarios, rounds, lines, timeout, settle, results):
+        super().__init__(daemon=True)
+        self.api = api
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.scenarios = scenarios
+        self.rounds = rounds
+        self.lines = lines
+        self.timeout = timeout
+        self.settle = settle
+        self.results = results
+        self.seq = 0
+        self.last_footer = None   # footer of the previous job, to recognize its late messages
+
+    def _mine(self, call):
+        return call.chat_id == self.chat_id and call.status in ("ok", "not_modified")
+
+    def _owner(self, ack, job_id, previous=None, footer=None, until=None):
+        """
+        Predicate for the calls of one job: messages sent from its ack on
+        (after the next job's ack `until` only if they carry this job's
+        footer), edits of those messages and its log document. Trailing
+        edits, late messages (they carry the `previous` footer) and the log
+        of the previous job don't match.
+        """
+        messages = {ack.message_id}
+
+        def owns(call):
+            if call.chat_id != self.chat_id or call.index < ack.index:
+                return False
+            if call.method == "sendMessage":
+                if previous and previous in call.text:
+                    return False
+                if until is not None and call.index >= until.index and not (footer and footer in call.text):
+                    return False
+                if call.message_id is not None:
+                    messages.add(call.message_id)
+                return True
+            if call.method == "editMessageText":
+                return call.message_id in messages
+            if call.method == "sendDocument":
+                return call.file_name == f"job-{job_id}.log.gz"
+            return True
+        return owns
+
+    def _settle(self):
+        """Wait until the chat was quiet for self.settle seconds."""
+        while self.api.wait_for(lambda c: c.chat_id == self.chat_id, self.settle, len(self.api.calls)):
+            pass
+
+    def run(self):
+        plays = []   # (result, ack, job id, footer)
+        for _ in range(self.rounds):
+            for name in self.scenarios:
+                try:
+                    plays.append(self.play(name))
+                except Exception as e:
+                    plays.append(({"scenario": name, "error": str(e)}, None, None, None))
+
+        # A job's last edits and its log document can arrive while the next job runs: count once all are in
+        self._settle()
+        with self.api.cond:
+            calls = [c for c in self.api.calls if c.chat_id == self.chat_id]
+        previous = None
+        for i, (result, ack, job_id, footer) in enumerate(plays):
+            if ack is not None and "error" not in result:
+                until = next((later[1] for later in plays[i + 1:] if later[1] is not None), None)
+                owns = self._owner(ack, job_id, previous, footer, until)
+                mine = [c for c in calls if owns(c)]
+                result["calls"] = sum(1 for c in mine if c.status == "ok")
+                result["documents"] = sum(1 for c in mine if c.method == "sendDocument" and c.status == "ok")
+                result["wasted"] = sum(1 for c in mine if c.status != "ok")
+            previous = footer
+            self.results.append(result)
+
+    def play(self, name):
+        """Run one scenario; returns (result without call counts, ack call, job id, footer)."""
+        self.seq += 1
+        marker = f"BENCH-{self.chat_id}-{self.seq}"
+        template, needs = SCENARIOS[name]
+        cmd = f"echo {marker}; " + template.format(lines=self.lines)
+
+        since = len(self.api.calls)
+        start = time.time()
+        self.api.inject_message(self.chat_id, self.user_id, cmd)
+        # "[#<job id>] $ <command>" names the job the rest of the calls are matched against
+        ack = self.api.wait_for(lambda c: self._mine(c) and c.method == "sendMessage" and marker in c.text
+                                and ACK.search(c.text), self.timeout, since)
+        if ack is None:
+            self.last_footer = None
+            return {"scenario": name, "error": "no ack"}, None, None, None
+        job_id = ACK.search(ack.text).group(1)
+        owns = self._owner(ack, job_id, self.last_footer)
+        ours = lambda c: owns(c) and self._mine(c)
+        # The marker on a line of its own is job output, not the echoed command
+        output = re.compile(rf"^{marker}$", re.M)
+        first = self.api.wait_for(lambda c: ours(c) and output.search(c.text), self.timeout, ack.index)
+        if needs == "answer":
+            if self.api.wait_for(lambda c: ours(c) and "Name:" in c.text, self.timeout, ack.index):
+                self.api.inject_message(self.chat_id, self.user_id, "bench")
+        elif needs == "stop" and first is not None:
+            self.api.inject_message(self.chat_id, self.user_id, "/stop")
+        done = self.api.wait_for(lambda c: ours(c) and FOOTER.search(c.text), self.timeout, ack.index)
+        if done is None:
+            self.last_footer = None
+            return {"scenario": name, "error": "timed out"}, ack, job_id, None
+        self.last_footer = FOOTER.search(done.text).group(0)
+
+        # Trailing edits and the log document are still queued behind the chat's rate limit
+        self._settle()
+        result = {
+            "scenario": name,
+            "ack": ack.at - start,
+            "first_output": first.at - start if first else None,
+            "done": done.at - start,
+        }
+        return result, ack, job_id, self.last_footer
+
+def report(results, api, sampler, elapsed):
+    summary = {"elapsed": elapsed, "scenarios": {}}
+    for name in SCENARIOS:
+        runs = [r for r in results if r["scenario"] == name]
+        if not runs:
+            continue
+        ok = [r for r in runs if "error" not in r]
+        entry = {"runs": len(runs), "errors": len(runs) - len(ok)}
+        for key in ("ack", "first_output", "done"):
+            values = [r[key] for r in ok if r.get(key) is not None]
+            entry[key] = {f"p{p}": percentile(values, p) for p in (50, 95, 99)}
+        entry["calls_per_command"] = sum(r["calls"] for r in ok) / len(ok) if ok else float("nan")
+        entry["documents"] = sum(r["documents"] for r in ok)
+        entry["wasted_per_command"] = sum(r["wasted"] for r in ok) / len(ok) if ok else float("nan")
+        summary["scenarios"][name] = entry
+
+    by_status = {}
+    for call in api.calls:
+        key = f"{call.method}:{call.status}"
+        by_status[key] = by_status.get(key, 0) + 1
+    summary["api_calls"] = by_status
+    bot_cpu, jobs_cpu = sampler.cpu()
+    summary["bot_cpu_seconds"] = bot_cpu
+    summary["jobs_cpu_seconds"] = jobs_cpu
+    summary["peak_rss_bytes"] = sampler.peak_rss
+
+    print(f"\n📊 {len(results)} commands in {elapsed:.1f}s")
+    print(f"{'scenario':<10} {'runs':>5} {'err':>4} {'ack p50/p95':>14} {'first p50/p95':>15} "
+          f"{'done p50/p95/p99':>20} {'calls':>7} {'wasted':>7} {'docs':>5}")
+    for name, e in summary["scenarios"].items():
+        print(f"{name:<10} {e['runs']:>5} {e['errors']:>4} "
+              f"{e['ack']['p50']:>6.3f}/{e['ack']['p95']:<7.3f} "
+              f"{e['first_output']['p50']:>6.3f}/{e['first_output']['p95']:<8.3f} "
+              f"{e['done']['p50']:>6.2f}/{e['done']['p95']:.2f}/{e['done']['p99']:<6.2f} "
+              f"{e['calls_per_command']:>7.1f} {e['wasted_per_command']:>7.1f} {e['documents']:>5}")
+    print("\nAPI calls: " + ", ".join(f"{k}={v}" for k, v in sorted(by_status.items())))
+    print(f"CPU: bot {bot_cpu:.2f}s, jobs {jobs_cpu:.2f}s · peak RSS {sampler.peak_rss / 1024 / 1024:.1f} MB")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test main.py against a fake Bot API")
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--chats", type=int, default=2, help="chats per admin")
+    parser.add_argument("--rounds", type=int, default=3, help="times each chat plays every scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--lines", type=int, default=20000, help="output lines of the heavy scenario")
+    parser.add_argument("--latency", type=float, default=0.03)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--enforce-limits", action="store_true")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a command to finish")
+    parser.add_argument("--settle", type=float, default=1.5,
+                        help="after a command, wait until the chat was quiet this long before counting calls")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the bot")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_429, enforce_limits=args.enforce_limits)
+    server = api.serve()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Every chat is a private chat with its own admin user id
+    chats = [(10000 + a * 100 + c, 10000 + a * 100) for a in range(args.admins) for c in range(args.chats)]
+    workdir = tempfile.mkdtemp(prefix="termux-bench-")
+    with open(os.path.join(workdir, "bot_data.json"), "w") as f:
+        json.dump({"admins": [chat_id for chat_id, _ in chats]}, f)
+
+    env = dict(os.environ, BOT_TOKEN="123456:bench", MAIN_ADMIN_ID=str(chats[0][0]),
+               TELEGRAM_API_URL=api_url, PORT=str(free_port()), PYTHONUNBUFFERED="1")
+    env.update(item.split("=", 1) for item in args.env)
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    bot = subprocess.Popen([sys.executable, MAIN_PY], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"🧪 Fake Bot API {api_url} · bot pid {bot.pid} · workdir {workdir}")
+
+    try:
+        if not api.wait_ready(30):
+            sys.exit(f"❌ Bot did not start polling, see {workdir}/bot.log")
+        sampler = ProcessSampler(bot.pid)
+        results = []
+        drivers = [ChatDriver(api, chat_id, user_id, scenarios, args.rounds, args.lines, args.timeout, args.settle, results)
+                   for chat_id, user_id in chats]
+        started = time.time()
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        summary = report(results, api, sampler, time.time() - started)
+        sampler.stopped.set()
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(summary, f, indent=2)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(5)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -4,118 +4,3220 @@ import os
 import pty
 import threading
 import uuid
-import select
+import hmac
+import selectors
+import codecs
+import heapq
+import itertools
 import json
 import time
 import signal
+import asyncio
+import gzip
+import shutil
+import tempfile
+import mmap
+import bisect
+import html
+import re
+import fcntl
+import termios
+import struct
+import sqlite3
+import atexit
+import zlib
+import subprocess
+import socket
+import hashlib
+import tarfile
+import requests
+from array import array
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, request, render_template_string
+from flask import Flask, Response, request, render_template_string, jsonify
 import telebot
 from telebot import types
+import node_link
+try:
+    from flask_sock import Sock   # Optional, only the browser terminal needs it
+except ImportError:
+    Sock = None
 
 # ===================== CONFIGURATION =====================
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 MAIN_ADMIN_ID = int(os.environ.get("MAIN_ADMIN_ID"))  # Main admin who can add/remove other admins
 BASE_DIR = os.getcwd()
 PORT = int(os.environ.get("PORT", 9090))
-DATA_FILE = "bot_data.json"
+DATA_FILE = "bot_data.json"                                        # legacy store, imported into DB_FILE once
+DB_FILE = os.environ.get("DB_FILE", "bot_data.db")
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", 0.5))  # seconds state writes are batched for
+EDIT_SESSION_TTL = int(os.environ.get("EDIT_SESSION_TTL", 24 * 3600))  # editor links stop working after this
+EDIT_SESSION_MAX = int(os.environ.get("EDIT_SESSION_MAX", 1000))   # least recently used links go first
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 3600))           # idle chats drop out of the session list
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 10000))
+REGISTRY_SHARDS = int(os.environ.get("REGISTRY_SHARDS", 16))     # lock stripes of the chat/job registry
+PROMPT_TTL = int(os.environ.get("PROMPT_TTL", 3600))             # unanswered job prompts and bot questions
+JOB_HISTORY_KEEP = int(os.environ.get("JOB_HISTORY_KEEP", 5000))    # finished jobs kept in the database
+HISTORY_DIR = os.environ.get("HISTORY_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "history"))
+HISTORY_SEGMENT_BYTES = int(os.environ.get("HISTORY_SEGMENT_BYTES", 4 * 1024 * 1024))  # then a new segment starts
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", 64 * 1024 * 1024))        # oldest segments go first
+HISTORY_MAX_AGE = float(os.environ.get("HISTORY_MAX_AGE_DAYS", 30)) * 86400
+HISTORY_OUTPUT_MAX = int(os.environ.get("HISTORY_OUTPUT_MAX", 1024 * 1024))   # tail of each job's output kept
+PUBLIC_URL = os.environ.get("PUBLIC_URL", "https://elite-vps-bot-try-hu7.onrender.com").rstrip("/")
+RUNTIME = os.environ.get("RUNTIME", "threads")                     # "threads" or "asyncio" (needs aiohttp)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")                  # set to receive updates via webhook instead of polling
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))        # threads feeding updates to telebot
+WEBHOOK_BACKLOG = int(os.environ.get("WEBHOOK_BACKLOG", 100))      # pending batches before Telegram is told to retry
+HANDLER_WORKERS = int(os.environ.get("HANDLER_WORKERS", 4))        # RUNTIME=asyncio: threads for handlers reading files or SQLite
+OUTPUT_FLUSH_INTERVAL = float(os.environ.get("OUTPUT_FLUSH_INTERVAL", 1.5))  # seconds between console edits
+OUTPUT_FLUSH_BYTES = int(os.environ.get("OUTPUT_FLUSH_BYTES", 3000))          # flush early once this much is buffered
+CONSOLE_LIMIT = 4000     # Telegram allows 4096 chars per message, keep some room for the code fence
+CONSOLE_MAX_MESSAGES = int(os.environ.get("CONSOLE_MAX_MESSAGES", 3))        # then only the live tail is kept in chat
+CONSOLE_ROWS = int(os.environ.get("CONSOLE_ROWS", 24))                        # terminal size jobs see
+CONSOLE_COLS = int(os.environ.get("CONSOLE_COLS", 80))
+CONSOLE_TERM = os.environ.get("CONSOLE_TERM", "xterm")                        # TERM of jobs, matches the screen emulator
+SPILL_DIR = os.environ.get("SPILL_DIR", os.path.join(tempfile.gettempdir(), "termux-bot-spill"))
+SPILL_MAX_BYTES = int(os.environ.get("SPILL_MAX_BYTES", 32 * 1024 * 1024))   # per job, oldest output is overwritten
+SPILL_KEEP = int(os.environ.get("SPILL_KEEP", 20))                            # finished job logs kept for download
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 8))              # concurrently running commands, the rest wait in a queue
+MAX_JOBS_PER_ADMIN = int(os.environ.get("MAX_JOBS_PER_ADMIN", 4))
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", 32))   # waiting jobs before new ones are refused
+JOB_DEFAULT_PRIORITY = 5                                   # 0 = most urgent, 9 = least
+JOB_LIMIT_CPU = int(os.environ.get("JOB_LIMIT_CPU", 0))    # CPU seconds per job, 0 = unlimited
+JOB_LIMIT_MEM = int(os.environ.get("JOB_LIMIT_MEM", 0))    # MB of address space per job
+JOB_LIMIT_FSIZE = int(os.environ.get("JOB_LIMIT_FSIZE", 0))   # MB, largest file a job may write
+JOB_LIMIT_NOFILE = int(os.environ.get("JOB_LIMIT_NOFILE", 0))  # open files per job
+JOB_NICE = int(os.environ.get("JOB_NICE", 5))              # jobs yield the CPU to the bot
+JOB_IONICE = os.environ.get("JOB_IONICE", "")              # "idle" or a best-effort level 0-7, needs ionice
+EDITOR_INLINE_LIMIT = int(os.environ.get("EDITOR_INLINE_LIMIT", 512 * 1024))  # bigger files load in chunks
+EDITOR_CHUNK_BYTES = int(os.environ.get("EDITOR_CHUNK_BYTES", 128 * 1024))
+LINE_INDEX_CACHE = int(os.environ.get("LINE_INDEX_CACHE", 16))                # files kept mapped and indexed
+VIEWER_PAGE_BYTES = int(os.environ.get("VIEWER_PAGE_BYTES", 3500))            # file bytes per viewer page
+VIEWER_KEEP = int(os.environ.get("VIEWER_KEEP", 256))                         # open viewers whose buttons still work
+VIEWER_TTL = int(os.environ.get("VIEWER_TTL", 6 * 3600))                      # idle viewers and browsers expire
+LINE_INDEX_TTL = int(os.environ.get("LINE_INDEX_TTL", 600))                   # idle files are unmapped
+BROWSER_PAGE_SIZE = int(os.environ.get("BROWSER_PAGE_SIZE", 20))              # entries per file browser page
+DIR_CACHE_SIZE = int(os.environ.get("DIR_CACHE_SIZE", 64))                    # directory listings kept in memory
+QUICK_TIMEOUT = float(os.environ.get("QUICK_TIMEOUT", 15))  # seconds a cached quick command may run
+SAMPLE_INTERVAL = float(os.environ.get("SAMPLE_INTERVAL", 5))  # seconds between /proc samples for /status, 0 = on demand
+SAMPLE_HISTORY = int(os.environ.get("SAMPLE_HISTORY", 60))  # samples kept for the /status sparklines
+TRANSFER_PART_BYTES = int(os.environ.get("TRANSFER_PART_BYTES", 20 * 1024 * 1024))  # /get volume size, Bot API uploads max 50 MB
+KILL_GRACE = float(os.environ.get("KILL_GRACE", 3))        # seconds between SIGTERM and SIGKILL
+JOB_HISTORY = int(os.environ.get("JOB_HISTORY", 50))       # finished jobs remembered in memory
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # e.g. http://127.0.0.1:8081 for a local/fake Bot API server
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", 30))       # messages per second across all chats
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", 1))            # messages per second in a private chat
+TG_GROUP_RATE = float(os.environ.get("TG_GROUP_RATE", 20 / 60))    # messages per second in a group chat
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST", 3))
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", 4))              # concurrent Bot API requests
+SEND_QUEUE_MAX = int(os.environ.get("SEND_QUEUE_MAX", 1000))       # queued calls before bulk output is dropped
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", 5))      # retries of a call after a 429
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")                    # if set, /metrics needs ?token= or a Bearer header
+NODE_LISTEN = os.environ.get("NODE_LISTEN")                        # host:port agents connect to, e.g. 0.0.0.0:9191
+NODE_TOKEN = os.environ.get("NODE_TOKEN")                          # shared secret of the hub and its agents
+NODE_PING_INTERVAL = float(os.environ.get("NODE_PING_INTERVAL", 20))  # agents silent for 3 intervals are dropped
+TERM_SESSION_TTL = int(os.environ.get("TERM_SESSION_TTL", 3600))   # browser terminal links, renewed while in use
+TERM_BATCH_DELAY = float(os.environ.get("TERM_BATCH_DELAY", 0.005))  # output coalesced this long into one WebSocket frame
+TERM_BUFFER_MAX = int(os.environ.get("TERM_BUFFER_MAX", 1024 * 1024))  # unsent output per browser, oldest dropped
+TERM_REPLAY_BYTES = int(os.environ.get("TERM_REPLAY_BYTES", 64 * 1024))  # recent output replayed on (re)attach
 
 # ===================== INITIALIZE BOT =====================
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
 bot = telebot.TeleBot(BOT_TOKEN)
 app = Flask(__name__)
+sock = Sock(app) if Sock else None
+
+# ===================== SESSION MANAGER =====================
+
+class ExpiringMap:
+    """
+    Dict-like table whose entries expire TTL seconds after they were
+    last set (or last read, if sliding) and which drops its least
+    recently used entries beyond max_size. Expiry is driven by the
+    SessionManager's sweeper; reads also ignore entries that are due.
+    on_evict(key, value) runs for expired and evicted entries, not for
+    pop() or del.
+    """
+
+    def __init__(self, manager, name, ttl, max_size=None, on_evict=None, sliding=False):
+        self.manager = manager
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.sliding = sliding
+        self.data = OrderedDict()   # key -> [value, expires], least recently used first
+        self.lock = threading.RLock()
+
+    def set(self, key, value, expires=None):
+        """Store value; expires is an absolute time.time(), default now + ttl."""
+        expires = time.time() + self.ttl if expires is None else expires
+        evicted = []
+        with self.lock:
+            self.data[key] = [value, expires]
+            self.data.move_to_end(key)
+            while self.max_size is not None and len(self.data) > self.max_size:
+                evicted.append(self.data.popitem(last=False))
+        self.manager.schedule(self, key, expires)
+        for old_key, (old_value, _) in evicted:
+            self._evicted(old_key, old_value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.time():
+                return default  # Due; the sweeper removes it
+            self.data.move_to_end(key)
+            if not self.sliding:
+                return entry[0]
+            expires = entry[1] = time.time() + self.ttl
+        self.manager.schedule(self, key, expires)  # Outside self.lock: compaction takes the locks the other way round
+        return entry[0]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1] <= time.time():
+                return default  # Due; the sweeper removes it and runs on_evict
+            del self.data[key]
+        return entry[0]
+
+    def expire(self, key, expires):
+        """Called by the sweeper; removes the entry if its deadline is still `expires`, returns True if it did."""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1] != expires:
+                return False  # Gone or renewed since this deadline was scheduled
+            del self.data[key]
+        self._evicted(key, entry[0])
+        return True
+
+    def _evicted(self, key, value):
+        if self.on_evict is not None:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f"⚠️ Evicting {self.name} entry failed: {e}")
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def __len__(self):
+        """Live entries; walks the table, for /status and /metrics."""
+        now = time.time()
+        with self.lock:
+            return sum(1 for _, expires in self.data.values() if expires > now)
+
+    def stored(self):
+        """Entries held, due ones included."""
+        with self.lock:
+            return len(self.data)
+
+    def deadlines(self):
+        """Snapshot of (key, expires) of every entry held."""
+        with self.lock:
+            return [(key, expires) for key, (_, expires) in self.data.items()]
+
+    def items(self):
+        """Snapshot of the live (key, value) pairs."""
+        now = time.time()
+        with self.lock:
+            return [(key, value) for key, (value, expires) in self.data.items() if expires > now]
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+class SessionManager:
+    """
+    Owns every ExpiringMap and runs one sweeper thread over a heap of
+    (deadline, map, key). Renewing an entry pushes a new deadline and
+    leaves the old one to be skipped when it comes up; the heap is
+    rebuilt from the live entries when stale deadlines pile up.
+    """
+
+    def __init__(self):
+        self.maps = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.expired = {}   # map name -> entries removed by the sweeper
+
+    def table(self, name, ttl, max_size=None, on_evict=None, sliding=False):
+        emap = self.maps[name] = ExpiringMap(self, name, ttl, max_size, on_evict, sliding)
+        return emap
+
+    def schedule(self, emap, key, expires):
+        with self.cond:
+            heapq.heappush(self.heap, (expires, next(self.seq), emap, key))
+            if len(self.heap) > 2 * sum(m.stored() for m in self.maps.values()) + 1024:
+                self._compact()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="session-sweeper", daemon=True)
+                self.thread.start()
+            if self.heap[0][0] == expires:
+                self.cond.notify()  # New earliest deadline
+
+    def _compact(self):
+        # Caller holds self.cond
+        self.heap = [(expires, next(self.seq), emap, key) for emap in self.maps.values()
+                     for key, expires in emap.deadlines()]
+        heapq.heapify(self.heap)
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                expires, _, emap, key = heapq.heappop(self.heap)
+            if emap.expire(key, expires):
+                self.expired[emap.name] = self.expired.get(emap.name, 0) + 1
+
+    def counts(self):
+        """Entries per table, for /status and /metrics."""
+        return {name: len(emap) for name, emap in self.maps.items()}
+
+sessions = SessionManager()
+
+# ===================== CHAT REGISTRY =====================
+
+class ChatState:
+    """Jobs of one (admin, chat) and which of them is in the foreground."""
+
+    __slots__ = ("jobs", "foreground")
+
+    def __init__(self):
+        self.jobs = {}          # job_id -> Job, running and queued
+        self.foreground = None  # job_id
+
+class _Shard:
+    __slots__ = ("lock", "chats", "version")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats = {}     # (admin_id, chat_id) -> ChatState
+        self.version = 0    # bumped by every change, invalidates the snapshot
+
+class ChatRegistry:
+    """
+    Jobs, foreground job and input prompt of every chat, split over
+    shards by (admin, chat) so handlers, PTY callbacks and Flask threads
+    working on different chats never wait for each other. Every method
+    is atomic within its chat. snapshot() gives a read-only view of all
+    chats that is rebuilt only after something changed.
+    """
+
+    def __init__(self, shards):
+        self.shards = [_Shard() for _ in range(shards)]
+        self._snapshot = (None, {})
+
+    def _shard(self, admin_id, chat_id):
+        return self.shards[hash((admin_id, chat_id)) % len(self.shards)]
+
+    def add_job(self, admin_id, chat_id, job):
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            shard.chats.setdefault((admin_id, chat_id), ChatState()).jobs[job.job_id] = job
+            shard.version += 1
+
+    def remove_job(self, admin_id, chat_id, job):
+        """Forget a finished job, its foreground slot and its prompt; True if the chat has no jobs left."""
+        key = (admin_id, chat_id)
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get(key)
+            if state is None:
+                return True
+            state.jobs.pop(job.job_id, None)
+            if state.foreground == job.job_id:
+                state.foreground = None
+            if input_wait.get(key) is job:
+                input_wait.pop(key)
+            if not state.jobs:
+                del shard.chats[key]
+            shard.version += 1
+            return not state.jobs
+
+    def jobs(self, admin_id, chat_id):
+        """Copy of the chat's jobs, keyed by job ID."""
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get((admin_id, chat_id))
+            return dict(state.jobs) if state else {}
+
+    def job(self, admin_id, chat_id, job_id):
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get((admin_id, chat_id))
+            return state.jobs.get(job_id) if state else None
+
+    def foreground(self, admin_id, chat_id):
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get((admin_id, chat_id))
+            return state.jobs.get(state.foreground) if state else None
+
+    def set_foreground(self, admin_id, chat_id, job):
+        """Make job (or nobody, for None) the foreground job; returns the previous one."""
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get((admin_id, chat_id))
+            if state is None:
+                return None
+            previous = state.jobs.get(state.foreground)
+            state.foreground = job.job_id if job is not None and job.job_id in state.jobs else None
+            shard.version += 1
+            return previous
+
+    def wait_input(self, admin_id, chat_id, job):
+        """Mark job as waiting at a prompt if it is still the foreground job."""
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get((admin_id, chat_id))
+            if state is None or state.foreground != job.job_id:
+                return False
+            input_wait[(admin_id, chat_id)] = job
+            return True
+
+    def claim_input(self, admin_id, chat_id):
+        """The job a plain chat message goes to: the attached foreground job, else one waiting at a prompt."""
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            state = shard.chats.get((admin_id, chat_id))
+            job = state.jobs.get(state.foreground) if state else None
+            if job is None or not job.input_attached:
+                job = input_wait.pop((admin_id, chat_id))
+            return job
+
+    def drop_input(self, admin_id, chat_id):
+        shard = self._shard(admin_id, chat_id)
+        with shard.lock:
+            input_wait.pop((admin_id, chat_id))
+
+    def snapshot(self):
+        """
+        {(admin_id, chat_id): (jobs tuple, foreground job_id)} of every
+        chat with jobs. Shared between callers, do not modify.
+        """
+        versions, chats = self._snapshot
+        if versions == tuple(shard.version for shard in self.shards):
+            return chats
+        versions, chats = [], {}
+        for shard in self.shards:
+            with shard.lock:
+                versions.append(shard.version)
+                for key, state in shard.chats.items():
+                    chats[key] = (tuple(state.jobs.values()), state.foreground)
+        self._snapshot = (tuple(versions), chats)
+        return chats
+
+    def admin_jobs(self, admin_id):
+        """All jobs of an admin's chats, from the snapshot."""
+        return [job for (admin, _), (jobs, _) in self.snapshot().items() if admin == admin_id for job in jobs]
+
+registry = ChatRegistry(REGISTRY_SHARDS)
 
 # ===================== ADMIN-WISE DATA =====================
-edit_sessions = {}       # admin_id -> {sid -> file}
-processes = {}           # admin_id -> {chat_id -> (pid, fd, start_time, cmd)}
-input_wait = {}          # admin_id -> {chat_id -> fd}
-active_sessions = {}     # admin_id -> {chat_id -> last_activity}
+edit_sessions = sessions.table(      # sid -> {"file", "admin_id", "expires"}
+    "edit", EDIT_SESSION_TTL, EDIT_SESSION_MAX, on_evict=lambda sid, _: store.drop_edit_session(sid))
+input_wait = sessions.table("prompt", PROMPT_TTL)    # (admin_id, chat_id) -> Job waiting at a prompt
+active_sessions = sessions.table(    # (admin_id, chat_id) -> last_activity
+    "chat", SESSION_TTL, SESSION_MAX, on_evict=lambda key, _: store.drop_chat_session(*key))
+next_steps = sessions.table("step", PROMPT_TTL)      # chat_id -> function receiving the chat's next plain message
+uploads = sessions.table("upload", PROMPT_TTL)       # chat_id -> (destination, expected sha256) for the next document
+term_sessions = sessions.table(      # sid -> {"admin_id", "chat_id", "job_id"}
+    "term", TERM_SESSION_TTL, sliding=True)
 admins = set()           # Set of admin IDs (ye same rahega)
 
-# ===================== HELPER =====================
-def get_admin_dict(admin_id, dict_obj):
+# ===================== HELPER =====================
+def get_admin_dict(admin_id, dict_obj):
+    """
+    Returns the dictionary for a specific admin.
+    If it doesn't exist, initialize it.
+    """
+    if admin_id not in dict_obj:
+        dict_obj[admin_id] = {}
+    return dict_obj[admin_id]
+
+# ===================== PERSISTENT STATE =====================
+
+class StateStore:
+    """
+    SQLite database (WAL mode) holding admins, editor sessions, job
+    history, chat sessions and per-chat preferences. Writes are queued
+    and committed by a background thread in one transaction every
+    DB_FLUSH_INTERVAL; several writes to the same row within a batch
+    collapse into the last one. Reads go straight to the database.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY, added_at REAL);
+        CREATE TABLE IF NOT EXISTS edit_sessions (
+            sid TEXT PRIMARY KEY, file TEXT, admin_id INTEGER, expires REAL);
+        CREATE INDEX IF NOT EXISTS edit_sessions_expires ON edit_sessions (expires);
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY, chat_id INTEGER, admin_id INTEGER, owner INTEGER, cmd TEXT,
+            priority INTEGER, status TEXT, exit_code INTEGER, queued_at REAL, started REAL, ended REAL, node TEXT,
+            usage TEXT);
+        CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id, job_id);
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            admin_id INTEGER, chat_id INTEGER, last_active REAL, PRIMARY KEY (admin_id, chat_id));
+        CREATE TABLE IF NOT EXISTS chat_prefs (
+            chat_id INTEGER, key TEXT, value TEXT, PRIMARY KEY (chat_id, key));
+        CREATE TABLE IF NOT EXISTS outputs (
+            job_id INTEGER PRIMARY KEY, chat_id INTEGER, segment INTEGER, offset INTEGER, length INTEGER,
+            size INTEGER, ended REAL, bloom BLOB);
+        CREATE INDEX IF NOT EXISTS outputs_chat ON outputs (chat_id, ended);
+        CREATE INDEX IF NOT EXISTS outputs_segment ON outputs (segment);
+    """
+    VERSION = 4
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()          # one connection, used by one thread at a time
+        self.cond = threading.Condition()
+        self.pending = {}                     # row key -> (sql, params), in arrival order
+        self.prefs = {}                       # (chat_id, key) -> value
+        self.thread = None
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent, fsync per checkpoint
+            self.conn.executescript(self.SCHEMA)
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                self._import_json()
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            if "node" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN node TEXT")  # Added in version 3
+            if "usage" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN usage TEXT")  # Added in version 4
+            self.conn.execute(f"PRAGMA user_version={self.VERSION}")
+            self.prefs = {(chat_id, key): json.loads(value) for chat_id, key, value
+                          in self.conn.execute("SELECT chat_id, key, value FROM chat_prefs")}
+        atexit.register(self.flush)
+
+    def _import_json(self):
+        """One-time migration of the old bot_data.json (caller holds self.lock)."""
+        if not os.path.exists(DATA_FILE):
+            return
+        try:
+            with open(DATA_FILE, 'r') as f:
+                data = json.load(f)
+            self.conn.executemany("INSERT OR IGNORE INTO admins VALUES (?, ?)",
+                                  [(int(a), time.time()) for a in data.get('admins', [])])
+            print(f"📦 Imported {len(data.get('admins', []))} admins from {DATA_FILE}")
+        except Exception as e:
+            print(f"⚠️ Import of {DATA_FILE} failed: {e}")
+
+    # ---------- Batched writes ----------
+
+    def write(self, key, sql, params):
+        """Queue a write; a later write with the same key replaces it."""
+        with self.cond:
+            self.pending.pop(key, None)  # Keep arrival order of the latest write
+            self.pending[key] = (sql, params)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="state-store", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(DB_FLUSH_INTERVAL)  # Let the batch fill up
+            self.flush()
+
+    def flush(self):
+        """Commit every queued write now."""
+        with self.cond:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                for sql, params in batch.values():
+                    self.conn.execute(sql, params)  # Statements are prepared once and cached by sqlite3
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self.conn.execute("ROLLBACK")
+                print(f"⚠️ State write failed: {e}")
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # ---------- Admins ----------
+
+    def load_admins(self):
+        return {row[0] for row in self.query("SELECT user_id FROM admins")}
+
+    def set_admin(self, user_id, is_admin):
+        if is_admin:
+            self.write(("admin", user_id), "INSERT OR REPLACE INTO admins VALUES (?, ?)", (user_id, time.time()))
+        else:
+            self.write(("admin", user_id), "DELETE FROM admins WHERE user_id = ?", (user_id,))
+
+    # ---------- Editor sessions ----------
+
+    def load_edit_sessions(self):
+        self.write(("edit_sessions", "expired"), "DELETE FROM edit_sessions WHERE expires < ?", (time.time(),))
+        return {sid: {"file": file, "admin_id": admin_id, "expires": expires} for sid, file, admin_id, expires
+                in self.query("SELECT sid, file, admin_id, expires FROM edit_sessions WHERE expires >= ?",
+                              (time.time(),))}
+
+    def save_edit_session(self, sid, session):
+        self.write(("edit_session", sid), "INSERT OR REPLACE INTO edit_sessions VALUES (?, ?, ?, ?)",
+                   (sid, session["file"], session["admin_id"], session["expires"]))
+
+    def drop_edit_session(self, sid):
+        self.write(("edit_session", sid), "DELETE FROM edit_sessions WHERE sid = ?", (sid,))
+
+    # ---------- Jobs ----------
+
+    def save_job(self, job):
+        self.write(("job", job.job_id), "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (job.job_id, job.chat_id, job.admin_id, job.owner, job.cmd, job.priority, job.status,
+                    job.exit_code, job.queued_at, job.started, job.ended, job.node,
+                    json.dumps(job.usage) if job.usage else None))
+
+    def load_jobs(self, limit):
+        """Jobs unfinished at the last shutdown become "lost"; returns the newest `limit` rows, oldest first."""
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'lost', ended = COALESCE(ended, started, queued_at) "
+                              "WHERE status IN ('queued', 'running', 'stopping')")
+            self.conn.execute("DELETE FROM jobs WHERE job_id <= (SELECT job_id FROM jobs ORDER BY job_id DESC "
+                              "LIMIT 1 OFFSET ?)", (JOB_HISTORY_KEEP,))
+            rows = self.conn.execute("SELECT * FROM jobs ORDER BY job_id DESC LIMIT ?", (limit,)).fetchall()
+            last = self.conn.execute("SELECT MAX(job_id) FROM jobs").fetchone()[0]
+        return rows[::-1], last or 0
+
+    # ---------- Chat sessions ----------
+
+    def load_chat_sessions(self):
+        return {(admin_id, chat_id): last_active
+                for admin_id, chat_id, last_active in self.query("SELECT * FROM chat_sessions")}
+
+    def touch_chat_session(self, admin_id, chat_id, last_active):
+        self.write(("chat_session", admin_id, chat_id), "INSERT OR REPLACE INTO chat_sessions VALUES (?, ?, ?)",
+                   (admin_id, chat_id, last_active))
+
+    def drop_chat_session(self, admin_id, chat_id):
+        self.write(("chat_session", admin_id, chat_id),
+                   "DELETE FROM chat_sessions WHERE admin_id = ? AND chat_id = ?", (admin_id, chat_id))
+
+    # ---------- Chat preferences ----------
+
+    def get_pref(self, chat_id, key, default=None):
+        return self.prefs.get((chat_id, key), default)
+
+    def set_pref(self, chat_id, key, value):
+        self.prefs[(chat_id, key)] = value
+        self.write(("pref", chat_id, key), "INSERT OR REPLACE INTO chat_prefs VALUES (?, ?, ?)",
+                   (chat_id, key, json.dumps(value)))
+
+def touch_session(admin_id, chat_id):
+    now = time.time()
+    active_sessions[(admin_id, chat_id)] = now
+    store.touch_chat_session(admin_id, chat_id, now)
+
+def drop_session(admin_id, chat_id):
+    if active_sessions.pop((admin_id, chat_id)) is not None:
+        store.drop_chat_session(admin_id, chat_id)
+
+def new_edit_session(path, admin_id):
+    """Create an editor session for path; returns its id."""
+    sid = str(uuid.uuid4())
+    session = {"file": path, "admin_id": admin_id, "expires": time.time() + EDIT_SESSION_TTL}
+    edit_sessions.set(sid, session, session["expires"])
+    store.save_edit_session(sid, session)
+    return sid
+
+# ===================== INITIAL LOAD =====================
+store = StateStore(DB_FILE)
+admins = store.load_admins() | {MAIN_ADMIN_ID}  # Main admin is always included
+for sid, session in store.load_edit_sessions().items():
+    edit_sessions.set(sid, session, session["expires"])
+for key, last_active in store.load_chat_sessions().items():
+    active_sessions.set(key, last_active, last_active + SESSION_TTL)  # Long idle ones expire right away
+
+# ================= METRICS =================
+
+class Metric:
+    """
+    Base of the in-process metrics: one value per label tuple, guarded by
+    a lock. Updating is a dict lookup and an add, cheap enough to leave on.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _series(self, key, suffix="", extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return self.name + suffix
+        inner = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+        return f"{self.name}{suffix}{{{inner}}}"
+
+    def collect(self):
+        """Current (key, value) pairs."""
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self._series(key)} {value}" for key, value in self.collect()]
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """A gauge read from `fn` at scrape time, so the hot path pays nothing.
+    `fn` returns a number, or {label tuple: number} for labelled gauges."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def collect(self):
+        value = self.fn()
+        return list(value.items()) if isinstance(value, dict) else [((), value)]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), then sum
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self._series(key, '_bucket', [('le', bound)])} {cumulative}")
+            lines.append(f"{self._series(key, '_sum')} {total}")
+            lines.append(f"{self._series(key, '_count')} {cumulative}")
+        return lines
+
+metrics_registry = []
+
+def timed_handler(function):
+    """Wrap a telebot handler to record how long it runs and whether it raised."""
+    name = function.__name__
+
+    def handler(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+    handler.__name__ = name
+    handler.__dict__.update(function.__dict__)   # Keeps the @offload mark
+    return handler
+
+def instrument_handlers():
+    """Time every registered message and callback handler (call once, before polling)."""
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for entry in handlers:
+            entry["function"] = timed_handler(entry["function"])
+
+def count_open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+TG_API_SECONDS = Histogram("termux_telegram_api_seconds", "Bot API call latency", ("method",))
+TG_API_ERRORS = Counter("termux_telegram_api_errors_total", "Failed Bot API calls (429 = rate limited)", ("method", "code"))
+PTY_BYTES = Counter("termux_pty_read_bytes_total", "Bytes read from job PTYs")
+CONSOLE_UPDATES = Counter("termux_console_updates_total", "Console messages sent or edited for job output", ("kind",))
+JOB_FIRST_OUTPUT = Histogram("termux_job_first_output_seconds", "Job start to first PTY output")
+JOB_OUTPUT_BYTES = Histogram("termux_job_output_bytes", "PTY bytes read per finished job",
+                             buckets=(1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+JOB_MESSAGES = Histogram("termux_job_console_updates", "Console messages sent or edited per finished job",
+                         buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+JOBS_STARTED = Counter("termux_jobs_started_total", "Jobs started")
+JOB_CPU_SECONDS = Histogram("termux_job_cpu_seconds", "User + system CPU time per finished job",
+                            buckets=(0.01, 0.1, 0.5, 1, 5, 30, 120, 600))
+JOB_MAX_RSS = Histogram("termux_job_max_rss_bytes", "Peak resident memory per finished job",
+                        buckets=(1e6, 4e6, 16e6, 64e6, 256e6, 1e9))
+HANDLER_SECONDS = Histogram("termux_handler_seconds", "Telebot handler execution time", ("handler",))
+HANDLER_ERRORS = Counter("termux_handler_errors_total", "Telebot handlers that raised", ("handler",))
+NODE_LINK_BYTES = Counter("termux_node_link_bytes_total", "Compressed job output received from agents", ("node",))
+QUICK_REQUESTS = Counter("termux_quick_requests_total", "Quick command requests by how they were served", ("result",))
+Gauge("termux_jobs", "Jobs by state",
+      lambda: {("running",): len(supervisor.running), ("queued",): len(supervisor.queue)}, ("state",))
+Gauge("termux_job_pty_bytes", "PTY bytes read so far by each running job",
+      lambda: {(job.job_id,): job.bytes_read for job in list(supervisor.running.values())}, ("job",))
+Gauge("termux_job_updates", "Console messages sent or edited so far by each running job",
+      lambda: {(job.job_id,): job.console.updates for job in list(supervisor.running.values()) if job.console}, ("job",))
+Gauge("termux_sessions", "Chats with recent shell activity", lambda: len(active_sessions))
+Gauge("termux_edit_sessions", "Open browser editor sessions", lambda: len(edit_sessions))
+Gauge("termux_session_entries", "Entries in each expiring session table",
+      lambda: {(name,): n for name, n in sessions.counts().items()}, ("table",))
+Gauge("termux_session_expired", "Session table entries removed on expiry since start",
+      lambda: {(name,): n for name, n in sessions.expired.items()}, ("table",))
+Gauge("termux_outbox_depth", "Bot API calls waiting in the send queue", lambda: outbox.depth)
+Gauge("termux_outbox_calls", "Send queue totals by outcome",
+      lambda: {(k,): v for k, v in outbox.stats.items()}, ("outcome",))
+Gauge("termux_nodes", "Connected agent nodes", lambda: len(node_hub.nodes))
+Gauge("termux_job_cpu_percent", "CPU% of each running local job's process tree at the last sample",
+      lambda: {(job_id,): round(cpu or 0, 1) for job_id, (cpu, _, _) in sampler.latest()["jobs"].items()}, ("job",))
+Gauge("termux_job_rss_bytes", "Resident memory of each running local job's process tree at the last sample",
+      lambda: {(job_id,): rss for job_id, (_, rss, _) in sampler.latest()["jobs"].items()}, ("job",))
+Gauge("termux_open_fds", "Open file descriptors", count_open_fds)
+Gauge("termux_threads", "Live threads", threading.active_count)
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        token = request.args.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(token, METRICS_TOKEN):
+            return "Forbidden", 403
+    lines = []
+    for metric in metrics_registry:
+        lines += metric.render()
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+# ================= OUTBOUND SEND QUEUE =================
+
+PRIO_INTERACTIVE = 0   # replies, prompts, callback answers
+PRIO_BULK = 1          # job output and other background traffic
+
+class OutboxDropped(Exception):
+    """Raised on the future of a call dropped because the send queue overflowed."""
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Honour a retry_after from Telegram."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class _Outgoing:
+    __slots__ = ("seq", "method", "chat_id", "args", "kwargs", "priority", "merge", "futures", "retries")
+
+    def __init__(self, seq, method, chat_id, args, kwargs, priority, merge):
+        self.seq = seq
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.merge = merge
+        self.futures = [Future()]
+        self.retries = 0
+
+class TelegramOutbox:
+    """
+    Every outgoing Bot API call goes through here. Calls are queued per
+    chat and priority, paced by a global token bucket plus one bucket per
+    chat, and executed by a small worker pool with at most one request in
+    flight per chat so ordering is kept. A 429 blocks the bucket for
+    retry_after and requeues the call. When a chat falls behind, queued
+    edits of the same message collapse into one and mergeable messages
+    are concatenated. Methods return a Future with the API result.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = {}          # chat_id -> (interactive deque, bulk deque)
+        self.buckets = {}         # chat_id -> TokenBucket
+        self.busy = set()         # chats with a request in flight
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.seq = itertools.count()
+        self.depth = 0
+        self.stats = {"sent": 0, "merged": 0, "dropped": 0, "retried": 0, "failed": 0}
+        self.pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="tg-send")
+        self.thread = None
+
+    # ---------- Bot API methods ----------
+
+    def send_message(self, chat_id, text, priority=PRIO_INTERACTIVE, merge=False, **kwargs):
+        return self._submit("send_message", chat_id, (chat_id, text), kwargs, priority, merge)
+
+    def edit_message_text(self, text, chat_id, message_id, priority=PRIO_BULK, **kwargs):
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self._submit("edit_message_text", chat_id, (text,), kwargs, priority)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        return self._submit("answer_callback_query", None, (callback_query_id, text), kwargs, PRIO_INTERACTIVE)
+
+    def send_document(self, chat_id, document, priority=PRIO_BULK, **kwargs):
+        return self._submit("send_document", chat_id, (chat_id, document), kwargs, priority)
+
+    # ---------- Queueing ----------
+
+    def _submit(self, method, chat_id, args, kwargs, priority, merge=False):
+        item = _Outgoing(next(self.seq), method, chat_id, args, kwargs, priority, merge)
+        future = item.futures[0]
+        with self.cond:
+            if self._merge(item):
+                self.stats["merged"] += 1
+                return future
+            queues = self.queues.setdefault(chat_id, (deque(), deque()))
+            queues[priority].append(item)
+            self.depth += 1
+            if self.depth > SEND_QUEUE_MAX:
+                self._drop_one()
+            self._kick()
+        return future
+
+    def _kick(self):
+        """Called with self.cond held whenever there may be work to dispatch."""
+        self.cond.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="tg-outbox", daemon=True)
+            self.thread.start()
+
+    def _merge(self, item):
+        queues = self.queues.get(item.chat_id)
+        if not queues:
+            return False
+        if item.method == "edit_message_text":
+            # A newer edit of the same message supersedes a queued one
+            for queue in queues:
+                for queued in queue:
+                    if queued.method == item.method and queued.kwargs.get("message_id") == item.kwargs["message_id"]:
+                        queued.args, queued.kwargs = item.args, item.kwargs
+                        queued.futures.extend(item.futures)
+                        return True
+            return False
+        queue = queues[item.priority]
+        if item.merge and queue:
+            last = queue[-1]
+            text = f"{last.args[1]}\n{item.args[1]}"
+            if last.merge and last.kwargs == item.kwargs and len(text) <= CONSOLE_LIMIT:
+                last.args = (item.chat_id, text)
+                last.futures.extend(item.futures)
+                return True
+        return False
+
+    def _drop_one(self):
+        """Drop the oldest bulk call, or the oldest call if nothing is bulk."""
+        victim = None
+        for priority in (PRIO_BULK, PRIO_INTERACTIVE):
+            for queues in self.queues.values():
+                if queues[priority] and (victim is None or queues[priority][0].seq < victim.seq):
+                    victim = queues[priority][0]
+            if victim is not None:
+                break
+        if victim is None:
+            return  # Nothing queued that could go
+        self.queues[victim.chat_id][victim.priority].popleft()
+        self.depth -= 1
+        self.stats["dropped"] += 1
+        for future in victim.futures:
+            future.set_exception(OutboxDropped(f"{victim.method} to {victim.chat_id} dropped"))
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            rate = TG_GROUP_RATE if isinstance(chat_id, int) and chat_id < 0 else TG_CHAT_RATE
+            bucket = self.buckets[chat_id] = TokenBucket(rate, TG_CHAT_BURST)
+        return bucket
+
+    def _next_ready(self):
+        """Pick the next call allowed to go out, or return how long to wait."""
+        if not self.depth:
+            return None, None
+        now = time.monotonic()
+        wait = self.global_bucket.wait_time(now)
+        if wait:
+            return None, wait
+        wait = None  # Nothing ready: sleep until a bucket refills or a chat frees up
+        for priority in (PRIO_INTERACTIVE, PRIO_BULK):
+            for chat_id, queues in self.queues.items():
+                if not queues[priority] or chat_id in self.busy:
+                    continue
+                if chat_id is not None:
+                    chat_wait = self._bucket(chat_id).wait_time(now)
+                    if chat_wait:
+                        wait = chat_wait if wait is None else min(wait, chat_wait)
+                        continue
+                    self._bucket(chat_id).take()
+                    self.busy.add(chat_id)
+                self.global_bucket.take()
+                item = queues[priority].popleft()
+                # Rotate the chat to the back so busy chats can't starve others
+                del self.queues[chat_id]
+                if queues[0] or queues[1]:
+                    self.queues[chat_id] = queues
+                self.depth -= 1
+                return item, None
+        return None, wait
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                item, wait = self._next_ready()
+                if item is None:
+                    self.cond.wait(wait)
+                    continue
+            self.pool.submit(self._perform, item)
+
+    def _perform(self, item):
+        start = time.perf_counter()
+        try:
+            result = getattr(bot, item.method)(*item.args, **item.kwargs)
+        except Exception as e:
+            TG_API_SECONDS.observe(time.perf_counter() - start, item.method)
+            self._failed(item, e)
+        else:
+            TG_API_SECONDS.observe(time.perf_counter() - start, item.method)
+            self._finish(item, result, None)
+
+    def _failed(self, item, error):
+        # Duck-typed so the asyncio runtime's ApiTelegramException works too
+        code = getattr(error, "error_code", None)
+        TG_API_ERRORS.inc(item.method, code or "network")
+        if code == 429 and item.retries < SEND_MAX_RETRIES:
+            retry_after = (error.result_json or {}).get("parameters", {}).get("retry_after", 1)
+            self._requeue(item, retry_after)
+        elif "message is not modified" in str(getattr(error, "description", "")):
+            self._finish(item, None, None)
+        else:
+            self._finish(item, None, error)
+
+    def _requeue(self, item, retry_after):
+        with self.cond:
+            bucket = self.global_bucket if item.chat_id is None else self._bucket(item.chat_id)
+            bucket.block(retry_after)
+            item.retries += 1
+            for arg in item.args:
+                if hasattr(arg, "seek"):
+                    arg.seek(0)  # Uploads are read again on retry
+            self.queues.setdefault(item.chat_id, (deque(), deque()))[item.priority].appendleft(item)
+            self.depth += 1
+            self.stats["retried"] += 1
+            self.busy.discard(item.chat_id)
+            self._kick()
+
+    def _finish(self, item, result, error):
+        with self.cond:
+            self.busy.discard(item.chat_id)
+            self.stats["failed" if error else "sent"] += 1
+            self._kick()
+        if error:
+            print(f"⚠️ {item.method} to {item.chat_id} failed: {error}")
+        for future in item.futures:
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+outbox = TelegramOutbox()
+
+# ================= PTY MULTIPLEXER =================
+
+class PtyMultiplexer:
+    """
+    Single I/O loop that owns the PTY master fds of every running command.
+    Readiness comes from selectors (epoll on Linux), process exit from EOF
+    on the master or a pidfd where the kernel supports it. The loop also
+    runs one-shot timers (call_later) so nothing has to poll.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = []            # (register|unregister, entry) applied by the loop
+        self.timers = []             # heap of (when, seq, callback)
+        self.seq = itertools.count()
+        self.thread = None
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="pty-mux", daemon=True)
+                self.thread.start()
+
+    def add(self, fd, pid, on_data, on_exit):
+        """Watch a PTY master; on_data(bytes) per chunk, on_exit() once the job is gone."""
+        os.set_blocking(fd, False)
+        entry = _PtyEntry(fd, pid, on_data, on_exit)
+        with self.lock:
+            self.pending.append(entry)
+        self.start()
+        self._wakeup()
+        return entry
+
+    def call_later(self, delay, callback):
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.seq), callback))
+        self.start()
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            pass  # Loop already has a wakeup queued
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                timeout = max(0, self.timers[0][0] - time.monotonic()) if self.timers else None
+            for entry in pending:
+                self._register(entry)
+
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while os.read(self.wake_r, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                entry, is_pidfd = key.data
+                if entry.closed:
+                    continue
+                if is_pidfd:
+                    self._pidfd_ready(entry)
+                else:
+                    self._read(entry)
+
+            self._run_timers()
+
+    def _register(self, entry):
+        self.selector.register(entry.fd, selectors.EVENT_READ, (entry, False))
+        if hasattr(os, "pidfd_open"):
+            try:
+                entry.pidfd = os.pidfd_open(entry.pid)
+                self.selector.register(entry.pidfd, selectors.EVENT_READ, (entry, True))
+            except OSError:
+                entry.pidfd = None  # Old kernel, rely on EOF
+
+    def _unwatch(self, fd):
+        self.selector.unregister(fd)
+
+    def _pidfd_ready(self, entry):
+        # Child exited: drain what is left in the PTY, then finish
+        while not entry.closed and self._read(entry):
+            pass
+        self._finish(entry)
+
+    def _read(self, entry):
+        try:
+            data = os.read(entry.fd, 65536)
+        except BlockingIOError:
+            return False
+        except OSError:
+            data = b""  # EIO: slave side closed
+        if not data:
+            self._finish(entry)
+            return False
+        try:
+            entry.on_data(data)
+        except Exception as e:
+            print(f"⚠️ Output handler error: {e}")
+        return True
+
+    def _finish(self, entry):
+        if entry.closed:
+            return
+        entry.closed = True
+        self._unwatch(entry.fd)
+        if entry.pidfd is not None:
+            self._unwatch(entry.pidfd)
+            os.close(entry.pidfd)
+        try:
+            entry.on_exit()
+        except Exception as e:
+            print(f"⚠️ Exit handler error: {e}")
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+        for callback in due:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Timer error: {e}")
+
+class _PtyEntry:
+    __slots__ = ("fd", "pid", "pidfd", "on_data", "on_exit", "closed")
+
+    def __init__(self, fd, pid, on_data, on_exit):
+        self.fd = fd
+        self.pid = pid
+        self.pidfd = None
+        self.on_data = on_data
+        self.on_exit = on_exit
+        self.closed = False
+
+pty_mux = PtyMultiplexer()
+
+# ================= OUTPUT SPILL LOGS =================
+
+class SpillLog:
+    """
+    Raw PTY output of one job, appended to a file on disk. Once the file
+    reaches SPILL_MAX_BYTES it wraps around like a ring buffer so the most
+    recent output is always kept and disk use stays bounded.
+    """
+
+    def __init__(self, log_id):
+        os.makedirs(SPILL_DIR, exist_ok=True)
+        self.log_id = log_id
+        self.path = os.path.join(SPILL_DIR, f"{log_id}.log")
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.pos = 0           # next write offset
+        self.size = 0          # bytes currently stored
+        self.total = 0         # bytes ever written
+        self.wrapped = False
+        self.holds = 1         # the running job; users of the file add one, see hold()
+        self.removed = False
+        self.lock = threading.RLock()   # Reentrant: run_cmd writes and snapshots watchers under it
+
+    def hold(self):
+        """Keep the file from being evicted until release(); False if it is already gone."""
+        with spill_lock:
+            if self.removed:
+                return False
+            self.holds += 1
+            return True
+
+    def release(self):
+        with spill_lock:
+            self.holds -= 1
+            prune_spill_logs()
+
+    def write(self, data):
+        with self.lock:
+            self.total += len(data)
+            if len(data) > SPILL_MAX_BYTES:
+                data = data[-SPILL_MAX_BYTES:]
+            while data:
+                n = min(len(data), SPILL_MAX_BYTES - self.pos)
+                os.pwrite(self.fd, data[:n], self.pos)
+                self.pos += n
+                self.size = max(self.size, self.pos)
+                data = data[n:]
+                if self.pos >= SPILL_MAX_BYTES:
+                    self.pos = 0
+                    self.wrapped = True
+
+    def chunks(self, chunk_size=65536):
+        """Yield the stored output oldest first."""
+        with self.lock:
+            ranges = [(self.pos, self.size), (0, self.pos)] if self.wrapped else [(0, self.size)]
+        for start, end in ranges:
+            while start < end:
+                data = os.pread(self.fd, min(chunk_size, end - start), start)
+                if not data:
+                    break
+                start += len(data)
+                yield data
+
+    def tail(self, n, locked=False):
+        """The newest n bytes of output; locked=True if the caller already holds self.lock."""
+        if not locked:
+            with self.lock:
+                return self.tail(n, locked=True)
+        data = os.pread(self.fd, min(n, self.pos), max(0, self.pos - n))
+        if self.wrapped and len(data) < n:
+            older = min(n - len(data), self.size - self.pos)
+            data = os.pread(self.fd, older, self.size - older) + data
+        return data
+
+    def gzip_copy(self):
+        """Compress the log into an anonymous temp file, one chunk at a time."""
+        tmp = tempfile.TemporaryFile(dir=SPILL_DIR)
+        with gzip.GzipFile(fileobj=tmp, mode="wb") as gz:
+            for data in self.chunks():
+                gz.write(data)
+        tmp.seek(0)
+        return tmp
+
+    def remove(self):
+        with self.lock:
+            self.removed = True
+            try:
+                os.close(self.fd)
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+spill_logs = OrderedDict()   # log_id -> SpillLog, oldest first
+spill_lock = threading.Lock()
+
+def new_spill_log():
+    """A log held by its job until the job calls release() after finishing."""
+    log = SpillLog(uuid.uuid4().hex[:8])
+    with spill_lock:
+        spill_logs[log.log_id] = log
+        prune_spill_logs()
+    return log
+
+def prune_spill_logs():
+    """Remove the oldest logs nobody holds beyond SPILL_KEEP; caller holds spill_lock."""
+    excess = len(spill_logs) - SPILL_KEEP
+    for log_id, log in list(spill_logs.items()):
+        if excess <= 0:
+            break
+        if log.holds == 0:
+            del spill_logs[log_id]
+            log.remove()
+            excess -= 1
+
+def send_spill_log(chat_id, log, name):
+    """Upload the full output of a job as a .log.gz document; None if the log was evicted meanwhile."""
+    if not log.hold():
+        return None
+    try:
+        doc = log.gzip_copy()
+    finally:
+        log.release()
+    caption = f"📦 Full output: {log.total} bytes"
+    if log.wrapped:
+        caption += f" (only the last {log.size} bytes kept)"
+    sent = outbox.send_document(chat_id, doc, caption=caption, visible_file_name=f"{name}.log.gz")
+    sent.add_done_callback(lambda _: doc.close())
+    return sent
+
+# ================= COMMAND HISTORY =================
+
+ANSI_ESCAPE = re.compile(rb"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\\\)|\x1b[()*+#%]?[@-~0-9]")
+
+class TrigramBloom:
+    """
+    Bloom filter over the lowercased byte trigrams of a text: a substring
+    query can only match if all its trigrams are (probably) present.
+    About 10 bits per distinct trigram, 3 hashes, ~2% false positives.
+    """
+
+    HASHES = 3
+
+    def __init__(self, bits):
+        self.bits = bits   # bytearray, length a power of two
+
+    @classmethod
+    def build(cls, data):
+        grams = {data[i:i + 3] for i in range(len(data) - 2)}
+        nbytes = 128
+        while nbytes * 8 < len(grams) * 10 and nbytes < 128 * 1024:
+            nbytes *= 2
+        bloom = cls(bytearray(nbytes))
+        for gram in grams:
+            for pos in bloom._positions(gram):
+                bloom.bits[pos >> 3] |= 1 << (pos & 7)
+        return bloom
+
+    def _positions(self, gram):
+        h = int.from_bytes(gram, "little")
+        h1 = (h * 0x9E3779B1) & 0xFFFFFFFF
+        h2 = ((h * 0x85EBCA77) >> 7 | 1) & 0xFFFFFFFF
+        mask = len(self.bits) * 8 - 1
+        return [(h1 + i * h2) & mask for i in range(self.HASHES)]
+
+    def may_contain(self, needle):
+        """needle: lowercased bytes. Always True for needles shorter than a trigram."""
+        for i in range(len(needle) - 2):
+            for pos in self._positions(needle[i:i + 3]):
+                if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                    return False
+        return True
+
+class HistoryLog:
+    """
+    Append-only log of finished jobs in numbered segment files under
+    HISTORY_DIR. Each record is self-describing: a JSON header (command,
+    admin, chat, timestamps, exit code) and the zlib-compressed tail of the
+    job's output with escape codes stripped. The `outputs` table of the
+    state store indexes records by job and chat and keeps a trigram Bloom
+    filter of each output, so /grep only decompresses records that can
+    match. Segments rotate at HISTORY_SEGMENT_BYTES and are deleted
+    oldest first beyond HISTORY_MAX_BYTES or HISTORY_MAX_AGE.
+    """
+
+    RECORD = struct.Struct("<4sII")   # magic, header length, body length
+    MAGIC = b"THR1"
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.dir = directory
+        self.lock = threading.Lock()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.dir) if name.endswith(".seg") and name[:-4].isdigit())
+
+    def _path(self, segment):
+        return os.path.join(self.dir, f"{segment:06d}.seg")
+
+    @staticmethod
+    def clean(data):
+        """Terminal output as plain lines: escape codes dropped, only the last of any \\r overwrites kept."""
+        data = ANSI_ESCAPE.sub(b"", data)
+        return b"\n".join(line.rstrip(b"\r").rsplit(b"\r", 1)[-1] for line in data.split(b"\n"))
+
+    def record(self, job, spill):
+        """Append a finished job in the background; the spill log is held until then."""
+        if spill.hold():
+            self.pool.submit(self._record_safe, job, spill)
+
+    def _record_safe(self, job, spill):
+        try:
+            self._record(job, spill)
+        except Exception as e:
+            print(f"⚠️ History record of job #{job.job_id} failed: {e}")
+        finally:
+            spill.release()
+
+    def _record(self, job, spill):
+        tail = bytearray()
+        for chunk in spill.chunks():
+            tail += chunk
+            if len(tail) > 2 * HISTORY_OUTPUT_MAX:
+                del tail[:-HISTORY_OUTPUT_MAX]
+        output = self.clean(bytes(tail[-HISTORY_OUTPUT_MAX:]))
+        header = json.dumps({
+            "job_id": job.job_id, "cmd": job.cmd, "admin_id": job.admin_id, "chat_id": job.chat_id,
+            "queued_at": job.queued_at, "started": job.started, "ended": job.ended,
+            "exit_code": job.exit_code, "status": job.status, "size": spill.total,
+        }).encode()
+        body = zlib.compress(output, 9)
+        bloom = TrigramBloom.build(output.lower())
+        record = self.RECORD.pack(self.MAGIC, len(header), len(body)) + header + body
+
+        with self.lock:
+            path = self._path(self.segment)
+            if os.path.exists(path) and os.path.getsize(path) + len(record) > HISTORY_SEGMENT_BYTES:
+                self.segment += 1
+                path = self._path(self.segment)
+                self._retain()
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            try:
+                offset = os.fstat(fd).st_size
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+        store.write(("output", job.job_id), "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job.job_id, job.chat_id, self.segment, offset, len(record), len(output), job.ended,
+                     bytes(bloom.bits)))
+
+    def _retain(self):
+        # Caller holds self.lock; the current segment is never removed
+        old = [seg for seg in self.segments() if seg < self.segment]
+        sizes = {seg: os.path.getsize(self._path(seg)) for seg in old}
+        total = sum(sizes.values())
+        for seg in old:
+            expired = os.path.getmtime(self._path(seg)) < time.time() - HISTORY_MAX_AGE
+            if total <= HISTORY_MAX_BYTES and not expired:
+                break
+            os.unlink(self._path(seg))
+            total -= sizes[seg]
+            store.write(("output_segment", seg), "DELETE FROM outputs WHERE segment = ?", (seg,))
+
+    def read(self, segment, offset, length):
+        """(header dict, output bytes) of the record at offset."""
+        with open(self._path(segment), "rb") as f:
+            raw = os.pread(f.fileno(), length, offset)
+        magic, hlen, blen = self.RECORD.unpack_from(raw)
+        if magic != self.MAGIC:
+            raise ValueError(f"bad history record at {segment}:{offset}")
+        start = self.RECORD.size
+        header = json.loads(raw[start:start + hlen])
+        return header, zlib.decompress(raw[start + hlen:start + hlen + blen])
+
+    def grep(self, chat_id, pattern, since=0, regex=False, limit=20):
+        """
+        Matching lines of past outputs in a chat, newest jobs first:
+        [(job_id, cmd, line)]. Plain patterns are case-insensitive
+        substrings and are prefiltered by the Bloom filters.
+        """
+        if regex:
+            matcher = re.compile(pattern.encode(), re.I).search
+            needle = b""
+        else:
+            needle = pattern.lower().encode()
+            matcher = lambda line: needle in line.lower()
+        rows = store.query("SELECT job_id, segment, offset, length, bloom FROM outputs "
+                           "WHERE chat_id = ? AND ended >= ? ORDER BY job_id DESC", (chat_id, since))
+        matches = []
+        for job_id, segment, offset, length, bits in rows:
+            if needle and not TrigramBloom(bits).may_contain(needle):
+                continue
+            try:
+                header, output = self.read(segment, offset, length)
+            except (OSError, ValueError, zlib.error):
+                continue  # Segment rotated away since the query
+            for line in output.split(b"\n"):
+                if matcher(line):
+                    matches.append((job_id, header["cmd"], line.decode("utf-8", errors="replace")))
+                    if len(matches) >= limit:
+                        return matches
+        return matches
+
+history_log = HistoryLog(HISTORY_DIR)
+
+# ================= TERMINAL SCREEN =================
+
+class Screen:
+    """
+    Small VT100/xterm emulator: PTY output is applied to a rows x cols
+    cell buffer, so carriage-return progress bars and full-screen
+    programs end up as a screen instead of a stream of escape codes.
+    Lines scrolling off the top of the main screen are finished output;
+    feed() hands them back so they can be posted as plain text.
+    Colors, attributes and wide characters are not modelled.
+    """
+
+    PRINTABLE = re.compile(r"[^\x00-\x1f\x7f]+")
+
+    def __init__(self, rows=CONSOLE_ROWS, cols=CONSOLE_COLS):
+        self.rows, self.cols = rows, cols
+        self.scrolled = []      # lines that left the main screen since the last feed()
+        self.state = "text"     # parser state: text, esc, csi, osc, osc_esc, charset
+        self.params = ""
+        self.reset()
+
+    def reset(self):
+        self.main = self._blank(self.rows)
+        self.lines = self.main  # self.alt while a full-screen program has switched over
+        self.x = self.y = 0
+        self.wrap_next = False  # cursor sits past the last column, wrap before the next char
+        self.top, self.bottom = 0, self.rows - 1   # scroll region
+        self.saved = (0, 0)
+
+    def _blank(self, n):
+        return [[" "] * self.cols for _ in range(n)]
+
+    def feed(self, text):
+        """Apply output; returns the lines scrolled off the main screen."""
+        i, n = 0, len(text)
+        while i < n:
+            state = self.state
+            if state == "text":
+                m = self.PRINTABLE.match(text, i)
+                if m:
+                    self._write(m.group())
+                    i = m.end()
+                    continue
+            ch = text[i]
+            i += 1
+            if state == "text":
+                if ch == "\x1b":
+                    self.state = "esc"
+                elif ch == "\r":
+                    self.x, self.wrap_next = 0, False
+                elif ch in "\n\x0b\x0c":
+                    self._linefeed()
+                elif ch == "\b":
+                    self.x, self.wrap_next = max(0, self.x - 1), False
+                elif ch == "\t":
+                    self.x = min(self.cols - 1, (self.x // 8 + 1) * 8)
+            elif state == "esc":
+                self._esc(ch)
+            elif state == "csi":
+                if "0" <= ch <= "?":
+                    self.params += ch
+                elif "@" <= ch <= "~":
+                    self.state = "text"
+                    self._csi(ch, self.params)
+                elif ch == "\x1b":
+                    self.state = "esc"
+                elif ch in "\x18\x1a":
+                    self.state = "text"   # CAN/SUB abort the sequence
+            elif state == "osc":
+                # Window titles and the like, up to BEL or ST (ESC \)
+                if ch == "\x07":
+                    self.state = "text"
+                elif ch == "\x1b":
+                    self.state = "osc_esc"
+            else:
+                # Final byte of ESC \ or of a charset designation
+                self.state = "text"
+        scrolled, self.scrolled = self.scrolled, []
+        return scrolled
+
+    def render(self):
+        """Screen content as text, without trailing blanks."""
+        rows = ["".join(line).rstrip() for line in self.lines]
+        while rows and not rows[-1]:
+            rows.pop()
+        return "\n".join(rows)
+
+    # ---------- Output ----------
+
+    def _write(self, s):
+        while s:
+            if self.wrap_next:
+                self.x, self.wrap_next = 0, False
+                self._linefeed()
+            part = s[:self.cols - self.x]
+            self.lines[self.y][self.x:self.x + len(part)] = part
+            self.x += len(part)
+            s = s[len(part):]
+            if self.x >= self.cols:
+                self.x, self.wrap_next = self.cols - 1, True
+
+    def _linefeed(self):
+        self.wrap_next = False
+        if self.y == self.bottom:
+            self._scroll_up(1)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _scroll_up(self, n):
+        for _ in range(min(n, self.bottom - self.top + 1)):
+            line = self.lines.pop(self.top)
+            if self.lines is self.main and self.top == 0:
+                self.scrolled.append("".join(line).rstrip())
+            self.lines.insert(self.bottom, [" "] * self.cols)
+
+    def _scroll_down(self, n):
+        for _ in range(min(n, self.bottom - self.top + 1)):
+            self.lines.pop(self.bottom)
+            self.lines.insert(self.top, [" "] * self.cols)
+
+    # ---------- Escape sequences ----------
+
+    def _esc(self, ch):
+        self.state = "text"
+        if ch == "[":
+            self.state, self.params = "csi", ""
+        elif ch == "]":
+            self.state = "osc"
+        elif ch in "()*+#%":
+            self.state = "charset"
+        elif ch == "7":
+            self.saved = (self.x, self.y)
+        elif ch == "8":
+            self.x, self.y = self.saved
+        elif ch == "D":
+            self._linefeed()
+        elif ch == "E":
+            self.x = 0
+            self._linefeed()
+        elif ch == "M":
+            # Reverse index
+            if self.y == self.top:
+                self._scroll_down(1)
+            elif self.y > 0:
+                self.y -= 1
+        elif ch == "c":
+            self.reset()
+
+    def _csi(self, final, params):
+        private = params[:1] in ("?", ">", "<", "=")
+        args = [int(p) if p.isdigit() else 0 for p in params.lstrip("?><=").split(";")]
+
+        def arg(i, default=1):
+            return (args[i] if i < len(args) else 0) or default
+
+        if final == "m":
+            return  # Colors and attributes are dropped
+        self.wrap_next = False
+        line = self.lines[self.y]
+        if final == "A":
+            self.y = max(0, self.y - arg(0))
+        elif final in "Be":
+            self.y = min(self.rows - 1, self.y + arg(0))
+        elif final in "Ca":
+            self.x = min(self.cols - 1, self.x + arg(0))
+        elif final == "D":
+            self.x = max(0, self.x - arg(0))
+        elif final == "E":
+            self.x, self.y = 0, min(self.rows - 1, self.y + arg(0))
+        elif final == "F":
+            self.x, self.y = 0, max(0, self.y - arg(0))
+        elif final in "G`":
+            self.x = min(self.cols, arg(0)) - 1
+        elif final == "d":
+            self.y = min(self.rows, arg(0)) - 1
+        elif final in "Hf":
+            self.y, self.x = min(self.rows, arg(0)) - 1, min(self.cols, arg(1)) - 1
+        elif final == "J":
+            mode = arg(0, 0)
+            if mode == 0:
+                line[self.x:] = [" "] * (self.cols - self.x)
+                self.lines[self.y + 1:] = self._blank(self.rows - self.y - 1)
+            elif mode == 1:
+                line[:self.x + 1] = [" "] * (self.x + 1)
+                self.lines[:self.y] = self._blank(self.y)
+            else:
+                self.lines[:] = self._blank(self.rows)
+        elif final == "K":
+            mode = arg(0, 0)
+            if mode == 0:
+                line[self.x:] = [" "] * (self.cols - self.x)
+            elif mode == 1:
+                line[:self.x + 1] = [" "] * (self.x + 1)
+            else:
+                line[:] = [" "] * self.cols
+        elif final == "@":
+            line[self.x:self.x] = [" "] * arg(0)
+            del line[self.cols:]
+        elif final == "P":
+            n = min(arg(0), self.cols - self.x)
+            del line[self.x:self.x + n]
+            line.extend([" "] * n)
+        elif final == "X":
+            n = min(arg(0), self.cols - self.x)
+            line[self.x:self.x + n] = [" "] * n
+        elif final in "LM" and self.top <= self.y <= self.bottom:
+            for _ in range(min(arg(0), self.bottom - self.y + 1)):
+                if final == "L":
+                    self.lines.pop(self.bottom)
+                    self.lines.insert(self.y, [" "] * self.cols)
+                else:
+                    self.lines.pop(self.y)
+                    self.lines.insert(self.bottom, [" "] * self.cols)
+        elif final == "S":
+            self._scroll_up(arg(0))
+        elif final == "T" and not private:
+            self._scroll_down(arg(0))
+        elif final == "r" and not private:
+            top, bottom = arg(0) - 1, min(self.rows, arg(1, self.rows)) - 1
+            self.top, self.bottom = (top, bottom) if top < bottom else (0, self.rows - 1)
+            self.x = self.y = 0
+        elif final == "s" and not private:
+            self.saved = (self.x, self.y)
+        elif final == "u" and not private:
+            self.x, self.y = self.saved
+        elif final in "hl" and private:
+            for mode in args:
+                if mode in (47, 1047, 1049):
+                    self._alternate(final == "h", save_cursor=mode == 1049)
+
+    def _alternate(self, on, save_cursor):
+        """Switch to or back from the alternate screen used by full-screen programs."""
+        if on and self.lines is self.main:
+            if save_cursor:
+                self.saved = (self.x, self.y)
+            self.lines = self._blank(self.rows)
+        elif not on and self.lines is not self.main:
+            self.lines = self.main
+            if save_cursor:
+                self.x, self.y = self.saved
+
+# ================= OUTPUT AGGREGATION =================
+
+class ConsoleStream:
+    """
+    Runs PTY output of one job through a Screen and mirrors it into a
+    single live "console" message that is edited in place: lines that
+    scrolled off the screen, followed by the current screen. The message
+    is only edited when that text changed, at most every
+    OUTPUT_FLUSH_INTERVAL or once OUTPUT_FLUSH_BYTES of scrolled lines are
+    waiting. A new message is started once the current one is full. After
+    CONSOLE_MAX_MESSAGES the last message only shows the live tail; the
+    full output lives in the job's spill log.
+    """
+
+    def __init__(self, chat_id, markup=None):
+        self.chat_id = chat_id
+        self.markup = markup     # buttons attached to every console message
+        self.screen = Screen()
+        self.message_id = None   # live console message being edited
+        self.messages = 0        # console messages started so far
+        self.text = ""           # scrolled lines shown in that message
+        self.shown = None        # last body sent, to skip edits that change nothing
+        self.pending = ""        # scrolled lines buffered since the last flush
+        self.changed = False     # screen changed since the last flush
+        self.truncated = False   # chat no longer shows all of the output
+        self.scheduled = False   # a timed flush is already queued
+        self.sending = False     # waiting for the id of a freshly sent message
+        self.muted = False       # background job: keep the tail, don't touch the chat
+        self.updates = 0         # messages sent or edited so far
+        self.on_truncated = None # set by finish(), called once output is drained
+        self.lock = threading.Lock()
+
+    def detach(self):
+        with self.lock:
+            self.muted = True
+
+    def attach(self):
+        """Resume live output in a fresh message, starting from the buffered tail."""
+        with self.lock:
+            self.muted = False
+            self.message_id = None
+            self.text = ""
+            self.shown = None
+            self.changed = True
+            self.messages = 0
+        self.flush()
+
+    def feed(self, out):
+        with self.lock:
+            scrolled = self.screen.feed(out)
+            if scrolled:
+                self.pending += "\n".join(scrolled) + "\n"
+            self.changed = True
+            if (self.muted or self.messages >= CONSOLE_MAX_MESSAGES) and len(self.pending) > CONSOLE_LIMIT:
+                # Only the tail will ever be shown, keep memory flat
+                self.pending = self.pending[-CONSOLE_LIMIT:]
+                self.truncated = True
+            full = len(self.pending) >= OUTPUT_FLUSH_BYTES
+            schedule = not full and not self.scheduled
+            self.scheduled = self.scheduled or schedule
+        if full:
+            self.flush()
+        elif schedule:
+            pty_mux.call_later(OUTPUT_FLUSH_INTERVAL, self.flush)
+
+    def finish(self, on_truncated):
+        """
+        No more output will come: flush it and, once everything has gone
+        out, call on_truncated if the chat did not get to see all of it.
+        """
+        with self.lock:
+            self.on_truncated = on_truncated
+        self.flush()
+
+    def flush(self):
+        sent = None
+        done = None
+        with self.lock:
+            self.scheduled = False
+            # While a new message is in flight we can't edit it yet; _on_sent flushes again
+            while (self.pending or self.changed) and not self.sending and not self.muted:
+                self.changed = False
+                screen = self.screen.render()[-(CONSOLE_LIMIT // 2):]
+                limit = CONSOLE_LIMIT - len(screen)   # room left for scrolled lines
+                room = limit - len(self.text)
+                if room < 0 or (room == 0 and self.pending):
+                    if self.messages < CONSOLE_MAX_MESSAGES:
+                        # Current message is full: it keeps its scrolled lines, the screen moves on
+                        if self.message_id is not None and self.text:
+                            self._count("edit")
+                            outbox.edit_message_text(f"```\n{self.text.rstrip()}\n```", self.chat_id, self.message_id,
+                                                     parse_mode="Markdown", reply_markup=self.markup)
+                        self.message_id = None
+                        self.text = ""
+                        self.shown = None
+                        room = limit
+                    else:
+                        # Out of messages: keep editing the last one with the tail
+                        self.text = (self.text + self.pending)[-limit:]
+                        self.pending = ""
+                        self.truncated = True
+                        room = 0
+                self.text += self.pending[:room]
+                self.pending = self.pending[room:]
+                content = (self.text + screen).rstrip("\n")
+                body = f"```\n{content}\n```"
+                if not content or body == self.shown:
+                    continue
+                self.shown = body
+                if self.message_id is None:
+                    self.sending = True
+                    self.messages += 1
+                    self._count("send")
+                    sent = outbox.send_message(self.chat_id, body, priority=PRIO_BULK,
+                                               parse_mode="Markdown", reply_markup=self.markup)
+                else:
+                    self._count("edit")
+                    outbox.edit_message_text(body, self.chat_id, self.message_id,
+                                             parse_mode="Markdown", reply_markup=self.markup)
+            if self.on_truncated and not (self.pending or self.sending or self.muted):
+                done, self.on_truncated = self.on_truncated, None
+                done = done if self.truncated else None
+        if sent is not None:
+            sent.add_done_callback(self._on_sent)
+        if done is not None:
+            done()
+
+    def _count(self, kind):
+        self.updates += 1
+        CONSOLE_UPDATES.inc(kind)
+
+    def _on_sent(self, future):
+        with self.lock:
+            self.sending = False
+            try:
+                self.message_id = future.result().message_id
+            except Exception:
+                # Message never arrived, start over with a fresh one
+                self.message_id = None
+                self.text = ""
+                self.shown = None
+                self.changed = True
+        if self.pending or self.changed:
+            self.flush()
+
+# ================= PROCESS SUPERVISOR =================
+
+class Job:
+    """A shell command running in its own PTY session and process group, here or on an agent node."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, cmd, admin_id, chat_id, owner=None, priority=JOB_DEFAULT_PRIORITY, job_id=None):
+        self.job_id = next(Job._ids) if job_id is None else job_id
+        self.cmd = cmd
+        self.admin_id = admin_id
+        self.chat_id = chat_id
+        self.owner = owner if owner is not None else chat_id   # user counted against MAX_JOBS_PER_ADMIN
+        self.priority = priority
+        self.node = None            # agent name, None = this host
+        self.limits = {}            # rlimits and niceness applied in the child, see effective_limits
+        self.usage = None           # rusage summary once reaped: user, sys, maxrss (KB), inblock, oublock
+        self.pid = None
+        self.fd = None
+        self.status = "queued"      # queued -> running -> (stopping) -> exited / killed / cancelled / failed / lost
+        self.queued_at = time.time()
+        self.started = None
+        self.ended = None
+        self.start_time = ""        # HH:MM:SS for display
+        self.exit_code = None       # negative: killed by that signal
+        self.on_start = None        # callbacks set by the runner
+        self.on_data = None
+        self.on_finish = None
+        self.on_end = []            # callbacks after on_finish, see Supervisor.when_done
+        self.console = None
+        self.bytes_read = 0         # PTY output so far
+        self.first_output = None    # when the first PTY output arrived
+        self.input_attached = False  # /fg: every chat message goes to this job's stdin
+        self.spill = None           # SpillLog of the output, set by run_cmd
+        self.watchers = []          # browser terminals: called with each output chunk, None at exit
+
+    @classmethod
+    def restore(cls, row):
+        """A finished job from a jobs table row of the state store."""
+        (job_id, chat_id, admin_id, owner, cmd, priority, status, exit_code, queued_at, started, ended,
+         node, usage) = row
+        job = cls(cmd, admin_id, chat_id, owner, priority, job_id)
+        job.node, job.status, job.exit_code = node, status, exit_code
+        job.usage = json.loads(usage) if usage else None
+        job.queued_at, job.started, job.ended = queued_at, started, ended
+        if started:
+            job.start_time = datetime.fromtimestamp(started).strftime("%H:%M:%S")
+        return job
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return 0.0
+        return (self.ended or time.time()) - self.started
+
+    def write_input(self, data):
+        """Send bytes to the job's terminal; raises OSError if it is gone."""
+        if self.node is None:
+            os.write(self.fd, data)
+        elif not node_hub.write(self, data):
+            raise OSError(f"node {self.node} is offline")
+
+    def resize(self, rows, cols):
+        """Change the terminal size the job sees; the kernel sends it SIGWINCH."""
+        if self.node is None:
+            fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+        else:
+            node_hub.resize(self, rows, cols)
+
+    def describe_usage(self):
+        """CPU time, peak memory and block I/O of a reaped job, "" if unknown."""
+        if not self.usage:
+            return ""
+        u = self.usage
+        text = f"cpu {u['user'] + u['sys']:.2f}s · {human_size(u['maxrss'] * 1024)}"
+        if u.get("inblock") or u.get("oublock"):
+            text += f" · io {u['inblock']}r/{u['oublock']}w"
+        return text
+
+    def describe_exit(self):
+        if self.exit_code is None:
+            return self.status
+        if self.exit_code < 0:
+            try:
+                return f"killed by {signal.Signals(-self.exit_code).name}"
+            except ValueError:
+                return f"killed by signal {-self.exit_code}"
+        return f"exit {self.exit_code}"
+
+class JobQueueFull(Exception):
+    """Raised by Supervisor.submit when JOB_QUEUE_MAX jobs are already waiting."""
+
+class Supervisor:
+    """
+    Schedules jobs under a global (MAX_JOBS) and per-admin
+    (MAX_JOBS_PER_ADMIN) concurrency limit; jobs that can't start yet wait
+    in a bounded run queue ordered by priority, then arrival. Running jobs
+    are reaped with waitpid, their exit status and duration recorded,
+    their PTY fds closed, and whole process groups are stopped with a
+    SIGTERM -> SIGKILL escalation that runs on the multiplexer's timers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}                          # job_id -> Job
+        self.queue = []                            # heap of (priority, job_id, Job)
+        self.history = deque(maxlen=JOB_HISTORY)   # finished jobs, newest last
+
+    def submit(self, job):
+        """Start the job or queue it; returns its queue position (0 = started)."""
+        with self.lock:
+            if self._can_start(job):
+                self.running[job.job_id] = job
+                position = 0
+            elif len(self.queue) >= JOB_QUEUE_MAX:
+                raise JobQueueFull(f"{len(self.queue)} jobs already waiting")
+            else:
+                heapq.heappush(self.queue, (job.priority, job.job_id, job))
+                position = sum(1 for entry in self.queue if entry[:2] <= (job.priority, job.job_id))
+        store.save_job(job)
+        if not position:
+            self._spawn(job)
+        return position
+
+    def _can_start(self, job):
+        # Limits are per node: jobs on an agent don't use this host's slots
+        on_node = [other for other in self.running.values() if other.node == job.node]
+        if len(on_node) >= MAX_JOBS:
+            return False
+        owned = sum(1 for other in on_node if other.owner == job.owner)
+        return owned < MAX_JOBS_PER_ADMIN
+
+    def queued(self):
+        with self.lock:
+            return [job for _, _, job in sorted(self.queue)]
+
+    def _spawn(self, job):
+        if job.node is not None:
+            # Started before RUN goes out: a fast job's EXIT can arrive on the link thread right after
+            self._started(job)
+            if not node_hub.spawn(job):
+                if job.ended is not None:
+                    return   # The link broke while sending and already reported the job lost
+                print(f"⚠️ Cannot start job {job.job_id}: node {job.node} is offline")
+                job.status, job.started, job.start_time = "failed", None, ""
+                job.ended = time.time()
+                self._done(job)
+                return
+            JOBS_STARTED.inc()
+            return
+        try:
+            pid, fd = pty.fork()
+        except OSError as e:
+            print(f"⚠️ Cannot start job {job.job_id}: {e}")
+            job.status = "failed"
+            job.ended = time.time()
+            self._done(job)
+            return
+        if pid == 0:
+            # Child process: pty.fork() already made it a session and group leader
+            try:
+                os.chdir(BASE_DIR)
+                # The terminal the job sees is the screen the chat shows
+                fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack("HHHH", CONSOLE_ROWS, CONSOLE_COLS, 0, 0))
+                os.environ["TERM"] = CONSOLE_TERM
+                node_link.apply_limits(job.limits)
+                argv = node_link.job_argv(job.cmd, job.limits)
+                os.execvp(argv[0], argv)
+            finally:
+                os._exit(127)
+
+        job.pid, job.fd = pid, fd
+        self._started(job)
+        JOBS_STARTED.inc()
+        pty_mux.add(fd, pid, job.on_data, lambda: self._reap(job))
+
+    def _started(self, job):
+        job.status = "running"
+        job.started = time.time()
+        job.start_time = datetime.now().strftime("%H:%M:%S")
+        store.save_job(job)
+        if job.on_start:
+            job.on_start(job)
+
+    def remote_exit(self, job, exit_code, usage=None):
+        """An agent reported the end of a job; exit_code None means the node was lost."""
+        if job.ended is not None:
+            return
+        job.exit_code = exit_code
+        job.usage = usage
+        job.ended = time.time()
+        if exit_code is None:
+            job.status = "lost"
+        else:
+            job.status = "killed" if exit_code < 0 or job.status == "stopping" else "exited"
+        self._done(job)
+
+    def _reap(self, job, delay=0.05):
+        try:
+            pid, status, rusage = os.wait4(job.pid, os.WNOHANG)
+        except ChildProcessError:
+            pid, status, rusage = job.pid, 0, None
+        if pid == 0:
+            # Output is closed but the process is still around, look again later
+            pty_mux.call_later(delay, lambda: self._reap(job, min(delay * 2, 5)))
+            return
+        job.exit_code = os.waitstatus_to_exitcode(status)
+        job.ended = time.time()
+        job.status = "killed" if job.exit_code < 0 or job.status == "stopping" else "exited"
+        if rusage is not None:
+            job.usage = node_link.usage_of(rusage)
+        try:
+            os.close(job.fd)
+        except OSError:
+            pass
+        self._done(job)
+
+    def _done(self, job):
+        store.save_job(job)
+        if job.usage:
+            JOB_CPU_SECONDS.observe(job.usage["user"] + job.usage["sys"])
+            JOB_MAX_RSS.observe(job.usage["maxrss"] * 1024)
+        with self.lock:
+            self.running.pop(job.job_id, None)
+            self.history.append(job)
+            # Highest priority waiting jobs whose owner has a free slot
+            startable = []
+            for entry in sorted(self.queue):
+                if self._can_start(entry[2]):
+                    self.queue.remove(entry)
+                    self.running[entry[2].job_id] = entry[2]
+                    startable.append(entry[2])
+            heapq.heapify(self.queue)
+        self._finished(job)
+        for next_job in startable:
+            self._spawn(next_job)
+
+    def _finished(self, job):
+        """Run the job's on_finish, then the callbacks registered with when_done."""
+        with self.lock:
+            callbacks, job.on_end = [job.on_finish] + job.on_end, []
+        for callback in callbacks:
+            if callback is None:
+                continue
+            try:
+                callback(job)
+            except Exception as e:
+                print(f"⚠️ Finish handler error: {e}")
+
+    def when_done(self, job, callback):
+        """Call callback(job) once the job has ended, right away if it already has."""
+        with self.lock:
+            if job.ended is None:
+                job.on_end.append(callback)
+                return
+        callback(job)
+
+    def terminate(self, job, sig=signal.SIGTERM):
+        """Stop a job's whole process group without blocking; returns False if it is gone."""
+        with self.lock:
+            entry = (job.priority, job.job_id, job)
+            queued = entry in self.queue
+            if queued:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+        if queued:
+            job.status = "cancelled"
+            job.ended = time.time()
+            store.save_job(job)
+            with self.lock:
+                self.history.append(job)
+            self._finished(job)
+            return True
+        if job.status not in ("running", "stopping"):
+            return False
+        job.status = "stopping"
+        if not self._kill(job, sig):
+            return False
+        if sig != signal.SIGKILL:
+            pty_mux.call_later(KILL_GRACE, lambda: self._escalate(job))
+        return True
+
+    def _kill(self, job, sig):
+        if job.node is not None:
+            return node_hub.signal(job, sig)
+        try:
+            os.killpg(job.pid, sig)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def _escalate(self, job):
+        if job.ended is None:
+            self._kill(job, signal.SIGKILL)
+
+supervisor = Supervisor()
+
+def restore_jobs():
+    """Put finished jobs of earlier runs back into the history; new ids continue after them."""
+    rows, last_id = store.load_jobs(JOB_HISTORY)
+    supervisor.history.extend(Job.restore(row) for row in rows)
+    Job._ids = itertools.count(last_id + 1)
+
+restore_jobs()
+
+# ================= JOB LIMITS =================
+#
+# Every job gets the tightest of three layers: the JOB_LIMIT_* settings,
+# the per-admin limits the main admin sets with /limits, and the flags
+# given to /run. nice only ever goes up, so a job can yield but not
+# jump ahead of its admin's share.
+
+LIMIT_KEYS = ("cpu", "mem", "fsize", "nofile")
+LIMIT_UNITS = {"cpu": "s", "mem": " MB", "fsize": " MB", "nofile": "", "nice": "", "ionice": ""}
+GLOBAL_LIMITS = {"cpu": JOB_LIMIT_CPU, "mem": JOB_LIMIT_MEM, "fsize": JOB_LIMIT_FSIZE,
+                 "nofile": JOB_LIMIT_NOFILE, "nice": JOB_NICE, "ionice": JOB_IONICE}
+
+def limit_value(key, value):
+    """Validated value of one limit; raises ValueError."""
+    if key not in LIMIT_UNITS:
+        raise ValueError(f"unknown limit {key}")
+    if key == "ionice":
+        if value != "idle" and not (len(value) == 1 and value in "01234567"):
+            raise ValueError("ionice is idle or 0-7")
+        return value
+    if not value.isdigit() or key == "nice" and int(value) > 19:
+        raise ValueError(f"bad value for {key}: {value or 'missing'}")
+    return int(value)
+
+def effective_limits(owner, overrides=None):
+    """Tightest of the global, per-admin and per-job limits."""
+    layers = [GLOBAL_LIMITS, (store.get_pref(owner, "limits") or {}) if owner else {}, overrides or {}]
+    limits = {}
+    for key in LIMIT_KEYS:
+        values = [int(layer[key]) for layer in layers if layer.get(key)]
+        if values:
+            limits[key] = min(values)
+    nice = max(int(layer.get("nice") or 0) for layer in layers)
+    if nice:
+        limits["nice"] = nice
+    ionice = [str(layer["ionice"]) for layer in layers if layer.get("ionice")]
+    if ionice:
+        limits["ionice"] = "idle" if "idle" in ionice else max(ionice)
+    return limits
+
+def describe_limits(limits):
+    parts = [f"{key} {limits[key]}{LIMIT_UNITS[key]}" for key in LIMIT_UNITS if limits.get(key)]
+    return " · ".join(parts) or "none"
+
+# ================= SYSTEM SAMPLER =================
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+SPARK = "▁▂▃▄▅▆▇█"
+
+def sparkline(values, top=100):
+    """One block character per value, scaled to 0..top; gaps for missing values."""
+    return "".join(" " if v is None else SPARK[min(len(SPARK) - 1, int(v / top * len(SPARK)))] for v in values)
+
+class SystemSampler:
+    """
+    Reads /proc and statvfs every SAMPLE_INTERVAL seconds so /status
+    renders from memory instead of forking top, ps and df. CPU% is the
+    delta since the previous sample; a job counts every process of its
+    PTY session. The last SAMPLE_HISTORY samples feed the sparklines.
+    """
+
+    def __init__(self, interval, keep):
+        self.interval = interval
+        self.samples = deque(maxlen=keep)
+        self.prev = None    # (monotonic time, cpu times, bot ticks, {job_id: ticks})
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.interval > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="sampler", daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"⚠️ Sampler error: {e}")
+            time.sleep(self.interval)
+
+    def latest(self):
+        """Newest sample; taken now if the sampler thread is not running."""
+        if self.thread is not None and self.samples:
+            return self.samples[-1]
+        return self.sample()
+
+    @staticmethod
+    def _cpu_times():
+        """(busy, total) jiffies of all CPUs, None where /proc/stat is not readable (newer Android)."""
+        try:
+            with open("/proc/stat") as f:
+                fields = [int(v) for v in f.readline().split()[1:9]]
+        except (OSError, ValueError):
+            return None
+        idle = fields[3] + fields[4]    # idle + iowait
+        return sum(fields) - idle, sum(fields)
+
+    @staticmethod
+    def _meminfo():
+        info = {}
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    key, _, rest = line.partition(":")
+                    if key in ("MemTotal", "MemAvailable"):
+                        info[key] = int(rest.split()[0]) * 1024
+        except OSError:
+            pass
+        return info.get("MemTotal"), info.get("MemAvailable")
+
+    @staticmethod
+    def _proc_stat(pid):
+        """(session id, CPU ticks incl. reaped children, RSS bytes) of a process, None if it is gone."""
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            return None
+        # session, utime, stime, cutime, cstime and rss are fields 6, 14-17 and 24 of stat
+        return int(fields[3]), sum(int(v) for v in fields[11:15]), int(fields[21]) * PAGE_SIZE
+
+    def _job_trees(self, sessions):
+        """session id -> [ticks, rss, processes] over every process in /proc."""
+        trees = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            stat = self._proc_stat(name)
+            if stat is None or stat[0] not in sessions:
+                continue
+            tree = trees.setdefault(stat[0], [0, 0, 0])
+            tree[0] += stat[1]
+            tree[1] += stat[2]
+            tree[2] += 1
+        return trees
+
+    def sample(self):
+        with self.lock:
+            now = time.monotonic()
+            cpu = self._cpu_times()
+            bot = self._proc_stat("self")
+            # Local jobs lead their own session (pty.fork calls setsid)
+            jobs = {job.pid: job for job in list(supervisor.running.values()) if job.node is None and job.pid}
+            trees = self._job_trees(set(jobs)) if jobs else {}
+            mem_total, mem_available = self._meminfo()
+            try:
+                load = os.getloadavg()
+            except OSError:
+                load = None
+            try:
+                disk = os.statvfs(BASE_DIR)
+                disk_total, disk_free = disk.f_blocks * disk.f_frsize, disk.f_bavail * disk.f_frsize
+            except OSError:
+                disk_total = disk_free = None
+
+            prev_time, prev_cpu, prev_bot, prev_jobs = self.prev or (None, None, None, {})
+            dt = now - prev_time if prev_time is not None else 0
+
+            def percent(ticks, before):
+                return max(0, ticks - before) / CLOCK_TICKS / dt * 100 if dt > 0 and before is not None else None
+
+            sample = {
+                "time": time.time(),
+                "cpu": (100 * (cpu[0] - prev_cpu[0]) / max(1, cpu[1] - prev_cpu[1])
+                        if cpu and prev_cpu else None),
+                "load": load,
+                "mem_total": mem_total,
+                "mem_used": mem_total - mem_available if mem_total and mem_available is not None else None,
+                "disk_total": disk_total,
+                "disk_used": disk_total - disk_free if disk_total is not None else None,
+                "bot_cpu": percent(bot[1], prev_bot) if bot else None,
+                "bot_rss": bot[2] if bot else None,
+                "jobs": {},     # job_id -> (cpu %, rss bytes, processes)
+            }
+            job_ticks = {}
+            for pid, (ticks, rss, count) in trees.items():
+                job = jobs[pid]
+                job_ticks[job.job_id] = ticks
+                if job.job_id in prev_jobs:
+                    job_cpu = percent(ticks, prev_jobs[job.job_id])
+                else:
+                    # First sample of this job: average since it started
+                    job_cpu = ticks / CLOCK_TICKS / max(0.1, time.time() - job.started) * 100
+                sample["jobs"][job.job_id] = (job_cpu, rss, count)
+            self.prev = (now, cpu, bot[1] if bot else None, job_ticks)
+            self.samples.append(sample)
+            return sample
+
+    def history(self, key):
+        return [sample[key] for sample in list(self.samples)]
+
+sampler = SystemSampler(SAMPLE_INTERVAL, SAMPLE_HISTORY)
+
+# ================= ENHANCED PTY RUNNER =================
+
+def chat_jobs(admin_id, chat_id):
+    """Jobs (running and queued) owned by a chat, keyed by job ID."""
+    return registry.jobs(admin_id, chat_id)
+
+def foreground_job(admin_id, chat_id):
+    return registry.foreground(admin_id, chat_id)
+
+def set_foreground(admin_id, chat_id, job):
+    """Make job the chat's foreground job; the previous one keeps running in the background."""
+    previous = registry.set_foreground(admin_id, chat_id, job)
+    if previous is job:
+        return
+    if previous is not None:
+        previous.input_attached = False
+        previous.console.detach()
+        outbox.send_message(chat_id, f"↪️ Job #{previous.job_id} moved to background", priority=PRIO_BULK, merge=True)
+    if job is not None:
+        job.console.attach()
+
+def find_job(admin_id, chat_id, job_id):
+    """A job of this chat by ID; the main admin may address any job."""
+    job = registry.job(admin_id, chat_id, job_id)
+    if job is None and str(chat_id) == str(MAIN_ADMIN_ID):
+        job = next((j for j in registry.admin_jobs(admin_id) if j.job_id == job_id), None)
+    return job
+
+def run_cmd(cmd, admin_id, chat_id, owner=None, priority=JOB_DEFAULT_PRIORITY, node=None, limits=None):
+    """
+    Queue a command as a new foreground job of the chat, on an agent
+    node if one is named, under the owner's limits tightened by
+    `limits`; returns (job, queue position). Raises JobQueueFull if the
+    run queue is full.
+    """
+    job = Job(cmd, admin_id, chat_id, owner, priority)
+    job.node = node
+    job.limits = effective_limits(owner, limits)
+    spill = job.spill = new_spill_log()
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("📥 Full Log", callback_data=f"log_{spill.log_id}"))
+    console = job.console = ConsoleStream(chat_id, markup)
+    console.detach()  # Attached when it becomes the foreground job
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    def on_data(data):
+        if job.first_output is None:
+            job.first_output = time.time()
+            JOB_FIRST_OUTPUT.observe(job.first_output - job.started)
+        job.bytes_read += len(data)
+        PTY_BYTES.inc(amount=len(data))
+        with spill.lock:
+            # Atomic with the replay a browser takes when it attaches, see term_socket
+            spill.write(data)
+            watchers = list(job.watchers)
+        for watcher in watchers:
+            watcher(data)
+        out = decoder.decode(data)
+        if out:
+            console.feed(out)
+
+        # Check if process is waiting for input
+        if out.strip().endswith(":") and registry.wait_input(admin_id, chat_id, job):
+            console.flush()  # Show the prompt right away
+
+    def on_finish(job):
+        summary = f"{job.describe_exit()} · {job.duration:.1f}s"
+        if job.usage:
+            summary += f" · {job.describe_usage()}"
+        for watcher in list(job.watchers):
+            watcher(None)
+        if console.muted:
+            outbox.send_message(chat_id, f"🔔 Job #{job.job_id} `{job.cmd[:50]}` finished: {summary}",
+                                priority=PRIO_BULK, parse_mode="Markdown", reply_markup=markup)
+        else:
+            if job.started is not None:
+                console.feed(f"\r\n[{summary}]" if console.screen.x else f"[{summary}]")
+            # Chat only saw the tail: deliver everything as a document
+            console.finish(lambda: threading.Thread(
+                target=send_spill_log, args=(chat_id, spill, f"job-{job.job_id}"), daemon=True).start())
+        if job.started is not None:
+            JOB_OUTPUT_BYTES.observe(job.bytes_read)
+            JOB_MESSAGES.observe(console.updates)
+            history_log.record(job, spill)
+        # Cleanup after process ends
+        if registry.remove_job(admin_id, chat_id, job):
+            drop_session(admin_id, chat_id)
+        spill.release()   # Finished: the log may now be evicted
+
+    job.on_data = on_data
+    job.on_finish = on_finish
+    registry.add_job(admin_id, chat_id, job)
+    touch_session(admin_id, chat_id)
+    set_foreground(admin_id, chat_id, job)
+    try:
+        return job, supervisor.submit(job)
+    except JobQueueFull:
+        registry.remove_job(admin_id, chat_id, job)
+        spill.release()
+        raise
+
+# ================= QUICK COMMAND CACHE =================
+
+# Read-only quick commands and how many seconds their output may be reused
+QUICK_CACHE_TTL = {
+    "ls -la": 5,
+    "pwd": 60,
+    "df -h": 10,
+    "top -b -n 1": 3,
+    "ps aux | head -15": 3,
+    "ifconfig || ip addr": 30,
+}
+
+class QuickCache:
+    """
+    Output of idempotent quick commands, reused for their TTL. Requests
+    for a command that is already running wait for that run instead of
+    starting another (singleflight), so a burst of button presses costs
+    one fork. Commands run without a PTY or a job slot.
+    """
+
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.results = {}    # cmd -> (monotonic finish time, (output, wall clock time))
+        self.inflight = {}   # cmd -> Future of (output, wall clock time)
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="quick")
+
+    def get(self, cmd, refresh=False):
+        """Future of (output, time it was produced); refresh skips the cached result."""
+        with self.lock:
+            cached = self.results.get(cmd)
+            if not refresh and cached and time.monotonic() - cached[0] < self.ttls[cmd]:
+                QUICK_REQUESTS.inc("hit")
+                future = Future()
+                future.set_result(cached[1])
+                return future
+            future = self.inflight.get(cmd)
+            if future is not None:
+                QUICK_REQUESTS.inc("shared")
+                return future
+            QUICK_REQUESTS.inc("miss")
+            future = self.inflight[cmd] = self.pool.submit(self._run, cmd)
+            return future
+
+    def _run(self, cmd):
+        """Run cmd once; the inflight entry is dropped even if the run fails."""
+        try:
+            try:
+                proc = subprocess.run(["bash", "-c", cmd], cwd=BASE_DIR, stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=QUICK_TIMEOUT,
+                                      env=dict(os.environ, TERM="dumb", COLUMNS=str(CONSOLE_COLS)))
+                output = proc.stdout.decode("utf-8", errors="replace")
+                if proc.returncode:
+                    output += f"\n[exit {proc.returncode}]"
+            except subprocess.TimeoutExpired as e:
+                output = (e.output or b"").decode("utf-8", errors="replace") + f"\n[timed out after {QUICK_TIMEOUT:g}s]"
+            result = (output, time.time())
+            with self.lock:
+                self.results[cmd] = (time.monotonic(), result)
+            return result
+        finally:
+            with self.lock:
+                self.inflight.pop(cmd, None)
+
+quick_cache = QuickCache(QUICK_CACHE_TTL)
+
+def send_quick(chat_id, cmd, message_id=None, refresh=False):
+    """Show a cached quick command; every waiting chat gets the shared result."""
+    future = quick_cache.get(cmd, refresh)
+    future.add_done_callback(lambda f: show_quick_result(chat_id, cmd, f, message_id))
+
+def show_quick_result(chat_id, cmd, future, message_id=None):
+    try:
+        output, produced = future.result()
+    except Exception as e:
+        outbox.send_message(chat_id, f"❌ {cmd}: {e}")
+        return
+    age = int(time.time() - produced)
+    note = f"🕒 cached, {age}s old" if age else ""
+    body = f"$ {cmd}\n{output.rstrip()}"[:CONSOLE_LIMIT - 100]
+    text = f"<pre>{html.escape(body)}</pre>{note}"
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 Refresh", callback_data=f"qc_{list(QUICK_CACHE_TTL).index(cmd)}"))
+    if message_id is None:
+        outbox.send_message(chat_id, text, parse_mode="HTML", reply_markup=markup)
+    else:
+        outbox.edit_message_text(text, chat_id, message_id, priority=PRIO_INTERACTIVE,
+                                 parse_mode="HTML", reply_markup=markup)
+
+def quick_callback(call):
+    """qc_<index>: rerun a quick command, bypassing the cache, and redraw its message."""
+    index = call.data[3:]
+    cmds = list(QUICK_CACHE_TTL)
+    if not index.isdigit() or int(index) >= len(cmds):
+        outbox.answer_callback_query(call.id, "❌ Unknown command")
+        return
+    outbox.answer_callback_query(call.id, "🔄 Refreshing...")
+    send_quick(call.message.chat.id, cmds[int(index)], call.message.message_id, refresh=True)
+
+# ================= NODE HUB =================
+
+class NodeLink:
+    """Hub end of one agent's connection; jobs on it are multiplexed by job ID."""
+
+    def __init__(self, sock, hello):
+        self.sock = sock
+        self.name = hello["name"]
+        self.host = hello.get("host", "?")
+        self.connected = time.time()
+        self.send_lock = threading.Lock()
+        self.jobs = {}   # job_id -> (Job, zlib decompressor)
+        self.closed = False
+
+    def send(self, kind, channel=0, payload=b""):
+        try:
+            with self.send_lock:
+                node_link.send_frame(self.sock, kind, channel, payload)
+            return True
+        except OSError:
+            self.close()
+            return False
+
+    def run(self, job):
+        self.jobs[job.job_id] = (job, zlib.decompressobj())
+        spec = {"cmd": job.cmd, "rows": CONSOLE_ROWS, "cols": CONSOLE_COLS, "term": CONSOLE_TERM,
+                "limits": job.limits}
+        if not self.send(node_link.RUN, job.job_id, spec):
+            self.jobs.pop(job.job_id, None)
+            return False
+        return True
+
+    def read_loop(self):
+        """Runs in the link's thread until the agent goes away."""
+        try:
+            while True:
+                kind, channel, payload = node_link.recv_frame(self.sock)
+                if kind == node_link.OUTPUT:
+                    entry = self.jobs.get(channel)
+                    if entry is not None:
+                        NODE_LINK_BYTES.inc(self.name, amount=len(payload))
+                        entry[0].on_data(entry[1].decompress(payload))
+                elif kind == node_link.EXIT:
+                    entry = self.jobs.pop(channel, None)
+                    if entry is not None:
+                        result = json.loads(payload)
+                        supervisor.remote_exit(entry[0], result["exit_code"], result.get("usage"))
+        except (OSError, node_link.LinkClosed, ValueError, zlib.error) as e:
+            print(f"⚠️ Node {self.name} disconnected: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        node_hub.forget(self)
+        # Its jobs can't report back any more
+        for job, _ in list(self.jobs.values()):
+            supervisor.remote_exit(job, None)
+        self.jobs.clear()
+
+class NodeHub:
+    """
+    Accepts agents (node_link.py) on NODE_LISTEN and routes jobs of
+    selected nodes to them. One thread per connected agent reads its
+    frames; a pinger drops agents that stopped answering.
+    """
+
+    def __init__(self):
+        self.nodes = {}   # name -> NodeLink
+        self.lock = threading.Lock()
+        self.server = None
+
+    def listen(self, address):
+        host, _, port = address.rpartition(":")
+        self.server = socket.create_server((host or "0.0.0.0", int(port)))
+        threading.Thread(target=self._accept_loop, name="node-hub", daemon=True).start()
+        threading.Thread(target=self._ping_loop, name="node-ping", daemon=True).start()
+        return self.server.getsockname()
+
+    def _accept_loop(self):
+        while True:
+            sock, address = self.server.accept()
+            threading.Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+    def _serve(self, sock, address):
+        try:
+            sock.settimeout(10)
+            # "local" means this host in /node and /all, an agent must not take it over
+            hello = node_link.hub_handshake(sock, NODE_TOKEN, reserved=("local",))
+        except (OSError, node_link.LinkClosed, ValueError) as e:
+            print(f"⚠️ Agent from {address[0]} rejected: {e}")
+            sock.close()
+            return
+        sock.settimeout(NODE_PING_INTERVAL * 3)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = NodeLink(sock, hello)
+        with self.lock:
+            old = self.nodes.get(link.name)
+            self.nodes[link.name] = link
+        if old is not None:
+            old.close()  # Same agent reconnected
+        print(f"🔗 Node {link.name} connected from {address[0]} ({link.host})")
+        threading.current_thread().name = f"node-{link.name}"
+        link.read_loop()
+
+    def _ping_loop(self):
+        while True:
+            time.sleep(NODE_PING_INTERVAL)
+            for link in list(self.nodes.values()):
+                link.send(node_link.PING)
+
+    def forget(self, link):
+        with self.lock:
+            if self.nodes.get(link.name) is link:
+                del self.nodes[link.name]
+
+    def get(self, name):
+        return self.nodes.get(name)
+
+    def spawn(self, job):
+        link = self.nodes.get(job.node)
+        return link is not None and link.run(job)
+
+    def signal(self, job, sig):
+        link = self.nodes.get(job.node)
+        return link is not None and job.job_id in link.jobs and \
+            link.send(node_link.SIGNAL, job.job_id, {"signal": int(sig)})
+
+    def write(self, job, data):
+        link = self.nodes.get(job.node)
+        return link is not None and link.send(node_link.INPUT, job.job_id, data)
+
+    def resize(self, job, rows, cols):
+        link = self.nodes.get(job.node)
+        return link is not None and link.send(node_link.RESIZE, job.job_id, {"rows": rows, "cols": cols})
+
+node_hub = NodeHub()
+
+class FanOut:
     """
-    Returns the dictionary for a specific admin.
-    If it doesn't exist, initialize it.
+    One command run in parallel on several nodes ("local" is this host),
+    reported in a single message that fills in as nodes finish.
     """
-    if admin_id not in dict_obj:
-        dict_obj[admin_id] = {}
-    return dict_obj[admin_id]
 
-# ===================== LOAD / SAVE DATA =====================
-def load_data():
-    global admins
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                admins = set(data.get('admins', []))
-        admins.add(MAIN_ADMIN_ID)  # Ensure main admin is always included
-    except Exception as e:
-        print(f"⚠️ Load data failed: {e}")
-        admins = {MAIN_ADMIN_ID}
+    TAIL_BYTES = 16 * 1024   # output kept per node for the summary
 
-def save_data():
-    try:
-        data = {'admins': list(admins)}
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(f"⚠️ Save data failed: {e}")
+    def __init__(self, chat_id, cmd, nodes):
+        self.chat_id = chat_id
+        self.cmd = cmd
+        self.jobs = OrderedDict((node, None) for node in nodes)   # node -> Job
+        self.tails = {node: bytearray() for node in nodes}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.message = None
 
-# ===================== INITIAL LOAD =====================
-load_data()
+    def start(self, admin_id, owner):
+        self.message = outbox.send_message(self.chat_id, self.render(), parse_mode="HTML")
+        for node in self.jobs:
+            job = Job(self.cmd, admin_id, self.chat_id, owner)
+            job.node = None if node == "local" else node
+            job.limits = effective_limits(owner)
+            job.on_data = lambda data, node=node: self._on_data(node, data)
+            job.on_finish = lambda job, node=node: self._on_finish(node, job)
+            self.jobs[node] = job
+            registry.add_job(admin_id, self.chat_id, job)
+            try:
+                supervisor.submit(job)
+            except JobQueueFull:
+                registry.remove_job(admin_id, self.chat_id, job)
+                self.errors[node] = "queue full"
+        self.update()
 
-# ================= ENHANCED PTY RUNNER =================
+    def _on_data(self, node, data):
+        job = self.jobs[node]
+        job.bytes_read += len(data)
+        if job.first_output is None:
+            job.first_output = time.time()
+        with self.lock:
+            tail = self.tails[node]
+            tail += data
+            if len(tail) > 2 * self.TAIL_BYTES:
+                del tail[:-self.TAIL_BYTES]
 
-def run_cmd(cmd, admin_id, chat_id):
-    def task():
-        # Ensure admin dict exists
-        proc_dict = get_admin_dict(admin_id, processes)
-        sess_dict = get_admin_dict(admin_id, active_sessions)
-        input_dict = get_admin_dict(admin_id, input_wait)
-        
-        pid, fd = pty.fork()
-        if pid == 0:
-            # Child process
-            os.chdir(BASE_DIR)
-            os.execvp("bash", ["bash", "-c", cmd])
+    def _on_finish(self, node, job):
+        if registry.remove_job(job.admin_id, self.chat_id, job):
+            drop_session(job.admin_id, self.chat_id)
+        self.update()
+
+    def update(self):
+        if self.message is not None:
+            self.message.add_done_callback(self._edit)
+
+    def _edit(self, sent):
+        try:
+            message_id = sent.result().message_id
+        except Exception:
+            return
+        outbox.edit_message_text(self.render(), self.chat_id, message_id, parse_mode="HTML")
+
+    def render(self):
+        finished = sum(1 for node, job in self.jobs.items() if node in self.errors or (job and job.ended))
+        header = f"🌐 <b>{finished}/{len(self.jobs)} nodes</b> $ <code>{html.escape(self.cmd[:200])}</code>\n"
+        budget = max(200, (CONSOLE_LIMIT - len(header)) // max(1, len(self.jobs)) - 80)
+        parts = [header]
+        for node, job in self.jobs.items():
+            if node in self.errors:
+                parts.append(f"\n❌ <b>{html.escape(node)}</b> · {self.errors[node]}")
+            elif job is None or job.ended is None:
+                state = "queued" if job is None or job.started is None else f"running {job.duration:.0f}s"
+                parts.append(f"\n⏳ <b>{html.escape(node)}</b> · {state}")
+            else:
+                icon = "✅" if job.exit_code == 0 else "❌"
+                with self.lock:
+                    output = HistoryLog.clean(bytes(self.tails[node][-self.TAIL_BYTES:]))
+                text = output.decode("utf-8", errors="replace").strip()[-budget:]
+                usage = f" · {job.describe_usage()}" if job.usage else ""
+                parts.append(f"\n{icon} <b>{html.escape(node)}</b> · {job.describe_exit()} · {job.duration:.1f}s{usage}")
+                if text:
+                    parts.append(f"\n<pre>{html.escape(text)}</pre>")
+        return "".join(parts)
+
+# ================= FILE BROWSER =================
+
+def inside_base_dir(path):
+    """True if `path` (symlinks resolved) lies within BASE_DIR."""
+    base = os.path.realpath(BASE_DIR)
+    return os.path.commonpath([base, os.path.realpath(path)]) == base
+
+def human_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+class DirListing:
+    """
+    One scandir pass over a directory: (name, is_dir, size, mtime) per
+    entry, plus sorted views built on first use. Valid while the
+    directory's own mtime is unchanged (entries added, removed or renamed).
+    """
+
+    SORT_KEYS = {
+        "name": lambda e: e[0].lower(),
+        "size": lambda e: -e[2],
+        "mtime": lambda e: -e[3],
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        self.entries = []
+        self.orders = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    st = entry.stat(follow_symlinks=False)
+                    self.entries.append((entry.name, is_dir, st.st_size, st.st_mtime))
+                except OSError:
+                    # Vanished or unreadable entry
+                    self.entries.append((entry.name, False, 0, 0))
+
+    def sorted(self, key):
+        order = self.orders.get(key)
+        if order is None:
+            # Directories first, then by the chosen key
+            sort_key = self.SORT_KEYS[key]
+            order = self.orders[key] = sorted(self.entries, key=lambda e: (not e[1], sort_key(e)))
+        return order
+
+dir_listings = OrderedDict()
+dir_listings_lock = threading.Lock()
+
+def get_dir_listing(path, refresh=False):
+    """Cached listing of `path`, rescanned only when the directory changed."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    with dir_listings_lock:
+        listing = dir_listings.get(path)
+        if listing is not None and listing.mtime_ns == mtime_ns and not refresh:
+            dir_listings.move_to_end(path)
+            return listing
+    listing = DirListing(path)
+    with dir_listings_lock:
+        dir_listings[path] = listing
+        dir_listings.move_to_end(path)
+        while len(dir_listings) > DIR_CACHE_SIZE:
+            dir_listings.popitem(last=False)
+    return listing
+
+class BrowserState:
+    """Where a chat's file browser is: directory, page, sort and the names on screen."""
+
+    def __init__(self, path):
+        self.path = path
+        self.page = 0
+        self.sort = "name"
+        self.shown = []
+
+browsers = sessions.table("browser", VIEWER_TTL, sliding=True)  # chat_id -> BrowserState
+
+def render_browser(state, refresh=False):
+    """Text and inline keyboard of the current browser page."""
+    listing = get_dir_listing(state.path, refresh)
+    entries = listing.sorted(state.sort)
+    pages = max(1, -(-len(entries) // BROWSER_PAGE_SIZE))
+    state.page = min(state.page, pages - 1)
+    page = entries[state.page * BROWSER_PAGE_SIZE:(state.page + 1) * BROWSER_PAGE_SIZE]
+    # Buttons refer to entries by position, so a listing that changes
+    # between two presses never opens the wrong file
+    state.shown = [name for name, _, _, _ in page]
+
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for i, (name, is_dir, size, mtime) in enumerate(page):
+        label = name if len(name) <= 40 else name[:37] + "..."
+        if is_dir:
+            markup.add(types.InlineKeyboardButton(f"📁 {label}/", callback_data=f"fb_o{i}"))
         else:
-            # Parent process
-            start_time = datetime.now().strftime("%H:%M:%S")
-            proc_dict[chat_id] = (pid, fd, start_time, cmd)
-            sess_dict[chat_id] = time.time()
+            markup.add(types.InlineKeyboardButton(f"📄 {label} · {human_size(size)}", callback_data=f"fb_o{i}"))
+
+    nav = []
+    if os.path.realpath(state.path) != os.path.realpath(BASE_DIR):
+        nav.append(types.InlineKeyboardButton("⬆️ Up", callback_data="fb_u"))
+    if state.page > 0:
+        nav.append(types.InlineKeyboardButton("◀️ Prev", callback_data=f"fb_p{state.page - 1}"))
+    if state.page < pages - 1:
+        nav.append(types.InlineKeyboardButton("Next ▶️", callback_data=f"fb_p{state.page + 1}"))
+    if nav:
+        markup.row(*nav)
+    markup.row(
+        *[types.InlineKeyboardButton(("✅ " if key == state.sort else "") + key.title(), callback_data=f"fb_s{key}")
+          for key in DirListing.SORT_KEYS],
+        types.InlineKeyboardButton("🔄", callback_data="fb_r"),
+    )
+
+    rel = os.path.relpath(state.path, BASE_DIR)
+    text = (f"📁 *FILES IN* `{state.path if rel == '.' else rel}`\n"
+            f"{len(entries)} entries · page {state.page + 1}/{pages} · sorted by {state.sort}")
+    return text, markup
+
+def show_browser(chat_id, message_id=None, refresh=False):
+    """Send the browser, or redraw it in place when message_id is given."""
+    state = browsers.get(chat_id)
+    try:
+        text, markup = render_browser(state, refresh)
+    except OSError as e:
+        outbox.send_message(chat_id, f"❌ Cannot list {state.path}: {e}")
+        return
+    if message_id is None:
+        outbox.send_message(chat_id, text, parse_mode="Markdown", reply_markup=markup)
+    else:
+        outbox.edit_message_text(text, chat_id, message_id, priority=PRIO_INTERACTIVE,
+                                 parse_mode="Markdown", reply_markup=markup)
+
+def file_actions_markup(chat_id, path):
+    """Edit link (new editor session) and view button for a file."""
+    sid = new_edit_session(path, chat_id)
+    link = f"{PUBLIC_URL}/edit/{sid}?admin_id={chat_id}"
+    markup = types.InlineKeyboardMarkup()
+    buttons = [types.InlineKeyboardButton("✏️ Edit in Browser", url=link)]
+    buttons.append(types.InlineKeyboardButton("📄 View Content", callback_data=f"vw_{new_viewer(path)}_o0"))
+    markup.add(*buttons)
+    return markup
+
+def browser_callback(call):
+    """fb_* buttons: o<i> open entry, u up, p<n> page, s<key> sort, r rescan."""
+    cid = call.message.chat.id
+    mid = call.message.message_id
+    state = browsers.get(cid)
+    if state is None:
+        outbox.answer_callback_query(call.id, "❌ Browser expired, open List Files again")
+        return
+    action, arg = call.data[3], call.data[4:]
+    refresh = False
 
+    if action == "o":
+        try:
+            name = state.shown[int(arg)]
+        except (ValueError, IndexError):
+            outbox.answer_callback_query(call.id, "❌ Entry no longer listed")
+            return
+        path = os.path.join(state.path, name)
+        if not inside_base_dir(path):
+            outbox.answer_callback_query(call.id, "❌ Outside the base directory")
+            return
+        if not os.path.isdir(path):
             try:
-                while True:
-                    rlist, _, _ = select.select([fd], [], [], 0.1)
-                    if fd in rlist:
-                        try:
-                            out = os.read(fd, 1024).decode(errors="ignore")
-                        except OSError:
-                            break
-
-                        if out:
-                            display_out = out if len(out) < 2000 else out[:2000] + "\n... [OUTPUT TRUNCATED]"
-                            bot.send_message(chat_id, f"```\n{display_out}\n```", parse_mode="Markdown")
-
-                        # Check if process is waiting for input
-                        if out.strip().endswith(":"):
-                            input_dict[chat_id] = fd
-
-                    # Check if process is still alive
-                    try:
-                        os.kill(pid, 0)
-                    except OSError:
-                        break
+                st = os.stat(path)
+            except OSError as e:
+                outbox.answer_callback_query(call.id, f"❌ {e}")
+                return
+            outbox.answer_callback_query(call.id)
+            modified = datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M")
+            outbox.send_message(
+                cid,
+                f"📄 *FILE:* `{os.path.relpath(path, BASE_DIR)}`\n*Size:* {human_size(st.st_size)}\n*Modified:* {modified}",
+                parse_mode="Markdown",
+                reply_markup=file_actions_markup(cid, path)
+            )
+            return
+        state.path, state.page = path, 0
+    elif action == "u":
+        parent = os.path.dirname(state.path)
+        if inside_base_dir(parent):
+            state.path, state.page = parent, 0
+    elif action == "p":
+        state.page = max(0, int(arg))
+    elif action == "s" and arg in DirListing.SORT_KEYS:
+        state.sort, state.page = arg, 0
+        store.set_pref(cid, "browser_sort", arg)
+    elif action == "r":
+        refresh = True
+
+    outbox.answer_callback_query(call.id)
+    show_browser(cid, mid, refresh)
+
+# ================= FILE TRANSFER =================
+#
+# /get and /put move files through Telegram documents without ever
+# holding a whole file: uploads go out in volumes of TRANSFER_PART_BYTES
+# (one volume in flight at a time), directories are tarred into a pipe
+# and cut into volumes as the archive is produced, and downloads are
+# written to disk chunk by chunk while they are hashed.
+
+TRANSFER_CHUNK = 256 * 1024
+transfers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="transfer")
+
+class FileWindow:
+    """
+    Read-only view of `length` bytes of a file from `offset`, handed to
+    send_document as the upload body. seek(0) rewinds to the start of
+    the window, so the outbox can resend it after a 429.
+    """
+
+    def __init__(self, fd, offset, length):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.pos = 0
 
-                    time.sleep(0.1)
+    def read(self, size=-1):
+        left = self.length - self.pos
+        size = left if size is None or size < 0 else min(size, left)
+        data = os.pread(self.fd, size, self.offset + self.pos) if size > 0 else b""
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        self.pos = pos if whence == 0 else self.length + pos if whence == 2 else self.pos + pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+def resolve_path(arg):
+    """
+    Absolute path for a /get or /put argument (relative to BASE_DIR), None
+    if outside BASE_DIR. A trailing slash is kept: "/put newdir/" names a
+    directory to save into, not a file.
+    """
+    arg = os.path.expanduser(arg.strip())
+    path = os.path.abspath(os.path.join(BASE_DIR, arg))
+    if not inside_base_dir(path):
+        return None
+    return os.path.join(path, "") if arg.endswith("/") else path
+
+def part_name(name, index, parts):
+    return name if parts == 1 else f"{name}.{index:03d}"
+
+def send_volume(chat_id, body, name, caption):
+    """Upload one volume and wait for it, so only one is ever buffered by the HTTP client."""
+    outbox.send_document(chat_id, body, caption=caption, visible_file_name=name).result()
+
+def send_file(chat_id, path):
+    """Send a file as one document, or as numbered volumes of TRANSFER_PART_BYTES."""
+    name = os.path.basename(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        parts = max(1, -(-size // TRANSFER_PART_BYTES))
+        whole = hashlib.sha256()
+        for index in range(1, parts + 1):
+            window = FileWindow(fd, (index - 1) * TRANSFER_PART_BYTES, TRANSFER_PART_BYTES)
+            window.length = min(TRANSFER_PART_BYTES, size - window.offset)
+            digest = hashlib.sha256()
+            while True:
+                data = window.read(TRANSFER_CHUNK)
+                if not data:
+                    break
+                digest.update(data)
+                whole.update(data)
+            window.seek(0)
+            label = f"part {index}/{parts} · " if parts > 1 else ""
+            send_volume(chat_id, window, part_name(name, index, parts),
+                        f"📦 {name} · {label}{human_size(window.length)}\nsha256 {digest.hexdigest()}")
+    finally:
+        os.close(fd)
+    if parts > 1:
+        outbox.send_message(chat_id, f"🧩 {name}: {parts} parts, {human_size(size)}\n"
+                                     f"`cat {name}.0* > {name}`\nsha256 `{whole.hexdigest()}`", parse_mode="Markdown")
+
+def send_tree(chat_id, path):
+    """Send a directory as a tar.gz produced on the fly, cut into volumes as it streams out of a pipe."""
+    name = os.path.basename(path.rstrip("/")) or "base"
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe, tarfile.open(fileobj=pipe, mode="w|gz") as tar:
+                tar.add(path, arcname=name)
+        except Exception as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=produce, name="tar", daemon=True)
+    producer.start()
+    total, index, whole = 0, 0, hashlib.sha256()
+    with os.fdopen(read_fd, "rb") as pipe:
+        data = pipe.read(TRANSFER_CHUNK)
+        while data:
+            index += 1
+            volume = tempfile.TemporaryFile(dir=SPILL_DIR)
+            digest = hashlib.sha256()
+            size = 0
+            while data and size < TRANSFER_PART_BYTES:
+                take = data[:TRANSFER_PART_BYTES - size]
+                volume.write(take)
+                digest.update(take)
+                whole.update(take)
+                size += len(take)
+                data = data[len(take):] or pipe.read(TRANSFER_CHUNK)
+            total += size
+            # The archive size is unknown up front: one volume is name.tar.gz, more are .tar.gz.001, .002...
+            single = index == 1 and not data
+            label = "" if single else f"part {index}{'' if data else ' (last)'} · "
+            volume.seek(0)
+            try:
+                send_volume(chat_id, volume, part_name(f"{name}.tar.gz", index, 1 if single else 0),
+                            f"📦 {name}.tar.gz · {label}{human_size(size)}\nsha256 {digest.hexdigest()}")
             finally:
-                # Cleanup after process ends
-                proc_dict.pop(chat_id, None)
-                input_dict.pop(chat_id, None)
-                sess_dict.pop(chat_id, None)
+                volume.close()
+    producer.join()
+    if errors:
+        outbox.send_message(chat_id, f"⚠️ Archive of {name} is incomplete: {errors[0]}")
+    elif index > 1:
+        outbox.send_message(chat_id, f"🧩 {name}.tar.gz: {index} parts, {human_size(total)}\n"
+                                     f"`cat {name}.tar.gz.0* | tar xz`\nsha256 `{whole.hexdigest()}`",
+                            parse_mode="Markdown")
 
-    threading.Thread(target=task, daemon=True).start()
+def receive_file(chat_id, document, dest, expected=None):
+    """Stream a document sent to the bot to `dest`, checking its size and sha256 before it replaces anything."""
+    file = bot.get_file(document.file_id)
+    directory = os.path.dirname(dest)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            if os.path.isabs(file.file_path) and os.path.exists(file.file_path):
+                # A local Bot API server (TELEGRAM_API_URL) hands out paths on its own disk
+                source = open(file.file_path, "rb")
+                chunks = iter(lambda: source.read(TRANSFER_CHUNK), b"")
+            else:
+                # FILE_URL is only set for a custom TELEGRAM_API_URL, like apihelper.get_file_url
+                file_url = telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+                url = file_url.format(bot.token, file.file_path)
+                source = requests.get(url, stream=True, timeout=60, proxies=telebot.apihelper.proxy)
+                source.raise_for_status()
+                chunks = source.iter_content(TRANSFER_CHUNK)
+            with source:
+                for data in chunks:
+                    digest.update(data)
+                    out.write(data)
+                    size += len(data)
+            out.flush()
+            os.fsync(out.fileno())
+        if document.file_size and size != document.file_size:
+            raise ValueError(f"got {size} of {document.file_size} bytes")
+        if expected and digest.hexdigest() != expected:
+            raise ValueError(f"sha256 mismatch, got {digest.hexdigest()}")
+        os.replace(tmp, dest)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return size, digest.hexdigest()
 
 # ================= ADMIN MANAGEMENT =================
 
@@ -148,12 +3250,17 @@ def main_menu_keyboard():
 
 # ================= TELEGRAM HANDLERS =================
 
+def offload(function):
+    """Mark a handler that reads files or SQLite; RUNTIME=asyncio runs it on the handler pool."""
+    function.offload = True
+    return function
+
 @bot.message_handler(commands=["start"])
 def start(m):
     cid = m.chat.id
     
     if not is_admin(cid):
-        bot.send_message(cid, "❌ You are not authorized to use this bot.")
+        outbox.send_message(cid, "❌ You are not authorized to use this bot.")
         return
     
     welcome_msg = """
@@ -171,7 +3278,21 @@ def start(m):
 
 📌 𝗤𝘂𝗶𝗰𝗸 𝗖𝗼𝗺𝗺𝗮𝗻𝗱𝘀:
 • /nano filename - 𝗘𝗱𝗶𝘁 𝗮 𝗳𝗶𝗹𝗲
+• /get path - 𝗗𝗼𝘄𝗻𝗹𝗼𝗮𝗱 𝗮 𝗳𝗶𝗹𝗲 𝗼𝗿 𝗳𝗼𝗹𝗱𝗲𝗿
+• /put path - 𝗨𝗽𝗹𝗼𝗮𝗱 𝘁𝗵𝗲 𝗻𝗲𝘅𝘁 𝗳𝗶𝗹𝗲 𝘀𝗲𝗻𝘁
 • /stop - 𝗦𝘁𝗼𝗽 𝗰𝘂𝗿𝗿𝗲𝗻𝘁 𝗽𝗿𝗼𝗰𝗲𝘀𝘀
+• /jobs - 𝗟𝗶𝘀𝘁 𝗷𝗼𝗯𝘀
+• /fg id - 𝗙𝗼𝗿𝗲𝗴𝗿𝗼𝘂𝗻𝗱 𝗮 𝗷𝗼𝗯
+• /term id - 𝗢𝗽𝗲𝗻 𝗮 𝗷𝗼𝗯 𝗶𝗻 𝘁𝗵𝗲 𝗯𝗿𝗼𝘄𝘀𝗲𝗿
+• /bg - 𝗦𝗲𝗻𝗱 𝗷𝗼𝗯 𝘁𝗼 𝗯𝗮𝗰𝗸𝗴𝗿𝗼𝘂𝗻𝗱
+• /kill id - 𝗞𝗶𝗹𝗹 𝗮 𝗷𝗼𝗯
+• /run -p N cmd - 𝗥𝘂𝗻 𝘄𝗶𝘁𝗵 𝗽𝗿𝗶𝗼𝗿𝗶𝘁𝘆 𝟬-𝟵
+• /limits - 𝗖𝗣𝗨, 𝗺𝗲𝗺𝗼𝗿𝘆 𝗮𝗻𝗱 𝗳𝗶𝗹𝗲 𝗹𝗶𝗺𝗶𝘁𝘀
+• /history - 𝗖𝗼𝗺𝗺𝗮𝗻𝗱 𝗵𝗶𝘀𝘁𝗼𝗿𝘆
+• /rerun id - 𝗥𝗲𝗿𝘂𝗻 𝗮 𝗽𝗮𝘀𝘁 𝗷𝗼𝗯
+• /grep text - 𝗦𝗲𝗮𝗿𝗰𝗵 𝗽𝗮𝘀𝘁 𝗼𝘂𝘁𝗽𝘂𝘁
+• /node name - 𝗣𝗶𝗰𝗸 𝘁𝗵𝗲 𝗱𝗲𝘃𝗶𝗰𝗲 𝘁𝗼 𝗿𝘂𝗻 𝗼𝗻
+• /all cmd - 𝗥𝘂𝗻 𝗼𝗻 𝗲𝘃𝗲𝗿𝘆 𝗱𝗲𝘃𝗶𝗰𝗲
 • /status - 𝗖𝗵𝗲𝗰𝗸 𝘀𝘆𝘀𝘁𝗲𝗺 𝘀𝘁𝗮𝘁𝘂𝘀
 • /admin - 𝗢𝗽𝗲𝗻 𝗮𝗱𝗺𝗶𝗻 𝗽𝗮𝗻𝗲𝗹
 • /sessions - 𝗩𝗶𝗲𝘄 𝗮𝗰𝘁𝗶𝘃𝗲 𝘀𝗲𝘀𝘀𝗶𝗼𝗻𝘀
@@ -179,7 +3300,7 @@ def start(m):
 💡 𝗧𝗶𝗽: 𝗨𝘀𝗲 𝗯𝘂𝘁𝘁𝗼𝗻𝘀 𝗯𝗲𝗹𝗼𝘄 𝗼𝗿 𝘁𝘆𝗽𝗲 𝗰𝗼𝗺𝗺𝗮𝗻𝗱𝘀 𝗱𝗶𝗿𝗲𝗰𝘁𝗹𝘆!
 ━━━━━━━━━━━━━━━━━━━━━━
 """
-    bot.send_message(cid, welcome_msg, 
+    outbox.send_message(cid, welcome_msg, 
                      parse_mode="Markdown", 
                      reply_markup=main_menu_keyboard())
 
@@ -187,18 +3308,19 @@ def start(m):
 def admin_panel(m):
     cid = m.chat.id
     if str(cid) != str(MAIN_ADMIN_ID):
-        bot.send_message(cid, "❌ Only main admin can access this panel.")
+        outbox.send_message(cid, "❌ Only main admin can access this panel.")
         return
     
-    bot.send_message(cid, "🔐 *ADMIN PANEL*", 
+    outbox.send_message(cid, "🔐 *ADMIN PANEL*", 
                      parse_mode="Markdown", 
                      reply_markup=admin_keyboard())
 
 @bot.message_handler(commands=["status"])
+@offload
 def status_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        outbox.send_message(cid, "❌ Not authorized!")
         return
     
     status_msg = f"""
@@ -206,93 +3328,582 @@ def status_cmd(m):
 📊 𝗦𝗬𝗦𝗧𝗘𝗠 𝗦𝗧𝗔𝗧𝗨𝗦 📊
 ━━━━━━━━━━━━━━━━━━━━━━
 
-• 𝗔𝗰𝘁𝗶𝘃𝗲 𝗣𝗿𝗼𝗰𝗲𝘀𝘀𝗲𝘀: {len(processes)}
+• 𝗔𝗰𝘁𝗶𝘃𝗲 𝗣𝗿𝗼𝗰𝗲𝘀𝘀𝗲𝘀: {len(supervisor.running)} running, {len(supervisor.queue)} queued
 • 𝗔𝗰𝘁𝗶𝘃𝗲 𝗦𝗲𝘀𝘀𝗶𝗼𝗻𝘀: {len(active_sessions)}
+• 𝗦𝗲𝘀𝘀𝗶𝗼𝗻 𝗧𝗮𝗯𝗹𝗲𝘀: {" · ".join(f"{name} {n}" for name, n in sessions.counts().items())}
 • 𝗔𝗱𝗺𝗶𝗻𝘀: {len(admins)}
+• 𝗦𝗲𝗻𝗱 𝗤𝘂𝗲𝘂𝗲: {outbox.depth} queued, {outbox.stats['dropped']} dropped, {outbox.stats['retried']} retried
+• 𝗝𝗼𝗯 𝗟𝗶𝗺𝗶𝘁𝘀: {describe_limits(GLOBAL_LIMITS)}
 • 𝗕𝗮𝘀𝗲 𝗗𝗶𝗿𝗲𝗰𝘁𝗼𝗿𝘆: `{BASE_DIR}`
-
-📌 𝗥𝘂𝗻𝗻𝗶𝗻𝗴 𝗣𝗿𝗼𝗰𝗲𝘀𝘀𝗲𝘀:
 """
+    sample = sampler.latest()
+    status_msg += "\n🖥️ 𝗦𝘆𝘀𝘁𝗲𝗺:"
+    if sample["cpu"] is not None:
+        status_msg += f"\n• 𝗖𝗣𝗨: {sample['cpu']:.0f}% `{sparkline(sampler.history('cpu')[-20:])}`"
+    if sample["load"]:
+        status_msg += f"\n• 𝗟𝗼𝗮𝗱: {' '.join(f'{v:.2f}' for v in sample['load'])}"
+    if sample["mem_used"] is not None:
+        mem = [used and 100 * used / sample["mem_total"] for used in sampler.history("mem_used")[-20:]]
+        status_msg += (f"\n• 𝗠𝗲𝗺𝗼𝗿𝘆: {human_size(sample['mem_used'])} / {human_size(sample['mem_total'])} "
+                       f"`{sparkline(mem)}`")
+    if sample["disk_used"] is not None:
+        status_msg += f"\n• 𝗗𝗶𝘀𝗸: {human_size(sample['disk_used'])} / {human_size(sample['disk_total'])}"
+    if sample["bot_rss"] is not None:
+        bot_cpu = f"{sample['bot_cpu']:.1f}% CPU · " if sample["bot_cpu"] is not None else ""
+        status_msg += f"\n• 𝗕𝗼𝘁: {bot_cpu}{human_size(sample['bot_rss'])}"
+    status_msg += "\n"
+    measured = [job for job in list(supervisor.history) if job.usage]
+    if measured:
+        status_msg += "\n🔥 𝗛𝗲𝗮𝘃𝗶𝗲𝘀𝘁 𝗝𝗼𝗯𝘀:"
+        heaviest = sorted(measured, key=lambda j: (j.usage["user"] + j.usage["sys"], j.usage["maxrss"]), reverse=True)
+        for job in heaviest[:3]:
+            status_msg += f"\n• #{job.job_id} {job.describe_usage()} — `{job.cmd[:30].replace('`', '')}`"
+        status_msg += "\n"
+    status_msg += "\n📌 𝗥𝘂𝗻𝗻𝗶𝗻𝗴 𝗣𝗿𝗼𝗰𝗲𝘀𝘀𝗲𝘀:\n"
+    running = sorted(((job, fg_id) for (_, _), (jobs, fg_id) in registry.snapshot().items() for job in jobs),
+                     key=lambda item: item[0].job_id)
+    for job, fg_id in running[:20]:
+        marker = "⭐" if job.job_id == fg_id else "▫️"
+        where = f"@{job.node}".replace("_", "\\_") if job.node else ""
+        load = ""
+        if job.job_id in sample["jobs"]:
+            cpu, rss, count = sample["jobs"][job.job_id]
+            load = f" · {cpu or 0:.0f}% · {human_size(rss)}" + (f" · {count} procs" if count > 1 else "")
+        status_msg += f"\n{marker} #{job.job_id}{where} {job.status}{load} · chat {job.chat_id} — `{job.cmd[:40].replace('`', '')}`"
+    if not running:
+        status_msg += "\n📭 None"
+    elif len(running) > 20:
+        status_msg += f"\n… and {len(running) - 20} more"
     
-    bot.send_message(cid, status_msg, parse_mode="Markdown")
+    outbox.send_message(cid, status_msg, parse_mode="Markdown")
 
 @bot.message_handler(commands=["sessions"])
 def sessions_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        outbox.send_message(cid, "❌ Not authorized!")
         return
     
     sessions_msg = "🔄 *ACTIVE SESSIONS*\n"
-    sess_dict = active_sessions.get(MAIN_ADMIN_ID, {})
-    for chat_id, last_active in sess_dict.items():
+    for (admin_id, chat_id), last_active in active_sessions.items():
+        if admin_id != MAIN_ADMIN_ID:
+            continue
         elapsed = int(time.time() - last_active)
         sessions_msg += f"\n👤 {chat_id}: {elapsed}s ago"
     
-    bot.send_message(cid, sessions_msg, parse_mode="Markdown")
+    outbox.send_message(cid, sessions_msg, parse_mode="Markdown")
 
 @bot.message_handler(commands=["stop"])
 def stop_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        outbox.send_message(cid, "❌ Not authorized!")
         return
     
-    proc_dict = processes.get(MAIN_ADMIN_ID, {})
-    if cid in proc_dict:
-        pid, fd, _, _ = proc_dict[cid]
-        try:
-            os.kill(pid, signal.SIGTERM)
-            time.sleep(0.5)
-            os.kill(pid, signal.SIGKILL)
-        except:
-            pass
-        
-        proc_dict.pop(cid, None)
-        input_wait.get(MAIN_ADMIN_ID, {}).pop(cid, None)
-        active_sessions.get(MAIN_ADMIN_ID, {}).pop(cid, None)
-        
-        bot.send_message(cid, "✅ Process stopped successfully!")
+    job = foreground_job(MAIN_ADMIN_ID, cid)
+    if job is not None:
+        registry.drop_input(MAIN_ADMIN_ID, cid)
+        stop_job(cid, job)
     else:
-        bot.send_message(cid, "⚠️ No running process to stop.")
-        
+        outbox.send_message(cid, "⚠️ No running process to stop.")
+
+def stop_job(cid, job):
+    """
+    SIGTERM now, SIGKILL after KILL_GRACE from the multiplexer's timer.
+    The chat sees "stopping" until the job has really ended.
+    """
+    notice = outbox.send_message(cid, f"🛑 Stopping job #{job.job_id}...")
+
+    def say(text):
+        def edit(sent):
+            try:
+                message_id = sent.result().message_id
+            except Exception:
+                return
+            outbox.edit_message_text(text, cid, message_id, priority=PRIO_INTERACTIVE)
+        notice.add_done_callback(edit)
+
+    if supervisor.terminate(job):
+        supervisor.when_done(job, lambda job: say(f"✅ Job #{job.job_id} stopped: {job.describe_exit()}"))
+    elif job.ended is not None or job.status not in ("running", "stopping"):
+        say(f"⚠️ Job #{job.job_id} already finished")
+    else:
+        where = f", node {job.node} is offline" if job.node else ""
+        say(f"❌ Could not signal job #{job.job_id}{where}")
+
+def parse_job_id(m):
+    args = m.text.strip().split()
+    if len(args) < 2:
+        return None
+    try:
+        return int(args[1].lstrip("#"))
+    except ValueError:
+        return None
+
+@bot.message_handler(commands=["jobs"])
+def jobs_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    jobs = chat_jobs(MAIN_ADMIN_ID, cid)
+    fg_id = getattr(foreground_job(MAIN_ADMIN_ID, cid), "job_id", None)
+    jobs_msg = "⚙️ *JOBS*\n"
+    for job in sorted(jobs.values(), key=lambda j: j.job_id):
+        marker = "⭐" if job.job_id == fg_id else "▫️"
+        state = f"{job.status} {int(job.duration)}s" if job.started else f"queued, prio {job.priority}"
+        jobs_msg += f"\n{marker} #{job.job_id} {state} — `{job.cmd[:40].replace('`', '')}`"
+    if not jobs:
+        jobs_msg += "\n📭 No running jobs"
+
+    finished = [job for job in supervisor.history if job.chat_id == cid][-5:]
+    if finished:
+        jobs_msg += "\n\n🗂 *RECENT*"
+        for job in finished:
+            usage = f" · {job.describe_usage()}" if job.usage else ""
+            jobs_msg += f"\n#{job.job_id} {job.describe_exit()} · {job.duration:.1f}s{usage} — `{job.cmd[:40].replace('`', '')}`"
+
+    outbox.send_message(cid, jobs_msg, parse_mode="Markdown")
+
+@bot.message_handler(commands=["fg"])
+def fg_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    job_id = parse_job_id(m)
+    jobs = chat_jobs(MAIN_ADMIN_ID, cid)
+    if job_id is None and jobs:
+        job_id = max(jobs)  # Most recent job
+    job = find_job(MAIN_ADMIN_ID, cid, job_id) if job_id is not None else None
+    if job is None or job.chat_id != cid:
+        outbox.send_message(cid, "⚠️ No such job in this chat. Usage: /fg <id>")
+        return
+
+    if job.console is None:
+        outbox.send_message(cid, f"⚠️ Job #{job.job_id} is part of an /all run and has no console.")
+        return
+
+    set_foreground(MAIN_ADMIN_ID, cid, job)
+    job.input_attached = True
+    outbox.send_message(cid, f"⭐ Job #{job.job_id} in foreground, messages now go to its input. /bg to detach.")
+
+@bot.message_handler(commands=["bg"])
+def bg_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    if foreground_job(MAIN_ADMIN_ID, cid) is None:
+        outbox.send_message(cid, "⚠️ No foreground job.")
+        return
+    registry.drop_input(MAIN_ADMIN_ID, cid)
+    set_foreground(MAIN_ADMIN_ID, cid, None)
+
+@bot.message_handler(commands=["kill"])
+def kill_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    job_id = parse_job_id(m)
+    job = find_job(MAIN_ADMIN_ID, cid, job_id) if job_id is not None else None
+    if job is None:
+        outbox.send_message(cid, "⚠️ No such job. Usage: /kill <id>")
+        return
+
+    stop_job(cid, job)
+
+@bot.message_handler(commands=["run"])
+def run_job_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    cmd = args[1] if len(args) > 1 else ""
+    priority = JOB_DEFAULT_PRIORITY
+    limits = {}
+    try:
+        while cmd.startswith("-"):
+            flag, value, *rest = cmd.split(maxsplit=2) + [""]
+            if flag == "-p":
+                if not value.isdigit():
+                    raise ValueError("priority is 0-9")
+                priority = min(int(value), 9)
+            elif flag.startswith("--"):
+                limits[flag[2:]] = limit_value(flag[2:], value)
+            else:
+                break
+            cmd = rest[0]
+    except ValueError as e:
+        outbox.send_message(cid, f"❌ {e}")
+        return
+    if not cmd:
+        outbox.send_message(cid, "Usage: /run [-p 0-9] [--cpu S] [--mem MB] [--fsize MB] [--nofile N] "
+                                 "[--nice N] [--ionice idle|0-7] <command>")
+        return
+
+    start_job(cid, cmd, m.from_user.id, priority, chat_node(cid), limits)
+
+def chat_node(cid):
+    """Agent node selected with /node, None for this host."""
+    return store.get_pref(cid, "node")
+
+def start_job(cid, cmd, owner, priority=JOB_DEFAULT_PRIORITY, node=None, limits=None):
+    """Queue cmd for the chat and announce it; returns the job, None if it could not be queued."""
+    if node is not None and node_hub.get(node) is None:
+        outbox.send_message(cid, f"❌ Node {node} is offline. /node to pick another one.")
+        return None
+    try:
+        job, position = run_cmd(cmd, MAIN_ADMIN_ID, cid, owner, priority, node, limits)
+    except JobQueueFull:
+        outbox.send_message(cid, f"❌ Job queue is full ({JOB_QUEUE_MAX} waiting), try again later.")
+        return None
+
+    where = f"@{node}" if node else ""
+    outbox.send_message(cid, f"```\n[#{job.job_id}{where}] $ {cmd}\n```", parse_mode="Markdown")
+    if position:
+        outbox.send_message(cid, f"⏳ Job #{job.job_id} queued at position {position} ({MAX_JOBS} running max)")
+    return job
+
+@bot.message_handler(commands=["history"])
+@offload
+def history_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split()
+    limit = min(int(args[1]), 50) if len(args) > 1 and args[1].isdigit() else 15
+    rows = store.query(
+        "SELECT jobs.*, outputs.size FROM jobs "
+        "LEFT JOIN outputs ON outputs.job_id = jobs.job_id "
+        "WHERE jobs.chat_id = ? AND jobs.ended IS NOT NULL ORDER BY jobs.job_id DESC LIMIT ?", (cid, limit))
+    if not rows:
+        outbox.send_message(cid, "📭 No finished jobs in this chat yet.")
+        return
+
+    lines = ["🕘 <b>HISTORY</b>", ""]
+    for *row, size in reversed(rows):
+        job = Job.restore(row)
+        when = datetime.fromtimestamp(job.ended).strftime("%m-%d %H:%M")
+        stored = f" · {human_size(size)}" if size is not None else ""
+        where = f"@{job.node}" if job.node else ""
+        lines.append(f"#{job.job_id}{where} {when} {job.describe_exit()} · {job.duration:.1f}s{stored}\n"
+                     f"<code>{html.escape(job.cmd[:80])}</code>")
+    lines.append("\n/rerun id · /grep text")
+    outbox.send_message(cid, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=["rerun"])
+@offload
+def rerun_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    job_id = parse_job_id(m)
+    rows = store.query("SELECT cmd, priority, node FROM jobs WHERE job_id = ? AND chat_id = ?",
+                       (job_id, cid)) if job_id is not None else []
+    if not rows:
+        outbox.send_message(cid, "⚠️ No such job in this chat. Usage: /rerun <id>")
+        return
+
+    cmd, priority, node = rows[0]
+    start_job(cid, cmd, m.from_user.id, priority, node)
+
+@bot.message_handler(commands=["limits"])
+def limits_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split()
+    if len(args) == 1:
+        own = store.get_pref(m.from_user.id, "limits") or {}
+        outbox.send_message(cid, "📏 *JOB LIMITS*\n\n"
+                                 f"• Global: {describe_limits(GLOBAL_LIMITS)}\n"
+                                 f"• Yours: {describe_limits(own)}\n"
+                                 f"• Effective: {describe_limits(effective_limits(m.from_user.id))}\n\n"
+                                 "Tighten per job with /run --cpu S --mem MB ...", parse_mode="Markdown")
+        return
+
+    if str(cid) != str(MAIN_ADMIN_ID):
+        outbox.send_message(cid, "❌ Only main admin can set limits.")
+        return
+    if not args[1].lstrip("-").isdigit() or len(args) < 3:
+        outbox.send_message(cid, "Usage: /limits <user_id> cpu=S mem=MB fsize=MB nofile=N nice=N ionice=idle|0-7, "
+                                 "or /limits <user_id> off")
+        return
+    user_id = int(args[1])
+    if args[2] == "off":
+        store.set_pref(user_id, "limits", None)
+        outbox.send_message(cid, f"✅ Limits of {user_id} removed.")
+        return
+    limits = store.get_pref(user_id, "limits") or {}
+    try:
+        for arg in args[2:]:
+            key, _, value = arg.partition("=")
+            limits[key] = limit_value(key, value)
+    except ValueError as e:
+        outbox.send_message(cid, f"❌ {e}")
+        return
+    limits = {key: value for key, value in limits.items() if value}
+    store.set_pref(user_id, "limits", limits or None)
+    outbox.send_message(cid, f"✅ Limits of {user_id}: {describe_limits(limits)}")
+
+SINCE_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+@bot.message_handler(commands=["grep"])
+@offload
+def grep_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    usage = "Usage: /grep [-e] [--since 30m|6h|7d] <text>\n-e treats the text as a regular expression."
+    args = m.text.strip().split(maxsplit=1)
+    rest = args[1] if len(args) > 1 else ""
+    regex, since = False, 0
+    while rest.startswith("-"):
+        option, _, rest = rest.partition(" ")
+        if option == "-e":
+            regex = True
+        elif option == "--since":
+            value, _, rest = rest.partition(" ")
+            if len(value) < 2 or value[-1] not in SINCE_UNITS or not value[:-1].isdigit():
+                rest = ""
+                break
+            since = time.time() - int(value[:-1]) * SINCE_UNITS[value[-1]]
+        else:
+            rest = ""
+            break
+        rest = rest.lstrip()
+    if not rest:
+        outbox.send_message(cid, usage)
+        return
+
+    try:
+        matches = history_log.grep(cid, rest, since, regex)
+    except re.error as e:
+        outbox.send_message(cid, f"❌ Bad pattern: {e}")
+        return
+    if not matches:
+        outbox.send_message(cid, "🔍 No matches.")
+        return
+
+    body, last_job = "", None
+    for job_id, cmd, line in matches:
+        entry = f"<code>{html.escape(line[:200])}</code>\n"
+        if job_id != last_job:
+            entry = f"<b>#{job_id}</b> $ {html.escape(cmd[:60])}\n" + entry
+            last_job = job_id
+        if len(body) + len(entry) > CONSOLE_LIMIT - 100:
+            break
+        body += entry
+    outbox.send_message(cid, f"🔍 <b>{len(matches)} match(es)</b>\n\n{body}", parse_mode="HTML")
+
+@bot.message_handler(commands=["node"])
+def node_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) > 1:
+        name = args[1].strip()
+        if name == "local":
+            store.set_pref(cid, "node", None)
+            outbox.send_message(cid, "🖥️ Commands now run on this host.")
+        elif node_hub.get(name) is None:
+            outbox.send_message(cid, f"❌ No node named {name} is connected. /node lists them.")
+        else:
+            store.set_pref(cid, "node", name)
+            outbox.send_message(cid, f"🔗 Commands now run on node {name}. /node local to go back.")
+        return
+
+    selected = chat_node(cid)
+    running = {}
+    for job in supervisor.running.copy().values():
+        running[job.node] = running.get(job.node, 0) + 1
+    lines = ["🌐 *NODES*", ""]
+    lines.append(f"{'▫️' if selected else '⭐'} local — this host · {running.get(None, 0)} jobs")
+    for name, link in sorted(node_hub.nodes.copy().items()):
+        marker = "⭐" if name == selected else "▫️"
+        lines.append(f"{marker} {name} — {link.host} · up {int(time.time() - link.connected)}s · "
+                     f"{running.get(name, 0)} jobs".replace("_", "\\_"))
+    if selected and node_hub.get(selected) is None:
+        lines.append(f"⚠️ {selected} (selected) is offline".replace("_", "\\_"))
+    if node_hub.server is None:
+        lines.append("\nℹ️ Set NODE\\_LISTEN and NODE\\_TOKEN to let agents connect.")
+    lines.append("\n/node name · /all command")
+    outbox.send_message(cid, "\n".join(lines), parse_mode="Markdown")
+
+@bot.message_handler(commands=["all"])
+def all_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) < 2:
+        outbox.send_message(cid, "Usage: /all <command> — runs it on this host and every connected node")
+        return
+    FanOut(cid, args[1], ["local"] + sorted(node_hub.nodes)).start(MAIN_ADMIN_ID, m.from_user.id)
+
 @bot.message_handler(commands=["nano"])
+@offload
 def nano_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        outbox.send_message(cid, "❌ Not authorized!")
         return
 
     args = m.text.strip().split(maxsplit=1)
     if len(args) < 2:
-        bot.send_message(cid, "Usage: /nano <filename>")
+        outbox.send_message(cid, "Usage: /nano <filename>")
         return
 
     filename = args[1].strip()
     path = os.path.join(BASE_DIR, filename)
 
-    # Agar file exist nahi karti to create karo
-    if not os.path.exists(path):
-        open(path, 'w').close()
+    # Agar file exist nahi karti to create karo
+    if not os.path.exists(path):
+        open(path, 'w').close()
+
+    outbox.send_message(
+    cid,
+    f"📝 *EDIT FILE*\n\n*File:* `{filename}`\n*Path:* `{path}`",
+    parse_mode="Markdown",
+    reply_markup=file_actions_markup(cid, path)
+)
+
+@bot.message_handler(commands=["get"])
+def get_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) < 2:
+        outbox.send_message(cid, "Usage: /get <file or directory> — directories arrive as .tar.gz")
+        return
+    path = resolve_path(args[1])
+    if path is None:
+        outbox.send_message(cid, "❌ Outside the base directory")
+        return
+    if not os.path.exists(path):
+        outbox.send_message(cid, f"❌ No such file: `{args[1]}`", parse_mode="Markdown")
+        return
+
+    def run():
+        try:
+            if os.path.isdir(path):
+                send_tree(cid, path)
+            else:
+                send_file(cid, path)
+        except Exception as e:
+            outbox.send_message(cid, f"❌ Sending {os.path.basename(path)} failed: {e}")
+
+    outbox.send_message(cid, f"📤 Sending {os.path.relpath(path, BASE_DIR)}...")
+    transfers.submit(run)
+
+@bot.message_handler(commands=["put"])
+def put_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split()[1:]
+    expected = args.pop() if args and re.fullmatch(r"[0-9a-fA-F]{64}", args[-1]) else None
+    dest = resolve_path(" ".join(args) or ".")
+    if dest is None:
+        outbox.send_message(cid, "❌ Outside the base directory")
+        return
+    uploads[cid] = (dest, expected and expected.lower())
+    outbox.send_message(cid, f"📥 Send the file now, it will be saved to `{os.path.relpath(dest, BASE_DIR)}`"
+                             + (" and checked against the sha256" if expected else ""), parse_mode="Markdown")
+
+@bot.message_handler(content_types=["document"])
+def document_upload(m):
+    """A document after /put, or with a "/put [path] [sha256]" caption, is saved under BASE_DIR."""
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ You are not authorized to use this bot.")
+        return
+
+    caption = (m.caption or "").strip()
+    if caption.startswith("/put"):
+        args = caption.split()[1:]
+        expected = args.pop().lower() if args and re.fullmatch(r"[0-9a-fA-F]{64}", args[-1]) else None
+        dest = resolve_path(" ".join(args) or ".")
+        if dest is None:
+            outbox.send_message(cid, "❌ Outside the base directory")
+            return
+    else:
+        pending = uploads.pop(cid, None)
+        if pending is None:
+            outbox.send_message(cid, "ℹ️ Send /put [path] first, or put \"/put [path]\" in the caption.")
+            return
+        dest, expected = pending
+    if os.path.isdir(dest) or dest.endswith(os.sep):
+        dest = os.path.join(dest, os.path.basename(m.document.file_name or f"upload-{m.message_id}"))
+
+    def run():
+        try:
+            size, digest = receive_file(cid, m.document, dest, expected)
+        except Exception as e:
+            outbox.send_message(cid, f"❌ Upload to {os.path.relpath(dest, BASE_DIR)} failed: {e}")
+            return
+        outbox.send_message(cid, f"✅ Saved `{os.path.relpath(dest, BASE_DIR)}` ({human_size(size)})\n"
+                                 f"sha256 `{digest}`" + (" ✔️ verified" if expected else ""), parse_mode="Markdown")
+
+    transfers.submit(run)
 
-    sid = str(uuid.uuid4())
-    edit_sessions[sid] = {"file": path, "admin_id": cid}
+@bot.message_handler(commands=["term"])
+def term_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        outbox.send_message(cid, "❌ Not authorized!")
+        return
+    if sock is None:
+        outbox.send_message(cid, "❌ The browser terminal needs flask-sock: pip install flask-sock")
+        return
 
-    # Direct link using Render domain
-    link = f"https://elite-vps-bot-try-hu7.onrender.com/edit/{sid}?admin_id={cid}"
+    job_id = parse_job_id(m)
+    if job_id is not None:
+        job = find_job(MAIN_ADMIN_ID, cid, job_id)
+        if job is None or job.chat_id != cid or job.ended is not None:
+            outbox.send_message(cid, "⚠️ No such running job in this chat. Usage: /term [id]")
+            return
+        if job.console is None:
+            outbox.send_message(cid, f"⚠️ Job #{job.job_id} is part of an /all run and has no terminal.")
+            return
+    else:
+        # A fresh shell that lives in the browser; the chat only hears when it exits
+        job = start_job(cid, "bash -i", m.from_user.id, node=chat_node(cid))
+        if job is None:
+            return
+        set_foreground(MAIN_ADMIN_ID, cid, None)
 
+    sid = new_term_session(job, cid)
     markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton("✏️ Edit in Browser", url=link),
-        types.InlineKeyboardButton("📄 View Content", callback_data=f"view_{filename}")
-    )
-
-    bot.send_message(
-    cid,
-    f"📝 *EDIT FILE*\n\n*File:* `{filename}`\n*Path:* `{path}`",
-    parse_mode="Markdown",
-    reply_markup=markup
-)
+    markup.add(types.InlineKeyboardButton("🖥️ Open Terminal", url=f"{PUBLIC_URL}/term/{sid}?admin_id={cid}"))
+    outbox.send_message(cid, f"🖥️ Browser terminal for job #{job.job_id}. Closing the page detaches, "
+                             "the link reattaches while the job runs.", reply_markup=markup)
 
 @bot.message_handler(func=lambda m: True)
 def shell(m):
@@ -300,16 +3911,25 @@ def shell(m):
     text = m.text.strip()
     
     if not is_admin(cid):
-        bot.send_message(cid, "❌ You are not authorized to use this bot.")
+        outbox.send_message(cid, "❌ You are not authorized to use this bot.")
+        return
+    
+    # Answer to a prompt such as "Send the user ID..."
+    step = next_steps.pop(cid, None)
+    if step is not None:
+        step(m)
         return
     
     # Update session activity
-    active_sessions.setdefault(MAIN_ADMIN_ID, {})[cid] = time.time()
+    touch_session(MAIN_ADMIN_ID, cid)
     
     # Handle input response
-    if cid in input_wait.get(MAIN_ADMIN_ID, {}):
-        fd = input_wait[MAIN_ADMIN_ID].pop(cid)
-        os.write(fd, (text + "\n").encode())
+    job = registry.claim_input(MAIN_ADMIN_ID, cid)
+    if job is not None and job.status == "running":
+        try:
+            job.write_input((text + "\n").encode())
+        except OSError as e:
+            outbox.send_message(cid, f"⚠️ Cannot write to job #{job.job_id}: {e}")
         return
     
     # Quick command mapping
@@ -317,7 +3937,7 @@ def shell(m):
         "📁 ls": "ls -la",
         "📂 pwd": "pwd",
         "💿 df -h": "df -h",
-        "📊 top": "top -b -n 1 | head -20",
+        "📊 top": "top -b -n 1",
         "📜 ps aux": "ps aux | head -15",
         "🗑️ clear": None,
         "🛑 stop": None,
@@ -328,29 +3948,22 @@ def shell(m):
     
     if text in quick_map:
         if text == "🗑️ clear":
-            bot.send_message(cid, "🗑️ Chat cleared (bot-side)")
+            outbox.send_message(cid, "🗑️ Chat cleared (bot-side)")
             return
         elif text == "🛑 stop":
             stop_cmd(m)
             return
         elif text == "📝 nano":
-            bot.send_message(cid, "Usage: /nano filename")
+            outbox.send_message(cid, "Usage: /nano filename")
+            return
+        elif quick_map[text] in QUICK_CACHE_TTL:
+            send_quick(cid, quick_map[text])
             return
         else:
             text = quick_map[text]
     
-    # Stop any existing process
-    proc_dict = processes.setdefault(MAIN_ADMIN_ID, {})
-    if cid in proc_dict:
-        pid, fd, _, _ = proc_dict[cid]
-        try:
-            os.kill(pid, signal.SIGTERM)
-        except:
-            pass
-        proc_dict.pop(cid, None)
-    
-    bot.send_message(cid, f"```\n$ {text}\n```", parse_mode="Markdown")
-    run_cmd(text, MAIN_ADMIN_ID, cid)
+    # Any running job keeps going in the background
+    start_job(cid, text, m.from_user.id, node=chat_node(cid))
 
 # ================= CALLBACK HANDLERS =================
 
@@ -359,89 +3972,95 @@ def callback_handler(call):
     cid = call.message.chat.id
     
     if not is_admin(cid):
-        bot.answer_callback_query(call.id, "❌ Not authorized!")
+        outbox.answer_callback_query(call.id, "❌ Not authorized!")
         return
     
     # Scoped dicts
-    proc_dict = processes.setdefault(MAIN_ADMIN_ID, {})
-    sess_dict = active_sessions.setdefault(MAIN_ADMIN_ID, {})
-    input_dict = input_wait.setdefault(MAIN_ADMIN_ID, {})
 
     # ---------- STATUS ----------
     if call.data == "status":
         status_cmd(call.message)
-        bot.answer_callback_query(call.id)
+        outbox.answer_callback_query(call.id)
     
     # ---------- STOP ALL ----------
     elif call.data == "stop_all":
         if str(cid) != str(MAIN_ADMIN_ID):
-            bot.answer_callback_query(call.id, "❌ Main admin only!")
+            outbox.answer_callback_query(call.id, "❌ Main admin only!")
             return
         
         stopped = 0
-        for chat_id, (pid, fd, start_time, cmd) in list(proc_dict.items()):
-            try:
-                os.kill(pid, signal.SIGKILL)
+        for job in registry.admin_jobs(MAIN_ADMIN_ID):
+            if supervisor.terminate(job, signal.SIGKILL):
                 stopped += 1
-            except:
-                pass
         
-        proc_dict.clear()
-        input_dict.clear()
-        sess_dict.clear()
+        for admin_id, chat in input_wait.keys():
+            if admin_id == MAIN_ADMIN_ID:
+                registry.drop_input(admin_id, chat)
+        for admin_id, chat in active_sessions.keys():
+            if admin_id == MAIN_ADMIN_ID:
+                drop_session(admin_id, chat)
         
-        bot.answer_callback_query(call.id, f"✅ Stopped {stopped} processes")
-        bot.send_message(cid, f"🛑 Stopped all {stopped} processes")
+        outbox.answer_callback_query(call.id, f"✅ Stopped {stopped} processes")
+        outbox.send_message(cid, f"🛑 Stopped all {stopped} processes")
     
     # ---------- ADMIN LIST ----------
     elif call.data == "admin_list":
         admin_list_text = "\n".join([f"👤 {a}" for a in sorted(admins)])
-        bot.answer_callback_query(call.id)
-        bot.send_message(cid, f"*ADMIN LIST:*\n{admin_list_text}", parse_mode="Markdown")
+        outbox.answer_callback_query(call.id)
+        outbox.send_message(cid, f"*ADMIN LIST:*\n{admin_list_text}", parse_mode="Markdown")
     
     # ---------- ADD ADMIN ----------
     elif call.data == "add_admin":
-        msg = bot.send_message(cid, "Send the user ID to add as admin:")
-        bot.register_next_step_handler(msg, add_admin_step)
-        bot.answer_callback_query(call.id)
+        outbox.send_message(cid, "Send the user ID to add as admin:")
+        next_steps[cid] = add_admin_step
+        outbox.answer_callback_query(call.id)
     
     # ---------- REMOVE ADMIN ----------
     elif call.data == "remove_admin":
-        msg = bot.send_message(cid, "Send the user ID to remove from admins:")
-        bot.register_next_step_handler(msg, remove_admin_step)
-        bot.answer_callback_query(call.id)
+        outbox.send_message(cid, "Send the user ID to remove from admins:")
+        next_steps[cid] = remove_admin_step
+        outbox.answer_callback_query(call.id)
     
     # ---------- LIST FILES ----------
     elif call.data == "list_files":
-        try:
-            files = os.listdir(BASE_DIR)
-            file_list = "\n".join([f"📄 {f}" for f in files[:20]])
-            if len(files) > 20:
-                file_list += f"\n... and {len(files)-20} more"
-            bot.answer_callback_query(call.id)
-            bot.send_message(cid, f"*FILES IN {BASE_DIR}:*\n{file_list}", parse_mode="Markdown")
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Error: {e}")
+        browsers[cid] = BrowserState(os.path.abspath(BASE_DIR))
+        browsers[cid].sort = store.get_pref(cid, "browser_sort", "name")
+        outbox.answer_callback_query(call.id)
+        show_browser(cid)
+    
+    elif call.data.startswith("fb_"):
+        browser_callback(call)
+
+    # ---------- QUICK COMMANDS ----------
+    elif call.data.startswith("qc_"):
+        quick_callback(call)
     
     # ---------- CLEAN LOGS ----------
     elif call.data == "clean_logs":
-        current_time = time.time()
-        old_sessions = [chat for chat, last_active in list(sess_dict.items()) if current_time - last_active > 3600]
-        for chat in old_sessions:
-            sess_dict.pop(chat, None)
-        bot.answer_callback_query(call.id, "✅ Cleaned old sessions")
+        # Sessions idle past SESSION_TTL expire on their own; this drops the ones without jobs now
+        idle = [chat for admin_id, chat in active_sessions.keys()
+                if admin_id == MAIN_ADMIN_ID and not registry.jobs(admin_id, chat)]
+        for chat in idle:
+            drop_session(MAIN_ADMIN_ID, chat)
+        outbox.answer_callback_query(call.id, f"✅ Cleaned {len(idle)} idle sessions")
     
+    # ---------- FULL JOB LOG ----------
+    elif call.data.startswith("log_"):
+        log = spill_logs.get(call.data[4:])
+        if log is None:
+            outbox.answer_callback_query(call.id, "❌ Log no longer available")
+            return
+        outbox.answer_callback_query(call.id, "📦 Preparing log...")
+        send_spill_log(cid, log, f"job-{log.log_id}")
+
     # ---------- VIEW FILE CONTENT ----------
+    elif call.data.startswith("vw_"):
+        viewer_callback(call)
+
+    # Buttons sent before the viewer existed
     elif call.data.startswith("view_"):
-        filename = call.data[5:]
-        path = os.path.join(BASE_DIR, filename)
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read(1000)
-            bot.send_message(cid, f"```\n{content}\n```", parse_mode="Markdown")
-            bot.answer_callback_query(call.id)
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Cannot read file: {e}")
+        outbox.answer_callback_query(call.id)
+        show_viewer_page(cid, new_viewer(os.path.join(BASE_DIR, call.data[5:])), "o", 0)
 
 # ---------- ADD / REMOVE ADMIN STEPS ----------
 
@@ -452,10 +4071,10 @@ def add_admin_step(m):
     try:
         new_admin = int(m.text.strip())
         admins.add(new_admin)
-        save_data()
-        bot.send_message(cid, f"✅ Added admin: {new_admin}")
+        store.set_admin(new_admin, True)
+        outbox.send_message(cid, f"✅ Added admin: {new_admin}")
     except:
-        bot.send_message(cid, "❌ Invalid user ID")
+        outbox.send_message(cid, "❌ Invalid user ID")
 
 def remove_admin_step(m):
     cid = m.chat.id
@@ -465,12 +4084,12 @@ def remove_admin_step(m):
         admin_id = int(m.text.strip())
         if admin_id != MAIN_ADMIN_ID and admin_id in admins:
             admins.remove(admin_id)
-            save_data()
-            bot.send_message(cid, f"✅ Removed admin: {admin_id}")
+            store.set_admin(admin_id, False)
+            outbox.send_message(cid, f"✅ Removed admin: {admin_id}")
         else:
-            bot.send_message(cid, "❌ Cannot remove main admin or admin not found")
+            outbox.send_message(cid, "❌ Cannot remove main admin or admin not found")
     except:
-        bot.send_message(cid, "❌ Invalid user ID")
+        outbox.send_message(cid, "❌ Invalid user ID")
 
 def remove_admin_step(m):
     cid = m.chat.id
@@ -480,29 +4099,241 @@ def remove_admin_step(m):
     try:
         admin_id = int(m.text.strip())
     except ValueError:
-        bot.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
+        outbox.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
         return
 
     if admin_id == MAIN_ADMIN_ID:
-        bot.send_message(cid, "❌ Cannot remove the main admin.")
+        outbox.send_message(cid, "❌ Cannot remove the main admin.")
         return
 
     if admin_id in admins:
         admins.remove(admin_id)
-        save_data()
-        bot.send_message(cid, f"✅ Removed admin: {admin_id}")
+        store.set_admin(admin_id, False)
+        outbox.send_message(cid, f"✅ Removed admin: {admin_id}")
     else:
-        bot.send_message(cid, f"❌ Admin ID {admin_id} not found in the list.")
+        outbox.send_message(cid, f"❌ Admin ID {admin_id} not found in the list.")
 
-# ================= ENHANCED EDITOR =================
+# ================= FILE LINE INDEX =================
+
+class LineIndex:
+    """
+    Read-only mmap of a file plus the byte offset of every line start.
+    The offsets are discovered lazily, only as far as a caller asks, so
+    opening line 10 of a huge log does not scan the rest of it.
+    """
+
+    def __init__(self, path):
+        st = os.stat(path)
+        self.key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.mm = None
+        if self.size:
+            with open(path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = array("Q", [0])   # offsets[n] = first byte of line n
+        self.complete = self.size == 0
+        self.lock = threading.Lock()
+
+    def _scan(self, line=None, offset=None):
+        # Caller holds self.lock
+        pos = self.offsets[-1]
+        while not self.complete:
+            if line is not None and len(self.offsets) > line:
+                break
+            if offset is not None and pos > offset:
+                break
+            nl = self.mm.find(b"\n", pos)
+            if nl < 0 or nl + 1 >= self.size:
+                self.complete = True
+                break
+            pos = nl + 1
+            self.offsets.append(pos)
+
+    def line_offset(self, line):
+        """Byte offset where line `line` (0-based) starts, or the file size past EOF."""
+        with self.lock:
+            self._scan(line=line)
+            return self.offsets[line] if line < len(self.offsets) else self.size
+
+    def line_at(self, offset):
+        """Number of the line containing byte `offset`."""
+        with self.lock:
+            self._scan(offset=offset)
+            return bisect.bisect_right(self.offsets, offset) - 1
+
+    def line_count(self):
+        with self.lock:
+            self._scan()
+            return len(self.offsets) if self.size else 0
+
+    def known_line_at(self, offset):
+        """Like line_at, but None instead of scanning when the index hasn't reached `offset` yet."""
+        with self.lock:
+            if not self.complete and offset > self.offsets[-1]:
+                return None
+            return bisect.bisect_right(self.offsets, offset) - 1
+
+    def read(self, start, end):
+        return self.mm[start:end] if self.mm is not None else b""
+
+    def chunk(self, offset, length):
+        """Whole lines starting at `offset`, about `length` bytes; returns (start, end)."""
+        start = min(max(0, offset), self.size)
+        end = min(self.size, start + length)
+        if end < self.size:
+            nl = self.mm.rfind(b"\n", start, end)
+            if nl < 0:
+                # A single line longer than `length`: take all of it
+                nl = self.mm.find(b"\n", end)
+                nl = self.size - 1 if nl < 0 else nl
+            end = nl + 1
+        return start, end
+
+    def chunk_before(self, offset, length):
+        """Whole lines ending at `offset`, about `length` bytes; returns (start, end)."""
+        end = min(max(0, offset), self.size)
+        start = max(0, end - length)
+        if start > 0:
+            nl = self.mm.find(b"\n", start - 1, end)
+            start = end if nl < 0 or nl + 1 >= end else nl + 1
+            if start == end:
+                # A single line longer than `length`
+                start = self.mm.rfind(b"\n", 0, max(0, end - 1)) + 1
+        return start, end
+
+# abs path -> LineIndex; the mmap is closed once evicted and no reader holds it
+line_indexes = sessions.table("index", LINE_INDEX_TTL, LINE_INDEX_CACHE, sliding=True)
+
+def get_line_index(path):
+    """Cached LineIndex for path, rebuilt when inode, size or mtime change."""
+    st = os.stat(path)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    index = line_indexes.get(path)
+    if index is not None and index.key == key:
+        return index
+    index = LineIndex(path)
+    line_indexes[path] = index
+    return index
+
+# ================= FILE VIEWER =================
+
+viewers = sessions.table("viewer", VIEWER_TTL, VIEWER_KEEP, sliding=True)   # token -> abs path
+
+def new_viewer(path):
+    """Register a file for viewing; the short token keeps callback_data under 64 bytes."""
+    token = uuid.uuid4().hex[:10]
+    viewers[token] = os.path.abspath(path)
+    return token
+
+def viewer_page(index, how, arg):
+    """
+    (start, end) byte range of a page: "o" starts at offset arg, "b" ends
+    at offset arg, "t" is the tail. Pages are whole lines unless one line
+    alone is longer than a page.
+    """
+    if how == "b":
+        start, end = index.chunk_before(arg, VIEWER_PAGE_BYTES)
+        return max(start, end - VIEWER_PAGE_BYTES), end
+    if how == "t":
+        start, end = index.chunk_before(index.size, VIEWER_PAGE_BYTES)
+        return max(start, end - VIEWER_PAGE_BYTES), end
+    start, end = index.chunk(arg, VIEWER_PAGE_BYTES)
+    return start, min(end, start + VIEWER_PAGE_BYTES)
+
+def show_viewer_page(chat_id, token, how, arg, message_id=None):
+    """Send one page of a file, or replace the page shown in message_id."""
+    path = viewers.get(token)
+    if path is None:
+        outbox.send_message(chat_id, "❌ Viewer expired, open the file again")
+        return
+    if not inside_base_dir(path):
+        outbox.send_message(chat_id, "❌ Unauthorized file access")
+        return
+    try:
+        index = get_line_index(path)
+    except OSError as e:
+        outbox.send_message(chat_id, f"❌ Cannot read file: {e}")
+        return
+
+    # Only the page itself is read from the mapping
+    start, end = viewer_page(index, how, arg)
+    text = index.read(start, end).decode("utf-8", errors="replace")
+    line = index.known_line_at(start)
+    percent = end * 100 // index.size if index.size else 100
+    header = (f"📄 <b>{html.escape(os.path.relpath(path, BASE_DIR))}</b>\n"
+              f"bytes {start}–{end} of {index.size} ({percent}%)"
+              + (f" · line {line + 1}" if line is not None else ""))
+    body = f"{header}\n<pre>{html.escape(text) or '(empty)'}</pre>"
+
+    markup = types.InlineKeyboardMarkup(row_width=4)
+    nav = []
+    if start > 0:
+        nav += [types.InlineKeyboardButton("⏮ Head", callback_data=f"vw_{token}_o0"),
+                types.InlineKeyboardButton("◀️ Prev", callback_data=f"vw_{token}_b{start}")]
+    if end < index.size:
+        nav += [types.InlineKeyboardButton("Next ▶️", callback_data=f"vw_{token}_o{end}"),
+                types.InlineKeyboardButton("⏭ Tail", callback_data=f"vw_{token}_t")]
+    if nav:
+        markup.row(*nav)
+    markup.row(types.InlineKeyboardButton("🔢 Go to line", callback_data=f"vw_{token}_l"))
+
+    if message_id is None:
+        outbox.send_message(chat_id, body, parse_mode="HTML", reply_markup=markup)
+    else:
+        outbox.edit_message_text(body, chat_id, message_id, priority=PRIO_INTERACTIVE,
+                                 parse_mode="HTML", reply_markup=markup)
+
+def viewer_callback(call):
+    """vw_<token>_<how><arg>: o<offset> page from, b<offset> page before, t tail, l ask for a line."""
+    cid = call.message.chat.id
+    mid = call.message.message_id
+    token, _, action = call.data[3:].partition("_")
+    how, arg = action[:1], action[1:]
+    if token not in viewers:
+        outbox.answer_callback_query(call.id, "❌ Viewer expired, open the file again")
+        return
+
+    if how == "l":
+        outbox.answer_callback_query(call.id)
+        outbox.send_message(cid, "Send the line number to jump to:")
+
+        def goto_line_step(m):
+            try:
+                line = max(1, int(m.text.strip()))
+            except ValueError:
+                outbox.send_message(cid, "❌ Invalid line number")
+                return
+            path = viewers.get(token)
+            try:
+                index = get_line_index(path)
+            except (OSError, TypeError):
+                outbox.send_message(cid, "❌ Viewer expired, open the file again")
+                return
+            offset = index.line_offset(line - 1)
+            if offset >= index.size:
+                show_viewer_page(cid, token, "t", 0, mid)  # Past the last line
+            else:
+                show_viewer_page(cid, token, "o", offset, mid)
+
+        next_steps[cid] = goto_line_step
+        return
+
+    try:
+        arg = int(arg) if arg else 0
+    except ValueError:
+        outbox.answer_callback_query(call.id, "❌ Bad page")
+        return
+    outbox.answer_callback_query(call.id)
+    show_viewer_page(cid, token, how, arg, mid)
 
 # ================= ENHANCED EDITOR =================
 
-@app.route("/edit/<sid>", methods=["GET", "POST"])
-def edit(sid):
+def edit_session_path(sid):
+    """Validate an editor session for this request; returns (abs_path, error_html)."""
     # Check if session exists
-    if sid not in edit_sessions:
-        return """
+    session_data = edit_sessions.get(sid)  # None once expired
+    if session_data is None:
+        return None, """
         <html>
         <body style="background:#111;color:#fff;padding:20px;">
         <h2>❌ Invalid or expired session</h2>
@@ -510,14 +4341,13 @@ def edit(sid):
         </html>
         """
 
-    session_data = edit_sessions[sid]
     file = session_data.get("file")
     admin_id = session_data.get("admin_id")
 
     # Ensure only the assigned admin can access
     current_user_id = request.args.get("admin_id")
     if str(current_user_id) != str(admin_id):
-        return """
+        return None, """
         <html>
         <body style="background:#111;color:#f00;padding:20px;">
         <h2>❌ Unauthorized access</h2>
@@ -527,48 +4357,145 @@ def edit(sid):
 
     # Security: Ensure file is inside BASE_DIR
     abs_path = os.path.abspath(file)
-    if not abs_path.startswith(os.path.abspath(BASE_DIR)):
-        return """
+    if not inside_base_dir(abs_path):
+        return None, """
         <html>
         <body style="background:#111;color:#f00;padding:20px;">
         <h2>❌ Unauthorized file access</h2>
         </body>
         </html>
         """
+    return abs_path, None
 
-    if request.method == "POST":
-        try:
-            code_content = request.form.get("code", "")
-            with open(abs_path, "w", encoding='utf-8') as f:
-                f.write(code_content)
+@app.route("/edit/<sid>/chunk")
+def edit_chunk(sid):
+    """
+    Ranged read for the editor: ?offset=&len= returns whole lines from a
+    byte offset, ?before=&len= the lines ending there, ?line=N the lines
+    from line N on.
+    """
+    abs_path, error = edit_session_path(sid)
+    if error:
+        return jsonify(error="unauthorized"), 403
+    try:
+        index = get_line_index(abs_path)
+        length = min(int(request.args.get("len", EDITOR_CHUNK_BYTES)), 4 * EDITOR_CHUNK_BYTES)
+        if "before" in request.args:
+            start, end = index.chunk_before(int(request.args["before"]), length)
+        elif "line" in request.args:
+            start, end = index.chunk(index.line_offset(max(0, int(request.args["line"]))), length)
+        else:
+            start, end = index.chunk(int(request.args.get("offset", 0)), length)
+        return jsonify(
+            offset=start, next=end, size=index.size, version=file_version(index),
+            line=index.line_at(start) if start < index.size else None,
+            text=index.read(start, end).decode("utf-8", errors="replace"),
+            bof=start == 0, eof=end >= index.size,
+        )
+    except (OSError, ValueError) as e:
+        return jsonify(error=str(e)), 400
+
+def file_version(index):
+    """ETag of the file content an index maps (inode, size and mtime)."""
+    return "%x-%x-%x" % index.key
+
+def write_patched(path, index, patches):
+    """
+    Atomically replace `path` with its current content (as mapped by
+    `index`) with byte-range patches [(start, end, data)] applied: the
+    result goes to a temp file in the same directory, is fsynced and then
+    renamed over the original.
+    """
+    path = os.path.realpath(path)  # Keep symlinks pointing at the edited file
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            pos = 0
+            for start, end, data in patches + [(index.size, index.size, b"")]:
+                while pos < start:
+                    # Unchanged bytes are copied straight from the mmap, 1 MB at a time
+                    step = min(start, pos + 1024 * 1024)
+                    out.write(index.read(pos, step))
+                    pos = step
+                out.write(data)
+                pos = end
+            out.flush()
+            os.fsync(out.fileno())
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+save_lock = threading.Lock()
 
-            # Remove session after save
-            edit_sessions.pop(sid, None)
+@app.route("/edit/<sid>/save", methods=["POST"])
+def edit_save(sid):
+    """
+    Delta save: JSON {"patches": [{"start", "end", "text"}]} with byte
+    offsets into the version named by the If-Match header. Stale versions
+    get a 409 with the current version; success returns the new one.
+    """
+    abs_path, error = edit_session_path(sid)
+    if error:
+        return jsonify(error="unauthorized"), 403
+    payload = request.get_json(force=True, silent=True) or {}
+    try:
+        patches = sorted((int(p["start"]), int(p["end"]), p["text"].encode("utf-8"))
+                         for p in payload.get("patches", []))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify(error="malformed patches"), 400
 
-            return """
-            <html>
-            <body style="background:#111;color:#0f0;padding:20px;text-align:center;">
-            <h2>✅ File Saved Successfully!</h2>
-            <p>You can close this window.</p>
-            </body>
-            </html>
-            """
+    with save_lock:
+        try:
+            index = get_line_index(abs_path)
+        except OSError as e:
+            return jsonify(error=str(e)), 400
+        version = file_version(index)
+        if request.headers.get("If-Match", payload.get("version")) != version:
+            return jsonify(error="conflict", version=version), 409
+        pos = 0
+        for start, end, _ in patches:
+            if start < pos or end < start or end > index.size:
+                return jsonify(error="patches overlap or exceed the file"), 400
+            pos = end
+        try:
+            write_patched(abs_path, index, patches)
+            version = file_version(get_line_index(abs_path))
         except Exception as e:
-            return f"""
-            <html>
-            <body style="background:#111;color:#f00;padding:20px;">
-            <h2>❌ Error saving file: {e}</h2>
-            </body>
-            </html>
-            """
-
-    # GET request: load file content
+            return jsonify(error=f"Error saving file: {e}"), 500
+    return jsonify(ok=True, version=version)
+
+@app.route("/edit/<sid>")
+def edit(sid):
+    abs_path, error = edit_session_path(sid)
+    if error:
+        return error
+    file = edit_sessions[sid].get("file")
+
+    # Small files are inlined, big ones are fetched in chunks by the page
+    code = ""
+    chunked = False
+    size = 0
+    version = None
     try:
-        with open(abs_path, "r", encoding='utf-8') as f:
-            code = f.read()
+        index = get_line_index(abs_path)
+        size = index.size
+        version = file_version(index)
+        chunked = size > EDITOR_INLINE_LIMIT
+        if not chunked:
+            code = index.read(0, size).decode("utf-8", errors="replace")
     except Exception as e:
-        code = ""
         print(f"⚠️ Error reading file {abs_path}: {e}")
+    query = f"?admin_id={request.args.get('admin_id')}"
+    chunk_url = f"/edit/{sid}/chunk{query}"
+    save_url = f"/edit/{sid}/save{query}"
 
     return render_template_string("""
 <!DOCTYPE html>
@@ -637,6 +4564,29 @@ def edit(sid):
         }
 
         .btn-save:hover { background: #2ea043; }
+
+        .save-status {
+            align-self: center;
+            margin-right: 15px;
+            font-size: 13px;
+        }
+
+        .line-jump {
+            margin-right: auto;
+            display: flex;
+            gap: 8px;
+            align-items: center;
+            font-size: 13px;
+        }
+
+        .line-jump input {
+            width: 110px;
+            background: var(--bg-dark);
+            color: #c9d1d9;
+            border: 1px solid var(--border);
+            border-radius: 6px;
+            padding: 8px;
+        }
     </style>
 </head>
 <body>
@@ -652,14 +4602,19 @@ def edit(sid):
 
 <div id="editor">{{ code }}</div>
 
-<form id="saveForm" method="post">
-    <input type="hidden" name="code" id="hiddenCode">
-    <div class="footer">
+<div class="footer">
+        {% if chunked %}
+        <div class="line-jump">
+            <input type="number" id="jumpLine" min="1" placeholder="Line #">
+            <button type="button" onclick="jumpToLine()" class="btn-save">GO</button>
+            <span id="winInfo"></span>
+        </div>
+        {% endif %}
+        <span id="saveStatus" class="save-status"></span>
         <button type="button" onclick="saveData()" class="btn-save">
             <i class="fas fa-cloud-upload-alt"></i> SAVE CHANGES
         </button>
-    </div>
-</form>
+</div>
 
 <script>
     // Ace Editor Setup
@@ -686,16 +4641,639 @@ def edit(sid):
         tabSize: 4
     });
 
-    // Save Function
+    // Large files: only a window of the file is loaded, more is fetched while scrolling
+    var chunked = {{ 'true' if chunked else 'false' }};
+    var chunkUrl = {{ chunk_url|tojson }};
+    var saveUrl = {{ save_url|tojson }};
+    var version = {{ version|tojson }};        // ETag of the file the loaded text came from
+    var fileSize = {{ size }}, firstLine = 0;
+    var winStart = 0, winEnd = fileSize, atBof = true, atEof = true;
+    var origText = editor.getValue();          // loaded window as it is on disk
+    var loading = false, dirty = false, quiet = false;
+    var encoder = new TextEncoder();
+
+    function byteLen(text) { return encoder.encode(text).length; }
+
+    function setStatus(text) { document.getElementById('saveStatus').textContent = text; }
+
+    editor.on("change", function() { if (!quiet) dirty = true; });
+
+    // Text loaded from the server must not end up in the undo history
+    function withoutUndo(fn) {
+        var undo = editor.session.getUndoManager();
+        var rev = undo.startNewGroup ? undo.startNewGroup() : null;
+        quiet = true;
+        fn();
+        quiet = false;
+        if (rev !== null && undo.markIgnored) undo.markIgnored(rev);
+    }
+
+    function fetchChunk(params, done) {
+        loading = true;
+        fetch(chunkUrl + "&" + params)
+            .then(function(r) { return r.json(); })
+            .then(function(c) {
+                loading = false;
+                if (c.error) { alert("❌ " + c.error); return; }
+                fileSize = c.size;
+                if (version !== c.version) {
+                    if (dirty || !done.fresh) setStatus("⚠️ File changed on disk, reload before saving");
+                    version = c.version;
+                }
+                done(c);
+                document.getElementById('winInfo').textContent =
+                    "bytes " + winStart + "-" + winEnd + " of " + fileSize;
+            })
+            .catch(function(e) { loading = false; alert("❌ " + e); });
+    }
+
+    function setFirstLine(line) {
+        firstLine = line || 0;
+        editor.setOption("firstLineNumber", firstLine + 1);
+    }
+
+    function loadWindow(params, gotoLine) {
+        var done = function(c) {
+            withoutUndo(function() { editor.session.setValue(c.text); });
+            origText = c.text;
+            winStart = c.offset; winEnd = c.next; atBof = c.bof; atEof = c.eof;
+            dirty = false;
+            setFirstLine(c.line);
+            if (gotoLine) editor.gotoLine(gotoLine - firstLine, 0, false);
+        };
+        done.fresh = true;  // A new window may come from a newer version
+        fetchChunk(params, done);
+    }
+
+    function appendChunk() {
+        if (loading || atEof) return;
+        fetchChunk("offset=" + winEnd, function(c) {
+            var doc = editor.session.getDocument();
+            var last = doc.getLength() - 1;
+            withoutUndo(function() { doc.insert({row: last, column: doc.getLine(last).length}, c.text); });
+            origText += c.text;
+            winEnd = c.next; atEof = c.eof;
+        });
+    }
+
+    function prependChunk() {
+        if (loading || atBof) return;
+        fetchChunk("before=" + winStart, function(c) {
+            var rows = editor.session.getLength();
+            var top = editor.renderer.getFirstVisibleRow();
+            withoutUndo(function() { editor.session.getDocument().insert({row: 0, column: 0}, c.text); });
+            editor.renderer.scrollToRow(top + editor.session.getLength() - rows);
+            origText = c.text + origText;
+            winStart = c.offset; atBof = c.bof;
+            setFirstLine(c.line);
+        });
+    }
+
+    function jumpToLine() {
+        var line = parseInt(document.getElementById('jumpLine').value, 10);
+        if (!line || line < 1) return;
+        if (line > firstLine && line <= firstLine + editor.session.getLength()) {
+            editor.gotoLine(line - firstLine, 0, true);
+            return;
+        }
+        if (dirty && !confirm("Unsaved changes in the loaded part will be lost. Continue?")) return;
+        loadWindow("line=" + Math.max(0, line - 51), line);
+    }
+
+    if (chunked) {
+        editor.session.on("changeScrollTop", function() {
+            var r = editor.renderer;
+            if (r.getLastVisibleRow() >= editor.session.getLength() - 50) appendChunk();
+            else if (r.getFirstVisibleRow() < 20) prependChunk();
+        });
+        loadWindow("offset=0", null);
+    }
+
+    // Smallest byte range of the file that changed, as a patch
+    function makePatch(text) {
+        if (byteLen(origText) !== winEnd - winStart) {
+            // Loaded text doesn't map 1:1 onto the file's bytes: replace the whole window
+            return {start: winStart, end: winEnd, text: text};
+        }
+        var max = Math.min(text.length, origText.length);
+        var p = 0;
+        while (p < max && text.charCodeAt(p) === origText.charCodeAt(p)) p++;
+        var q = 0;
+        while (q < max - p && text.charCodeAt(text.length - 1 - q) === origText.charCodeAt(origText.length - 1 - q)) q++;
+        // Never split a surrogate pair
+        if (p > 0 && (origText.charCodeAt(p - 1) & 0xFC00) === 0xD800) p--;
+        if (q > 0 && (origText.charCodeAt(origText.length - q) & 0xFC00) === 0xDC00) q--;
+        if (p === origText.length && p === text.length) return null;
+        return {
+            start: winStart + byteLen(origText.slice(0, p)),
+            end: winEnd - byteLen(origText.slice(origText.length - q)),
+            text: text.slice(p, text.length - q)
+        };
+    }
+
+    // Save Function: sends only the changed range, the page stays open for more saves
     function saveData() {
-        document.getElementById('hiddenCode').value = editor.getValue();
-        document.getElementById('saveForm').submit();
+        var text = editor.getValue();
+        var patch = makePatch(text);
+        if (!patch) { setStatus("No changes"); return; }
+        setStatus("Saving...");
+        fetch(saveUrl, {
+            method: "POST",
+            headers: {"Content-Type": "application/json", "If-Match": version},
+            body: JSON.stringify({patches: [patch]})
+        })
+            .then(function(r) { return r.json().then(function(body) { return {status: r.status, body: body}; }); })
+            .then(function(res) {
+                if (res.status === 409) {
+                    setStatus("⚠️ File changed on disk since it was loaded, reload to get the latest version");
+                } else if (res.body.error) {
+                    setStatus("❌ " + res.body.error);
+                } else {
+                    version = res.body.version;
+                    origText = text;
+                    winEnd = winStart + byteLen(text);
+                    fileSize += byteLen(patch.text) - (patch.end - patch.start);
+                    dirty = false;
+                    setStatus("✅ Saved " + byteLen(patch.text) + " bytes");
+                }
+            })
+            .catch(function(e) { setStatus("❌ " + e); });
     }
 </script>
 
 </body>
 </html>
-""", code=code, file=file)
+""", code=code, file=file, chunked=chunked, chunk_url=chunk_url, save_url=save_url, version=version, size=size)
+
+# ================= BROWSER TERMINAL =================
+#
+# /term hands out a link like the editor's. The page runs xterm.js and
+# talks to a running job over a WebSocket: binary frames carry keystrokes
+# in and PTY output out, text frames carry JSON control messages
+# ({"resize": [cols, rows]} in, {"exit": "..."} out). Output is collected
+# per browser and sent in batches, so a flood of small PTY reads becomes
+# a few frames. Closing the page only detaches; the link reattaches and
+# replays the recent output while the job runs.
+
+class TermClient:
+    """Output buffer of one attached browser, drained by its socket's sender thread."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.buffer = bytearray()
+        self.closed = False     # the job ended or the socket went away
+        self.dropped = 0        # bytes discarded because the browser fell behind
+
+    def feed(self, data):
+        """Job output watcher: bytes, or None once the job has ended."""
+        with self.cond:
+            if data is None:
+                self.closed = True
+            else:
+                self.buffer += data
+                if len(self.buffer) > TERM_BUFFER_MAX:
+                    excess = len(self.buffer) - TERM_BUFFER_MAX
+                    del self.buffer[:excess]
+                    self.dropped += excess
+            self.cond.notify()
+
+    def close(self):
+        self.feed(None)
+
+    def next_batch(self):
+        """Wait for output and return it in one piece after TERM_BATCH_DELAY; None once closed and drained."""
+        with self.cond:
+            while not self.buffer and not self.closed:
+                self.cond.wait()
+            if not self.closed and len(self.buffer) < 64 * 1024:
+                self.cond.wait(TERM_BATCH_DELAY)   # Let the rest of a burst arrive
+            data, self.buffer = bytes(self.buffer), bytearray()
+            return data or None
+
+def new_term_session(job, admin_id):
+    """Link token for attaching a browser to job; returns its id."""
+    sid = str(uuid.uuid4())
+    term_sessions[sid] = {"admin_id": admin_id, "chat_id": job.chat_id, "job_id": job.job_id}
+    return sid
+
+def term_session_job(sid):
+    """The running job a terminal link points at, or (None, error text)."""
+    session = term_sessions.get(sid)
+    if session is None:
+        return None, "Invalid or expired session"
+    if str(request.args.get("admin_id")) != str(session["admin_id"]):
+        return None, "Unauthorized access"
+    job = find_job(MAIN_ADMIN_ID, session["chat_id"], session["job_id"])
+    if job is None or job.ended is not None:
+        return None, f"Job #{session['job_id']} has finished"
+    return job, None
+
+@app.route("/term/<sid>")
+def term_page(sid):
+    job, error = term_session_job(sid)
+    if error is None and sock is None:
+        error = "WebSocket support is missing: pip install flask-sock"
+    if error:
+        return f"""
+        <html>
+        <body style="background:#111;color:#f00;padding:20px;">
+        <h2>❌ {html.escape(error)}</h2>
+        </body>
+        </html>
+        """
+    return render_template_string("""
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Terminal | #{{ job_id }}</title>
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/xterm@5.3.0/css/xterm.css">
+    <script src="https://cdn.jsdelivr.net/npm/xterm@5.3.0/lib/xterm.js"></script>
+    <script src="https://cdn.jsdelivr.net/npm/xterm-addon-fit@0.8.0/lib/xterm-addon-fit.js"></script>
+    <style>
+        :root { --bg-dark: #0d1117; --accent: #58a6ff; --card-bg: #161b22; --border: #30363d; }
+        html, body { height: 100%; margin: 0; background: var(--bg-dark); color: #c9d1d9; font-family: 'Segoe UI', sans-serif; }
+        body { display: flex; flex-direction: column; }
+        .header {
+            background: var(--card-bg); padding: 8px 16px; display: flex; gap: 12px;
+            justify-content: space-between; align-items: center; border-bottom: 1px solid var(--border);
+        }
+        .cmd { font-family: monospace; color: var(--accent); overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+        #status { font-size: 13px; white-space: nowrap; }
+        button {
+            background: #21262d; color: #c9d1d9; border: 1px solid var(--border);
+            padding: 6px 14px; border-radius: 6px; cursor: pointer;
+        }
+        #terminal { flex: 1; min-height: 0; padding: 4px; }
+    </style>
+</head>
+<body>
+    <div class="header">
+        <span class="cmd">#{{ job_id }} $ {{ cmd }}</span>
+        <span id="status">connecting…</span>
+        <button id="toggle">Detach</button>
+    </div>
+    <div id="terminal"></div>
+<script>
+    const term = new Terminal({ cursorBlink: true, fontSize: 14, scrollback: 5000, theme: { background: "#0d1117" } });
+    const fit = new FitAddon.FitAddon();
+    term.loadAddon(fit);
+    term.open(document.getElementById("terminal"));
+    fit.fit();
+
+    const status = document.getElementById("status");
+    const toggle = document.getElementById("toggle");
+    const encoder = new TextEncoder();
+    const url = (location.protocol === "https:" ? "wss://" : "ws://") + location.host +
+                location.pathname + "/ws" + location.search;
+    let ws = null, exited = false, detached = false, retry = 500;
+
+    function send(data) {
+        if (ws && ws.readyState === WebSocket.OPEN) ws.send(data);
+    }
+    function sendSize() {
+        send(JSON.stringify({ resize: [term.cols, term.rows] }));
+    }
+
+    function connect() {
+        ws = new WebSocket(url);
+        ws.binaryType = "arraybuffer";
+        ws.onopen = () => {
+            term.reset();   // The server replays recent output
+            status.textContent = "🟢 attached";
+            toggle.textContent = "Detach";
+            retry = 500;
+            sendSize();
+            term.focus();
+        };
+        ws.onmessage = (e) => {
+            if (typeof e.data !== "string") {
+                term.write(new Uint8Array(e.data));
+                return;
+            }
+            const msg = JSON.parse(e.data);
+            if (msg.exit !== undefined) {
+                exited = true;
+                status.textContent = "⚪ " + msg.exit;
+                toggle.disabled = true;
+            }
+        };
+        ws.onclose = () => {
+            ws = null;
+            if (exited) return;
+            if (detached) {
+                status.textContent = "⏸ detached";
+                toggle.textContent = "Reattach";
+                return;
+            }
+            status.textContent = "🟡 reconnecting…";
+            setTimeout(connect, retry);
+            retry = Math.min(retry * 2, 10000);
+        };
+    }
+
+    term.onData((data) => send(encoder.encode(data)));
+    term.onBinary((data) => send(Uint8Array.from(data, (c) => c.charCodeAt(0))));
+    term.onResize(sendSize);
+    window.addEventListener("resize", () => fit.fit());
+    toggle.onclick = () => {
+        if (ws) {
+            detached = true;
+            ws.close();
+        } else {
+            detached = false;
+            connect();
+        }
+    };
+    connect();
+</script>
+</body>
+</html>
+""", job_id=job.job_id, cmd=job.cmd)
+
+def term_socket(ws, sid):
+    """One attached browser: this thread reads input and resizes, a sender thread streams output."""
+    job, error = term_session_job(sid)
+    if error:
+        ws.send(json.dumps({"exit": error}))
+        return
+    client = TermClient()
+    if job.spill is not None:
+        # run_cmd's on_data writes the spill and lists watchers under this lock, so no chunk is lost or doubled
+        with job.spill.lock:
+            client.feed(job.spill.tail(TERM_REPLAY_BYTES, locked=True))
+            job.watchers.append(client.feed)
+    else:
+        job.watchers.append(client.feed)
+    if job.ended is not None:
+        client.close()   # Finished after term_session_job(): on_finish may have run before we were listed
+
+    def sender():
+        try:
+            while True:
+                data = client.next_batch()
+                if data is None:
+                    break
+                ws.send(data)
+            if job.ended is not None:
+                ws.send(json.dumps({"exit": f"job #{job.job_id} {job.describe_exit()}"}))
+            ws.close()
+        except Exception:
+            pass   # Socket closed under us, the reader below notices too
+
+    threading.Thread(target=sender, name=f"term-{job.job_id}", daemon=True).start()
+    try:
+        while not client.closed:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, bytes):
+                job.write_input(message)
+                continue
+            resize = json.loads(message).get("resize")
+            if resize:
+                cols, rows = (max(2, min(int(v), 500)) for v in resize)
+                job.resize(rows, cols)
+    except Exception:
+        pass   # Browser went away or the job's terminal is gone
+    finally:
+        job.watchers.remove(client.feed)
+        client.close()
+        if not job.watchers and job.ended is None:
+            try:
+                job.resize(CONSOLE_ROWS, CONSOLE_COLS)   # Back to what the Telegram console renders
+            except OSError:
+                pass
+
+if sock is not None:
+    sock.route("/term/<sid>/ws")(term_socket)
+
+# ================= WEBHOOK =================
+
+webhook_pool = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+webhook_slots = threading.BoundedSemaphore(WEBHOOK_BACKLOG)
+
+def process_update_batch(updates):
+    try:
+        bot.process_new_updates(updates)
+    except Exception as e:
+        print(f"⚠️ Update processing failed: {e}")
+    finally:
+        webhook_slots.release()
+
+@app.route("/webhook/<secret>", methods=["POST"])
+def webhook(secret):
+    """
+    Telegram delivers updates here when WEBHOOK_SECRET is set. The body is
+    one Update object, or a JSON array of them (handy for replaying
+    recorded updates with curl). Updates are acknowledged right away and
+    handled on a bounded pool; when the backlog is full Telegram gets a
+    503 and retries later.
+    """
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET) \
+            or not hmac.compare_digest(header, WEBHOOK_SECRET):
+        return "Forbidden", 403
+
+    payload = request.get_json(force=True, silent=True)
+    if payload is None:
+        return "Bad Request", 400
+    try:
+        updates = [types.Update.de_json(u) for u in (payload if isinstance(payload, list) else [payload])]
+    except Exception as e:
+        print(f"⚠️ Bad update payload: {e}")
+        return "Bad Request", 400
+
+    if not webhook_slots.acquire(blocking=False):
+        return "Busy", 503
+    webhook_pool.submit(process_update_batch, updates)
+    return "OK"
+
+# ================= ASYNCIO RUNTIME =================
+
+class AsyncOutbox(TelegramOutbox):
+    """
+    TelegramOutbox for the asyncio runtime. Queueing, buckets, merging and
+    retries are shared; dispatch runs as event loop callbacks and each call
+    is a coroutine on AsyncTeleBot instead of a pool thread. Safe to call
+    from other threads.
+    """
+
+    def __init__(self, abot, loop):
+        super().__init__()
+        self.abot = abot
+        self.loop = loop
+        self.kicked = False
+        self.timer = None
+
+    def _kick(self):
+        if not self.kicked:
+            self.kicked = True
+            self.loop.call_soon_threadsafe(self._dispatch)
+
+    def _dispatch(self):
+        with self.cond:
+            self.kicked = False
+            while True:
+                item, wait = self._next_ready()
+                if item is None:
+                    break
+                self.loop.create_task(self._perform_async(item))
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if wait is not None:
+            self.timer = self.loop.call_later(wait, self._dispatch)
+
+    async def call(self, method, *args, **kwargs):
+        """Queue a Bot API call and await its result on the loop; None if it failed (already logged)."""
+        try:
+            return await asyncio.wrap_future(getattr(self, method)(*args, **kwargs))
+        except Exception:
+            return None
+
+    async def _perform_async(self, item):
+        start = time.perf_counter()
+        try:
+            result = await getattr(self.abot, item.method)(*item.args, **item.kwargs)
+        except Exception as e:
+            TG_API_SECONDS.observe(time.perf_counter() - start, item.method)
+            self._failed(item, e)
+        else:
+            TG_API_SECONDS.observe(time.perf_counter() - start, item.method)
+            self._finish(item, result, None)
+
+class AsyncioReactor(PtyMultiplexer):
+    """PtyMultiplexer for the asyncio runtime: fds and timers live on the event loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def start(self):
+        pass
+
+    def add(self, fd, pid, on_data, on_exit):
+        os.set_blocking(fd, False)
+        entry = _PtyEntry(fd, pid, on_data, on_exit)
+        self.loop.call_soon_threadsafe(self._register, entry)
+        return entry
+
+    def call_later(self, delay, callback):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def _register(self, entry):
+        self.loop.add_reader(entry.fd, self._read, entry)
+        if hasattr(os, "pidfd_open"):
+            try:
+                entry.pidfd = os.pidfd_open(entry.pid)
+                self.loop.add_reader(entry.pidfd, self._pidfd_ready, entry)
+            except OSError:
+                entry.pidfd = None  # Old kernel, rely on EOF
+
+    def _unwatch(self, fd):
+        self.loop.remove_reader(fd)
+
+    async def writable(self, fd, timeout):
+        """Wait until fd has room for a write, at most timeout seconds."""
+        ready = self.loop.create_future()
+        self.loop.add_writer(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.loop.remove_writer(fd)
+
+handler_pool = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="handler")
+OFFLOAD_CALLBACKS = ("status", "list_files", "fb_", "log_", "vw_", "view_")   # buttons that touch files or gzip
+
+async def job_input(job, data):
+    """Write to a job's terminal from the loop, waiting for room in a full PTY while the job runs."""
+    if job.node is not None:
+        job.write_input(data)
+        return
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(job.fd, view):]
+        except BlockingIOError:
+            if job.ended is not None:
+                raise OSError("job has ended")
+            await pty_mux.writable(job.fd, 1)
+
+async def async_shell(m):
+    """shell() on the loop: input for a running job is awaited instead of failing on a full PTY."""
+    cid = m.chat.id
+    if is_admin(cid) and cid not in next_steps:
+        job = registry.claim_input(MAIN_ADMIN_ID, cid)
+        if job is not None and job.status == "running":
+            touch_session(MAIN_ADMIN_ID, cid)
+            try:
+                await job_input(job, (m.text.strip() + "\n").encode())
+            except OSError as e:
+                await outbox.call("send_message", cid, f"⚠️ Cannot write to job #{job.job_id}: {e}")
+            return
+    shell(m)
+
+async def async_callback(call):
+    """Buttons on the loop, except the ones that list directories, read files or gzip logs."""
+    if call.data.startswith(OFFLOAD_CALLBACKS):
+        await asyncio.get_running_loop().run_in_executor(handler_pool, callback_handler, call)
+    else:
+        callback_handler(call)
+
+NATIVE_HANDLERS = {"shell": async_shell, "callback_handler": async_callback}
+
+def _async_handler(function):
+    """Coroutine for a mirrored handler: a native one, the handler itself on the loop, or @offload ones on the pool."""
+    if function.__name__ in NATIVE_HANDLERS:
+        return NATIVE_HANDLERS[function.__name__]
+    if getattr(function, "offload", False):
+        async def handler(update):
+            await asyncio.get_running_loop().run_in_executor(handler_pool, function, update)
+    else:
+        async def handler(update):
+            function(update)
+    return handler
+
+def run_async():
+    """
+    RUNTIME=asyncio: updates come from AsyncTeleBot, PTY fds are read via
+    loop.add_reader, and API calls, edits and console timers are
+    coroutines and callbacks on the loop thread. The handlers registered
+    on `bot` are mirrored onto the async bot: chat input, buttons and job
+    commands run on the loop, the few marked @offload (files, gzip,
+    SQLite) on HANDLER_WORKERS threads. The state store writer, history
+    log, sampler, transfers and session sweeper keep their own threads,
+    as in the threaded runtime. Updates arrive by polling only.
+    """
+    global outbox, pty_mux
+    try:
+        from telebot.async_telebot import AsyncTeleBot
+        from telebot import asyncio_helper
+    except ImportError as e:
+        print(f"⚠️ asyncio runtime unavailable ({e}), install aiohttp")
+        return
+
+    if TELEGRAM_API_URL:
+        asyncio_helper.API_URL = telebot.apihelper.API_URL
+        asyncio_helper.FILE_URL = telebot.apihelper.FILE_URL
+    abot = AsyncTeleBot(BOT_TOKEN)
+    for handlers, async_handlers in ((bot.message_handlers, abot.message_handlers),
+                                     (bot.callback_query_handlers, abot.callback_query_handlers)):
+        for handler in handlers:
+            async_handlers.append({"function": _async_handler(handler["function"]),
+                                   "pass_bot": False, "filters": handler["filters"]})
+
+    async def main():
+        global outbox, pty_mux
+        loop = asyncio.get_running_loop()
+        outbox = AsyncOutbox(abot, loop)
+        pty_mux = AsyncioReactor(loop)
+        await abot.infinity_polling(timeout=60)
+
+    asyncio.run(main())
 
 # ================= START SERVER =================
 
@@ -847,9 +5425,19 @@ def home():
 </html>
 """
 if __name__ == "__main__":
+    if RUNTIME == "asyncio" and WEBHOOK_SECRET:
+        raise SystemExit("❌ RUNTIME=asyncio only polls: unset WEBHOOK_SECRET or use RUNTIME=threads")
     print("🤖 Starting Termux Controller Pro...")
+    instrument_handlers()
     print(f"👑 Main Admin: {MAIN_ADMIN_ID}")
     print(f"📁 Base Directory: {BASE_DIR}")
+    if NODE_LISTEN:
+        if not NODE_TOKEN:
+            print("⚠️ NODE_LISTEN is set without NODE_TOKEN, agents are disabled")
+        else:
+            host, port = node_hub.listen(NODE_LISTEN)[:2]
+            print(f"🌐 Waiting for agents on {host}:{port}")
+    sampler.start()
     
     # Start Flask server safely
     def run_flask():
@@ -858,12 +5446,22 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"⚠️ Flask server error: {e}")
     
-    threading.Thread(target=run_flask, daemon=True).start()
-    
-    # Start bot with retry
-    while True:
-        try:
-            bot.infinity_polling(timeout=60, long_polling_timeout=60)
-        except Exception as e:
-            print(f"⚠️ Bot error: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
+    if RUNTIME == "asyncio":
+        threading.Thread(target=run_flask, daemon=True).start()
+        run_async()
+    elif WEBHOOK_SECRET:
+        # Webhook mode: Telegram pushes updates to Flask, no polling loop
+        bot.remove_webhook()
+        bot.set_webhook(url=f"{PUBLIC_URL}/webhook/{WEBHOOK_SECRET}", secret_token=WEBHOOK_SECRET)
+        print(f"🔗 Webhook: {PUBLIC_URL}/webhook/***")
+        run_flask()
+    else:
+        threading.Thread(target=run_flask, daemon=True).start()
+        
+        # Start bot with retry
+        while True:
+            try:
+                bot.infinity_polling(timeout=60, long_polling_timeout=60)
+            except Exception as e:
+                print(f"⚠️ Bot error: {e}. Retrying in 5 seconds...")
+                time.sleep(5)
@@ -0,0 +1,364 @@
+# ================= NODE LINK =================
+#
+# Wire protocol between the bot (the hub) and agents on other devices,
+# plus the agent itself. An agent connects to the hub over one TCP
+# connection, proves it knows NODE_TOKEN, and then runs PTY jobs on its
+# own machine as the hub asks, streaming their output back compressed.
+# Everything is multiplexed over that connection by job channel.
+#
+#   NODE_LISTEN=0.0.0.0:9191 NODE_TOKEN=secret python main.py          # hub
+#   python node_link.py --hub 192.168.1.10:9191 --name phone2 --token secret
+#
+# The link authenticates both sides but is not encrypted: outside a
+# trusted network, run it through an SSH tunnel or a VPN.
+#
+# Frames are HEADER (type, channel, payload length) + payload. Channel 0
+# is the link itself, any other channel is the job with that ID.
+
+import argparse
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import pty
+import resource
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import sys
+import termios
+import time
+import zlib
+
+HEADER = struct.Struct("!BII")
+MAX_FRAME = 4 * 1024 * 1024
+VERSION = 1
+
+# Link control, channel 0
+CHALLENGE = 1   # hub -> agent: {"nonce"}
+HELLO = 2       # agent -> hub: {"name", "nonce", "mac", "host", "pid", "version"}
+WELCOME = 3     # hub -> agent: {"mac"}
+REFUSED = 4     # hub -> agent: {"error"}
+PING = 5
+PONG = 6
+# Jobs, channel = job ID
+RUN = 10        # hub -> agent: {"cmd", "rows", "cols", "term", "cwd", "limits"}
+INPUT = 11      # hub -> agent: bytes for the job's PTY
+SIGNAL = 12     # hub -> agent: {"signal"}, sent to the job's process group
+OUTPUT = 13     # agent -> hub: PTY output, one zlib stream per channel (Z_SYNC_FLUSH per frame)
+EXIT = 14       # agent -> hub: {"exit_code", "usage"}, exit_code negative when killed by a signal
+RESIZE = 15     # hub -> agent: {"rows", "cols"} of the job's terminal
+
+class LinkClosed(Exception):
+    """The other side closed the connection or broke the protocol."""
+
+def send_frame(sock, kind, channel=0, payload=b""):
+    """Send one frame; payload may be bytes or a JSON-able dict. Callers serialize sends."""
+    if isinstance(payload, dict):
+        payload = json.dumps(payload).encode()
+    sock.sendall(HEADER.pack(kind, channel, len(payload)) + payload)
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        data = sock.recv(n - len(buf))
+        if not data:
+            raise LinkClosed("connection closed")
+        buf += data
+    return bytes(buf)
+
+def recv_frame(sock):
+    """(kind, channel, payload bytes) of the next frame."""
+    kind, channel, length = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if length > MAX_FRAME:
+        raise LinkClosed(f"frame of {length} bytes")
+    return kind, channel, _recv_exact(sock, length) if length else b""
+
+def sign(token, role, nonce):
+    return hmac.new(token.encode(), f"{role}:{nonce}".encode(), hashlib.sha256).hexdigest()
+
+def hub_handshake(sock, token, reserved=()):
+    """Hub side: challenge the agent; returns its HELLO dict or raises LinkClosed. Names in reserved are refused."""
+    nonce = os.urandom(16).hex()
+    send_frame(sock, CHALLENGE, 0, {"nonce": nonce, "version": VERSION})
+    kind, _, payload = recv_frame(sock)
+    try:
+        hello = json.loads(payload) if kind == HELLO else {}
+    except ValueError:
+        hello = None
+    if not isinstance(hello, dict):
+        raise LinkClosed("malformed hello")
+    if not hmac.compare_digest(str(hello.get("mac", "")), sign(token, "agent", nonce)):
+        send_frame(sock, REFUSED, 0, {"error": "bad token"})
+        raise LinkClosed("agent failed authentication")
+    if not hello.get("name") or not hello.get("nonce"):
+        send_frame(sock, REFUSED, 0, {"error": "missing name"})
+        raise LinkClosed("agent sent no name")
+    if hello["name"] in reserved:
+        send_frame(sock, REFUSED, 0, {"error": f"node name {hello['name']!r} is reserved"})
+        raise LinkClosed(f"agent used the reserved name {hello['name']!r}")
+    send_frame(sock, WELCOME, 0, {"mac": sign(token, "hub", str(hello["nonce"]))})
+    return hello
+
+def agent_handshake(sock, name, token):
+    """Agent side: answer the challenge and check that the hub knows the token too."""
+    kind, _, payload = recv_frame(sock)
+    if kind != CHALLENGE:
+        raise LinkClosed("expected a challenge")
+    nonce = os.urandom(16).hex()
+    send_frame(sock, HELLO, 0, {"name": name, "nonce": nonce, "version": VERSION,
+                                "mac": sign(token, "agent", json.loads(payload)["nonce"]),
+                                "host": socket.gethostname(), "pid": os.getpid()})
+    kind, _, payload = recv_frame(sock)
+    reply = json.loads(payload or b"{}")
+    if kind == REFUSED:
+        raise LinkClosed(f"hub refused: {reply.get('error')}")
+    if kind != WELCOME or not hmac.compare_digest(str(reply.get("mac", "")), sign(token, "hub", nonce)):
+        raise LinkClosed("hub failed authentication")
+
+# ================= JOB LIMITS =================
+#
+# Used by the hub for local jobs and by agents, in the forked child
+# before exec. Limits are a dict of cpu (seconds), mem and fsize (MB),
+# nofile, nice and ionice ("idle" or a best-effort level 0-7); 0 or a
+# missing key means no limit.
+
+RLIMITS = {
+    "cpu": (resource.RLIMIT_CPU, 1),
+    "mem": (resource.RLIMIT_AS, 1024 * 1024),
+    "fsize": (resource.RLIMIT_FSIZE, 1024 * 1024),
+    "nofile": (resource.RLIMIT_NOFILE, 1),
+}
+
+def apply_limits(limits):
+    """Set rlimits and niceness of the current process (the job child)."""
+    for key, (rlimit, unit) in RLIMITS.items():
+        value = int(limits.get(key) or 0) * unit
+        if value <= 0:
+            continue
+        _, hard = resource.getrlimit(rlimit)
+        soft = value if hard == resource.RLIM_INFINITY else min(value, hard)
+        new_hard = soft
+        if key == "cpu":
+            # SIGXCPU at the soft limit, SIGKILL a little later if it is ignored
+            new_hard = soft + 5 if hard == resource.RLIM_INFINITY else min(soft + 5, hard)
+        try:
+            resource.setrlimit(rlimit, (soft, new_hard))
+        except (ValueError, OSError):
+            pass
+    if limits.get("nice"):
+        try:
+            os.nice(int(limits["nice"]))
+        except OSError:
+            pass
+
+def job_argv(cmd, limits):
+    """bash -c cmd, under ionice when an I/O class is set and ionice is installed."""
+    argv = ["bash", "-c", cmd]
+    ionice = str(limits.get("ionice") or "")
+    if ionice and shutil.which("ionice"):
+        prefix = ["ionice", "-c", "3"] if ionice == "idle" else ["ionice", "-c", "2", "-n", ionice]
+        argv = prefix + argv
+    return argv
+
+def usage_of(rusage):
+    """JSON-able summary of a reaped job's struct rusage."""
+    return {"user": round(rusage.ru_utime, 3), "sys": round(rusage.ru_stime, 3),
+            "maxrss": rusage.ru_maxrss,   # KB on Linux
+            "inblock": rusage.ru_inblock, "oublock": rusage.ru_oublock}
+
+# ================= AGENT =================
+
+class AgentJob:
+    """A PTY job the agent runs for the hub."""
+
+    def __init__(self, channel, pid, fd):
+        self.channel = channel
+        self.pid = pid
+        self.fd = fd            # None once the PTY hit EOF
+        self.compressor = zlib.compressobj(6)
+
+class Agent:
+    """
+    Connects to the hub, runs the jobs it is sent and streams their output
+    back. One thread: a selector over the link socket and every job PTY,
+    plus timers that reap jobs without blocking. Reconnects with backoff;
+    jobs of a lost link are killed, since their output has nowhere to go.
+    """
+
+    def __init__(self, hub, name, token, cwd=None, ping_timeout=90):
+        host, _, port = hub.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        self.name = name
+        self.token = token
+        self.cwd = cwd or os.getcwd()
+        self.ping_timeout = ping_timeout
+        self.sock = None
+        self.selector = None
+        self.jobs = {}   # channel -> AgentJob
+        self.reaps = []  # (monotonic due time, AgentJob, next delay) of jobs to wait for again
+
+    def run_forever(self):
+        delay = 1
+        while True:
+            try:
+                self.sock = socket.create_connection(self.address, timeout=30)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                agent_handshake(self.sock, self.name, self.token)
+                print(f"🔗 Connected to hub {self.address[0]}:{self.address[1]} as {self.name}", flush=True)
+                delay = 1
+                self.serve()
+            except (OSError, LinkClosed, ValueError) as e:
+                print(f"⚠️ Link to hub lost: {e}. Retrying in {delay}s", flush=True)
+            finally:
+                self._drop_jobs()
+                if self.sock is not None:
+                    self.sock.close()
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def serve(self):
+        self.sock.settimeout(None)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        last_heard = time.monotonic()
+        try:
+            while True:
+                timeout = 5
+                if self.reaps:
+                    timeout = max(0, min(timeout, min(due for due, _, _ in self.reaps) - time.monotonic()))
+                events = self.selector.select(timeout=timeout)
+                if not events and time.monotonic() - last_heard > self.ping_timeout:
+                    raise LinkClosed("hub stopped answering")
+                for key, _ in events:
+                    if key.data is None:
+                        last_heard = time.monotonic()
+                        self._on_frame(*recv_frame(self.sock))
+                    else:
+                        self._on_pty(key.data)
+                self._run_reaps()
+        finally:
+            self.selector.close()   # One per connection, its epoll fd would leak on every reconnect
+
+    def _on_frame(self, kind, channel, payload):
+        if kind == PING:
+            send_frame(self.sock, PONG)
+        elif kind == RUN:
+            self._start(channel, json.loads(payload))
+        elif kind == INPUT:
+            job = self.jobs.get(channel)
+            if job is not None and job.fd is not None:
+                try:
+                    os.write(job.fd, payload)
+                except OSError:
+                    pass
+        elif kind == SIGNAL:
+            job = self.jobs.get(channel)
+            if job is not None:
+                try:
+                    os.killpg(job.pid, json.loads(payload)["signal"])
+                except OSError:
+                    pass   # Already gone, or a process that changed user
+        elif kind == RESIZE:
+            job = self.jobs.get(channel)
+            if job is not None and job.fd is not None:
+                size = json.loads(payload)
+                try:
+                    fcntl.ioctl(job.fd, termios.TIOCSWINSZ, struct.pack("HHHH", size["rows"], size["cols"], 0, 0))
+                except OSError:
+                    pass
+
+    def _start(self, channel, spec):
+        try:
+            pid, fd = pty.fork()
+        except OSError as e:
+            send_frame(self.sock, OUTPUT, channel, zlib.compress(f"❌ Cannot start: {e}\r\n".encode()))
+            send_frame(self.sock, EXIT, channel, {"exit_code": 127})
+            return
+        if pid == 0:
+            try:
+                os.chdir(spec.get("cwd") or self.cwd)
+            except OSError:
+                os.chdir(self.cwd)
+            try:
+                fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack("HHHH", spec.get("rows", 24), spec.get("cols", 80), 0, 0))
+                os.environ["TERM"] = spec.get("term", "xterm")
+                limits = spec.get("limits") or {}
+                apply_limits(limits)
+                argv = job_argv(spec["cmd"], limits)
+                os.execvp(argv[0], argv)
+            finally:
+                os._exit(127)
+        job = self.jobs[channel] = AgentJob(channel, pid, fd)
+        self.selector.register(fd, selectors.EVENT_READ, job)
+
+    def _on_pty(self, job):
+        try:
+            data = os.read(job.fd, 65536)
+        except OSError:
+            data = b""
+        if data:
+            body = job.compressor.compress(data) + job.compressor.flush(zlib.Z_SYNC_FLUSH)
+            send_frame(self.sock, OUTPUT, job.channel, body)
+            return
+        # EOF: nothing holds the terminal any more, but the job may still run (daemonized, or in D state)
+        self.selector.unregister(job.fd)
+        os.close(job.fd)
+        job.fd = None
+        self._reap(job, 0.05)
+
+    def _reap(self, job, delay):
+        """Report the job's exit if it can be waited for, else look again after delay."""
+        try:
+            pid, status, rusage = os.wait4(job.pid, os.WNOHANG)
+        except ChildProcessError:
+            pid, status, rusage = job.pid, 0, None
+        if pid == 0:
+            self.reaps.append((time.monotonic() + delay, job, min(delay * 2, 5)))
+            return
+        if self.jobs.get(job.channel) is not job:
+            return   # Dropped with its link, nobody to tell
+        del self.jobs[job.channel]
+        send_frame(self.sock, EXIT, job.channel, {"exit_code": os.waitstatus_to_exitcode(status),
+                                                  "usage": usage_of(rusage) if rusage else None})
+
+    def _run_reaps(self):
+        now = time.monotonic()
+        due = [entry for entry in self.reaps if entry[0] <= now]
+        if due:
+            self.reaps = [entry for entry in self.reaps if entry[0] > now]
+            for _, job, delay in due:
+                self._reap(job, delay)
+
+    def _drop_jobs(self):
+        """Kill the jobs of a lost link; they are reaped by the timers of the next connection."""
+        for job in list(self.jobs.values()):
+            try:
+                os.killpg(job.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            if job.fd is not None:
+                try:
+                    os.close(job.fd)
+                except OSError:
+                    pass
+            if not any(entry[1] is job for entry in self.reaps):
+                self.reaps.append((time.monotonic(), job, 0.05))
+        self.jobs.clear()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run jobs on this device for a Termux Controller hub")
+    parser.add_argument("--hub", default=os.environ.get("NODE_HUB"), help="host:port of the hub's NODE_LISTEN")
+    parser.add_argument("--name", default=os.environ.get("NODE_NAME", socket.gethostname()))
+    parser.add_argument("--token", default=os.environ.get("NODE_TOKEN"))
+    parser.add_argument("--cwd", default=os.environ.get("NODE_CWD"), help="working directory of jobs")
+    args = parser.parse_args()
+    if not args.hub or not args.token:
+        sys.exit("❌ --hub and --token (or NODE_HUB and NODE_TOKEN) are required")
+    Agent(args.hub, args.name, args.token, args.cwd).run_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# ================= TEST SETUP =================
+#
+# main.py reads its configuration and opens its database at import, so
+# the environment is set up here, before any test imports it: a
+# throwaway working directory (BASE_DIR), database and spill directory.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="termux-bot-test-")
+
+os.environ.update(
+    BOT_TOKEN="123456:test",
+    MAIN_ADMIN_ID="1",
+    DB_FILE=os.path.join(WORKDIR, "bot_data.db"),
+    SPILL_DIR=os.path.join(WORKDIR, "spill"),
+    DB_FLUSH_INTERVAL="0.05",
+)
+for name in ("TELEGRAM_API_URL", "WEBHOOK_SECRET", "NODE_LISTEN", "NODE_TOKEN", "RUNTIME"):
+    os.environ.pop(name, None)
+os.chdir(WORKDIR)
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+@pytest.fixture
+def fake_api():
+    """Start a FakeBotAPI(**options) and point telebot at it; returns the FakeBotAPI."""
+    import telebot
+    from fake_bot_api import FakeBotAPI
+
+    servers = []
+    api_url = telebot.apihelper.API_URL
+
+    def start(**options):
+        api = FakeBotAPI(**options)
+        server = api.serve()
+        servers.append(server)
+        telebot.apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+        return api
+
+    yield start
+    telebot.apihelper.API_URL = api_url
+    for server in servers:
+        server.shutdown()
@@ -0,0 +1,69 @@
+# ================= NODE HUB =================
+#
+# Two agents on localhost against the hub: jobs are routed to the right
+# one, a job that closes its terminal but keeps running doesn't stall
+# its agent, and the reserved node name "local" is refused.
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import main
+import node_link
+
+TOKEN = "node-test-token"
+
+@pytest.fixture(scope="module")
+def hub(tmp_path_factory):
+    main.NODE_TOKEN = TOKEN
+    host, port = main.node_hub.listen("127.0.0.1:0")[:2]
+    cwds = {}
+    for name in ("alpha", "beta"):
+        cwds[name] = str(tmp_path_factory.mktemp(name))
+        agent = node_link.Agent(f"{host}:{port}", name, TOKEN, cwds[name])
+        threading.Thread(target=agent.run_forever, daemon=True).start()
+    deadline = time.time() + 10
+    while set(main.node_hub.nodes) != set(cwds) and time.time() < deadline:
+        time.sleep(0.05)
+    assert set(main.node_hub.nodes) == set(cwds)
+    return f"{host}:{port}", cwds
+
+def run_on(node, cmd):
+    """Submit cmd to node; returns (job, Event set when it finished, output chunks)."""
+    job = main.Job(cmd, 1, 555)
+    job.node = node
+    chunks = []
+    finished = threading.Event()
+    job.on_data = chunks.append
+    job.on_finish = lambda job: finished.set()
+    main.supervisor.submit(job)
+    return job, finished, chunks
+
+def test_jobs_run_on_their_node(hub):
+    _, cwds = hub
+    runs = {name: run_on(name, "pwd") for name in cwds}
+    for name, (job, finished, chunks) in runs.items():
+        assert finished.wait(10)
+        assert job.status == "exited" and job.exit_code == 0
+        assert os.path.realpath(b"".join(chunks).decode().strip()) == os.path.realpath(cwds[name])
+
+def test_job_without_terminal_does_not_block_its_agent(hub):
+    # Like a nohup'ed daemon: closes its terminal right away, survives the hangup and runs 3s more
+    lingering, lingering_done, _ = run_on("alpha", "trap '' HUP; exec 0<&- 1>&- 2>&-; sleep 3")
+    time.sleep(0.3)
+    job, finished, chunks = run_on("alpha", "echo still here")
+    assert finished.wait(2), "agent stalled behind a job that closed its terminal"
+    assert b"still here" in b"".join(chunks)
+    assert lingering.ended is None
+    assert lingering_done.wait(10) and lingering.exit_code == 0
+
+def test_reserved_name_is_refused(hub):
+    address, _ = hub
+    host, _, port = address.rpartition(":")
+    with socket.create_connection((host, int(port)), timeout=5) as sock:
+        with pytest.raises(node_link.LinkClosed, match="reserved"):
+            node_link.agent_handshake(sock, "local", TOKEN)
+    assert main.node_hub.get("local") is None
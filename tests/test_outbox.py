@@ -0,0 +1,74 @@
+# ================= OUTBOUND SEND QUEUE =================
+#
+# TelegramOutbox against the fake Bot API with Telegram's rate limits
+# enforced: per-chat ordering, merging, priorities, 429 handling and
+# drop counters.
+
+import random
+
+import pytest
+
+import main
+
+CHAT = 4242
+
+def sent_texts(api, chat_id):
+    return [c.text for c in api.calls if c.chat_id == chat_id and c.method == "sendMessage" and c.status == "ok"]
+
+def test_order_kept_and_429s_honoured(fake_api):
+    random.seed(3)
+    api = fake_api(enforce_limits=True, rate_429=0.3, retry_after=1)
+    outbox = main.TelegramOutbox()
+    futures = [outbox.send_message(CHAT, f"m{i}") for i in range(6)]
+    for future in futures:
+        future.result(timeout=60)
+
+    assert sent_texts(api, CHAT) == [f"m{i}" for i in range(6)]
+    refused = [c for c in api.calls if c.status in ("429", "limit")]
+    assert refused, "seed should produce at least one 429"
+    assert outbox.stats["retried"] == len(refused)
+    assert outbox.stats["sent"] == 6 and outbox.stats["failed"] == 0
+    for call in refused:
+        retry = next(c for c in api.calls[call.index + 1:] if c.chat_id == call.chat_id)
+        assert retry.at - call.at >= 0.9   # retry_after of 1s, minus clock slack
+
+def test_queued_messages_and_edits_merge(fake_api):
+    api = fake_api(enforce_limits=True)
+    outbox = main.TelegramOutbox()
+    with outbox.cond:  # Nothing goes out while the calls are queued
+        lines = [outbox.send_message(CHAT, f"line{i}", merge=True) for i in range(5)]
+        edits = [outbox.edit_message_text(f"v{i}", CHAT, 77) for i in range(3)]
+    assert outbox.stats["merged"] == 4 + 2
+
+    message = lines[0].result(timeout=10)
+    assert all(f.result(timeout=10).message_id == message.message_id for f in lines)
+    for future in edits:
+        future.result(timeout=10)
+    assert sent_texts(api, CHAT) == ["\n".join(f"line{i}" for i in range(5))]
+    assert [c.text for c in api.calls if c.method == "editMessageText"] == ["v2"]
+
+def test_interactive_overtakes_bulk(fake_api):
+    api = fake_api()
+    outbox = main.TelegramOutbox()
+    with outbox.cond:
+        bulk = outbox.send_message(CHAT, "output", priority=main.PRIO_BULK)
+        reply = outbox.send_message(CHAT, "reply")
+    bulk.result(timeout=10)
+    reply.result(timeout=10)
+    assert sent_texts(api, CHAT) == ["reply", "output"]
+
+def test_overflow_drops_bulk_first(fake_api, monkeypatch):
+    api = fake_api()
+    monkeypatch.setattr(main, "SEND_QUEUE_MAX", 2)
+    outbox = main.TelegramOutbox()
+    outbox._drop_one()  # Empty queue: nothing to drop, no error
+    with outbox.cond:
+        old_bulk = outbox.send_message(CHAT, "old output", priority=main.PRIO_BULK)
+        reply = outbox.send_message(CHAT, "reply")
+        new_bulk = outbox.send_message(CHAT, "new output", priority=main.PRIO_BULK)
+    with pytest.raises(main.OutboxDropped):
+        old_bulk.result(timeout=10)
+    reply.result(timeout=10)
+    new_bulk.result(timeout=10)
+    assert outbox.stats["dropped"] == 1
+    assert sent_texts(api, CHAT) == ["reply", "new output"]
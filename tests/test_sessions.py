@@ -0,0 +1,55 @@
+# ================= SESSION MANAGER =================
+
+import threading
+import time
+
+import main
+
+def test_due_entries_are_invisible_until_swept():
+    manager = main.SessionManager()
+    emap = manager.table("t", 60)
+    emap.set("live", 1)
+    emap.set("due", 2, time.time() - 1)
+    manager.heap.clear()   # Keep the sweeper from removing "due" first
+
+    assert "due" not in emap and emap.get("due") is None
+    assert emap.pop("due", "gone") == "gone"
+    assert len(emap) == 1 and emap.stored() == 2
+    assert emap.pop("live") == 1 and len(emap) == 0
+
+def test_expired_prompt_does_not_take_input():
+    registry = main.ChatRegistry(4)
+    job = main.Job("read x", 1, 99)
+    registry.add_job(1, 99, job)
+    registry.set_foreground(1, 99, job)
+    assert registry.wait_input(1, 99, job)
+    main.input_wait.set((1, 99), job, time.time() - 1)   # The prompt timed out, not swept yet
+    assert registry.claim_input(1, 99) is None
+
+def test_compaction_races_with_writers():
+    manager = main.SessionManager()
+    emap = manager.table("t", 60, sliding=True)
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            try:
+                emap.set(i % 500, i)
+                emap.get((i * 7) % 500)
+            except Exception as e:
+                errors.append(e)
+            i += 1
+
+    threads = [threading.Thread(target=writer) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 1
+    while time.time() < deadline:
+        with manager.cond:
+            manager._compact()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert not errors
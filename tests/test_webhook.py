@@ -0,0 +1,36 @@
+# ================= WEBHOOK =================
+#
+# Replays a recorded update through Flask's test client, as Telegram
+# would deliver it when WEBHOOK_SECRET is set.
+
+import json
+import os
+
+import main
+
+SECRET = "webhook-test-secret"
+
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "update_jobs.json")) as f:
+    UPDATE = json.load(f)
+
+def post(client, secret, header, body=UPDATE):
+    return client.post(f"/webhook/{secret}", json=body, headers={"X-Telegram-Bot-Api-Secret-Token": header})
+
+def test_bad_secret_is_forbidden(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    client = main.app.test_client()
+    assert post(client, "wrong", SECRET).status_code == 403
+    assert post(client, SECRET, "wrong").status_code == 403
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", None)
+    assert post(client, SECRET, SECRET).status_code == 403   # Webhook mode off
+
+def test_recorded_update_is_dispatched(monkeypatch, fake_api):
+    api = fake_api()
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    client = main.app.test_client()
+    assert client.post(f"/webhook/{SECRET}", data="not json",
+                       headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}).status_code == 400
+
+    assert post(client, SECRET, SECRET).status_code == 200
+    reply = api.wait_for(lambda c: c.method == "sendMessage" and c.chat_id == 1, 10)
+    assert reply is not None and "JOBS" in reply.text